@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from metrics import metrics
+from settings import get_text
+
+class Broadcaster:
+    """
+    Sends a broadcast to every invited user at a fixed rate, well below
+    Telegram's global limit so that replies to students keep priority.
+    Progress is saved after every batch; a broadcast interrupted by a restart
+    resumes after the last saved batch (its last batch may be sent twice).
+    """
+
+    def __init__(self, broadcast_repo, rate: float, batch_size: int):
+        self.broadcast_repo = broadcast_repo
+        self.interval = 1 / rate
+        self.batch_size = batch_size
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._next_slot = 0.0
+
+    def start(self, broadcast: dict, bot: Bot) -> None:
+        """Run a broadcast in the background"""
+        broadcast_id = broadcast['id']
+        if broadcast_id in self.tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast, bot))
+        self.tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+
+    async def resume(self, bot: Bot) -> int:
+        """Continue broadcasts that were running when the bot stopped"""
+        broadcasts = await self.broadcast_repo.get_running_broadcasts()
+        for broadcast in broadcasts:
+            logging.info(f"Resuming broadcast {broadcast['id']} after user {broadcast['last_user_id']}")
+            self.start(broadcast, bot)
+        return len(broadcasts)
+
+    async def _wait_turn(self) -> None:
+        """Pace sends to the configured rate"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, bot: Bot, user_id: int, text: str) -> str:
+        """Send one message, returning "sent", "blocked" or "failed" """
+        for _ in range(3):
+            await self._wait_turn()
+            try:
+                await bot.send_message(user_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot: pause every sender
+                self._next_slot = max(self._next_slot, time.monotonic() + e.retry_after)
+                metrics.increment("broadcast_flood_waits")
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramAPIError as e:
+                logging.warning(f"Failed to send broadcast to {user_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def _send_batch(self, broadcast: dict, bot: Bot, user_ids: list) -> None:
+        results = await asyncio.gather(*(self._send(bot, user_id, broadcast['text']) for user_id in user_ids))
+        blocked = [user_id for user_id, result in zip(user_ids, results) if result == "blocked"]
+        sent = results.count("sent")
+        failed = results.count("failed")
+        metrics.increment("broadcast_sent", sent)
+        metrics.increment("broadcast_failed", failed)
+        metrics.increment("broadcast_blocked", len(blocked))
+        await self.broadcast_repo.save_progress(broadcast['id'], user_ids[-1], sent, failed, blocked)
+
+    async def _run(self, broadcast: dict, bot: Bot) -> None:
+        try:
+            # Each batch is a short keyset query, so no connection is held while sending
+            last_user_id = broadcast['last_user_id']
+            while True:
+                batch = await self.broadcast_repo.get_recipients(last_user_id, self.batch_size)
+                if batch is None:
+                    # Still running: it resumes from the saved progress on the next start
+                    return
+                if not batch:
+                    break
+                await self._send_batch(broadcast, bot, batch)
+                last_user_id = batch[-1]
+
+            result = await self.broadcast_repo.finish_broadcast(broadcast['id'])
+            if result:
+                logging.info(f"Broadcast {result['id']} finished: {result['sent']} sent, "
+                             f"{result['failed']} failed, {result['blocked']} blocked")
+                await bot.send_message(result['created_by'], get_text(
+                    'broadcast_finished', result['language'],
+                    sent=result['sent'], failed=result['failed'], blocked=result['blocked']
+                ))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Broadcast {broadcast['id']} failed: {e}")
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import socket
+import uuid
+from typing import Awaitable, Callable
+from aiogram import Bot, Dispatcher
+from metrics import metrics
+
+class Cluster:
+    """
+    Shares the work of several bot instances through Postgres. The instance
+    holding the "polling" lease receives the updates, periodic jobs run
+    under their own leases, and test timers are claimed from scheduled_jobs
+    by the instance owning the shard of their test_id among the live
+    instances. Disabled, the single process does all of it.
+    """
+
+    def __init__(self, cluster_repo, enabled: bool, heartbeat_interval: float,
+                 instance_ttl: float, lease_ttl: float):
+        self.cluster_repo = cluster_repo
+        self.enabled = enabled
+        self.heartbeat_interval = heartbeat_interval
+        self.instance_ttl = instance_ttl
+        self.lease_ttl = lease_ttl
+        self.instance_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.shard_index = 0
+        self.shard_count = 1
+        self.leases = set()
+        self.stopped = asyncio.Event()
+
+    async def heartbeat(self) -> None:
+        """Announce this instance and recompute its shard among the live ones"""
+        live = await self.cluster_repo.heartbeat(self.instance_id, self.instance_ttl)
+        if self.instance_id in live:
+            self.shard_index = live.index(self.instance_id)
+            self.shard_count = len(live)
+            metrics.set_gauge("cluster_instances", len(live))
+
+    async def run_heartbeat(self) -> None:
+        while True:
+            await self.heartbeat()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def hold_lease(self, name: str, ttl: float = None) -> bool:
+        """Take or renew a lease for ttl seconds. Always held when clustering is off."""
+        if not self.enabled:
+            return True
+        held = await self.cluster_repo.acquire_lease(name, self.instance_id, ttl or self.lease_ttl)
+        if held:
+            self.leases.add(name)
+        else:
+            self.leases.discard(name)
+        return held
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    async def _wait_stopped(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.stopped.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_polling(self, dp: Dispatcher, bot: Bot,
+                          on_leader: Callable[[], Awaitable], on_follower: Callable[[], Awaitable]) -> None:
+        """
+        Poll for updates while holding the "polling" lease, and try to take it
+        over otherwise, until stop(). Signals must call stop(): aiogram only
+        handles them while polling.
+        """
+        while not self.stopped.is_set():
+            if await self.hold_lease("polling"):
+                logging.info(f"Instance {self.instance_id} took over polling")
+                metrics.set_gauge("cluster_leader", 1)
+                await on_leader()
+                await self._poll_while_leader(dp, bot)
+                metrics.set_gauge("cluster_leader", 0)
+                await on_follower()
+            await self._wait_stopped(self.lease_ttl / 3)
+
+    async def _poll_while_leader(self, dp: Dispatcher, bot: Bot) -> None:
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+        stopped = asyncio.create_task(self.stopped.wait())
+        while True:
+            done, _ = await asyncio.wait({polling, stopped}, timeout=self.lease_ttl / 3)
+            if done:
+                break
+            if not await self.hold_lease("polling"):
+                logging.warning(f"Instance {self.instance_id} lost the polling lease")
+                break
+        stopped.cancel()
+
+        if not polling.done():
+            try:
+                await dp.stop_polling()
+            except RuntimeError:
+                # Polling did not start yet
+                polling.cancel()
+        result, = await asyncio.gather(polling, return_exceptions=True)
+        if isinstance(result, Exception):
+            logging.error(f"Polling failed: {result}")
+
+    async def leave(self) -> None:
+        """Release the leases of this instance so others take over without waiting for them to expire"""
+        if self.enabled:
+            await self.cluster_repo.remove_instance(self.instance_id)
+            self.leases.clear()
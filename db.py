@@ -1,74 +1,435 @@
+import asyncio
+import functools
 import logging
+import time
 import asyncpg
-from typing import Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict
+from settings import settings
+from metrics import metrics
+
+# Connection of the transaction running in the current task, shared by all repositories
+_transaction_connection: ContextVar[Optional[asyncpg.Connection]] = ContextVar("transaction_connection", default=None)
+# Set while a read-only repository method runs, so its queries may go to the replica
+_read_only: ContextVar[bool] = ContextVar("read_only", default=False)
+
+def read_only(method):
+    """Mark a repository method as read-only: its queries may be served by the read replica"""
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        token = _read_only.set(True)
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            _read_only.reset(token)
+    return wrapper
+
+class NamedStatementConnection(asyncpg.Connection):
+    """Connection that keeps the registered statements it has already prepared"""
+    named_statements: Dict[str, asyncpg.prepared_stmt.PreparedStatement]
 
 class Database:
     def __init__(self):
         self.pool: Optional[asyncpg.Pool] = None
+        # Registered statements by name, prepared once per pooled connection
+        self.queries: Dict[str, str] = {}
+        self.query_stats: Dict[str, Dict[str, float]] = {}
+        self.database_url: str = ""
+        self._last_connect_attempt: float = 0.0
+        self._connect_lock = asyncio.Lock()
+        self._warm_up_task: Optional[asyncio.Task] = None
+        # Optional read replica for read-only repository methods
+        self.replica_pool: Optional[asyncpg.Pool] = None
+        self.replica_url: str = ""
+        self.replica_lag: Optional[float] = None
+        self._replica_checked_at: float = 0.0
+        self._replica_monitor_task: Optional[asyncio.Task] = None
+        # Repositories create or migrate their tables on init unless this is off
+        self.schema_checks: bool = True
     
-    async def connect(self, database_url: str) -> None:
-        """Create a connection pool to the PostgreSQL database"""
+    async def connect(self, database_url: str, replica_url: str = "") -> None:
+        """Create a connection pool to the PostgreSQL database (and to its read replica, if given)"""
+        self.database_url = database_url
         if not database_url:
             logging.warning("DATABASE_URL is not set. Database functionality will be disabled.")
             return
         
+        await self._create_pool()
+        self.replica_url = replica_url
+        if replica_url:
+            # The replica is only used once its lag has been checked
+            self._replica_monitor_task = asyncio.create_task(self._monitor_replica())
+
+    def _pool_options(self, min_size: int) -> dict:
+        """Pool sizing, timeouts and connection setup shared by the primary and replica pools"""
+        return dict(
+            min_size=min_size,
+            max_size=settings.DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=settings.DB_MAX_INACTIVE_LIFETIME,
+            command_timeout=settings.DB_COMMAND_TIMEOUT,
+            server_settings={
+                "statement_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS),
+                "idle_in_transaction_session_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS * 2),
+            },
+            connection_class=NamedStatementConnection,
+            init=self._init_connection
+        )
+
+    async def _create_pool(self) -> bool:
+        """Create the pool with the configured sizing and timeouts"""
+        self._last_connect_attempt = time.monotonic()
+        lazy = settings.DB_LAZY_CONNECT
         try:
-            # Create a connection pool
+            # Create a connection pool; in lazy mode connections are opened in the background
             self.pool = await asyncpg.create_pool(
-                database_url,
-                min_size=5,
-                max_size=20
+                self.database_url,
+                **self._pool_options(0 if lazy else settings.DB_POOL_MIN_SIZE)
             )
+            metrics.increment("db_pool_created")
+
+            if lazy:
+                self._warm_up_task = asyncio.create_task(self._warm_up(settings.DB_POOL_MIN_SIZE))
+                return True
             
             # Test the connection
             async with self.pool.acquire() as conn:
                 version = await conn.fetchval("SELECT version();")
                 logging.info(f"Successfully connected to PostgreSQL: {version}")
+            return True
         except Exception as e:
             logging.error(f"Failed to create database connection pool: {e}")
+            metrics.increment("db_connect_failures")
             self.pool = None
+            return False
+
+    async def _create_replica_pool(self) -> bool:
+        """Create the replica pool; connections are opened on first use"""
+        try:
+            self.replica_pool = await asyncpg.create_pool(self.replica_url, **self._pool_options(0))
+            logging.info("Read replica pool created")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to create read replica pool: {e}")
+            self.replica_pool = None
+            return False
+
+    async def _check_replica_lag(self) -> None:
+        """Measure the replication lag, creating the replica pool if needed; None when the check fails"""
+        if not self.replica_pool and not await self._create_replica_pool():
+            self.replica_lag = None
+            return
+        try:
+            async with self.replica_pool.acquire() as conn:
+                self.replica_lag = float(await conn.fetchval("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """))
+            self._replica_checked_at = time.monotonic()
+            metrics.set_gauge("db_replica_lag_seconds", self.replica_lag)
+        except Exception as e:
+            logging.error(f"Failed to check read replica lag: {e}")
+            self.replica_lag = None
+
+    async def _monitor_replica(self) -> None:
+        """Refresh the replica lag every DB_REPLICA_LAG_CHECK_INTERVAL in the background"""
+        while True:
+            await self._check_replica_lag()
+            await asyncio.sleep(settings.DB_REPLICA_LAG_CHECK_INTERVAL)
+
+    def _replica_usable(self) -> bool:
+        """
+        Whether read-only queries may go to the replica, from the lag last
+        measured by the monitor task. A replica that lags more than
+        DB_REPLICA_MAX_LAG, failed its check or was not checked recently is skipped.
+        """
+        if not self.replica_url:
+            return False
+        fresh = time.monotonic() - self._replica_checked_at < 3 * settings.DB_REPLICA_LAG_CHECK_INTERVAL
+        usable = (
+            self.replica_pool is not None and fresh
+            and self.replica_lag is not None and self.replica_lag <= settings.DB_REPLICA_MAX_LAG
+        )
+        if not usable:
+            metrics.increment("db_replica_fallbacks")
+        return usable
+
+    async def _warm_up(self, size: int) -> None:
+        """Open `size` connections in the background so the first requests do not wait for them"""
+        connections = []
+        try:
+            for _ in range(size):
+                connections.append(await self.pool.acquire())
+            version = await connections[0].fetchval("SELECT version();") if connections else None
+            logging.info(f"Warmed up {len(connections)} database connections: {version}")
+        except Exception as e:
+            logging.error(f"Failed to warm up database connections: {e}")
+        finally:
+            for conn in connections:
+                await self.pool.release(conn)
+
+    async def _ensure_pool(self) -> bool:
+        """Make sure a pool exists, reconnecting at most once per DB_RECONNECT_INTERVAL"""
+        if self.pool:
+            return True
+        if self.database_url:
+            async with self._connect_lock:
+                if self.pool:
+                    return True
+                if time.monotonic() - self._last_connect_attempt >= settings.DB_RECONNECT_INTERVAL:
+                    logging.info("Reconnecting to the database")
+                    if await self._create_pool():
+                        return True
+        logging.error("Database connection not established")
+        return False
+
+    def get_pool_stats(self) -> Dict[str, int]:
+        """Current pool size and usage for monitoring"""
+        stats = self._describe_pool(self.pool)
+        if self.replica_url:
+            stats["replica"] = self._describe_pool(self.replica_pool)
+            stats["replica"]["lag_seconds"] = self.replica_lag
+        return stats
+
+    @staticmethod
+    def _describe_pool(pool: Optional[asyncpg.Pool]) -> Dict[str, int]:
+        if not pool:
+            return {"connected": False}
+        size = pool.get_size()
+        idle = pool.get_idle_size()
+        return {
+            "connected": True,
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "min_size": settings.DB_POOL_MIN_SIZE,
+            "max_size": pool.get_max_size(),
+        }
     
+    @asynccontextmanager
+    async def _acquire(self):
+        """
+        Use the current transaction's connection, or take one from the pool.
+        Read-only repository methods use the replica when its lag is acceptable.
+        """
+        conn = _transaction_connection.get()
+        if conn is not None:
+            yield conn
+            return
+
+        pool = self.pool
+        if _read_only.get() and self._replica_usable():
+            pool = self.replica_pool
+            metrics.increment("db_replica_reads")
+        async with pool.acquire() as conn:
+            yield conn
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether the current context runs inside transaction()"""
+        return _transaction_connection.get() is not None
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Unit of work: every repository call made inside the block runs on one
+        connection and is committed together (or rolled back on an exception).
+        Nested blocks become savepoints. Statements inside a transaction run
+        one at a time, so do not run them concurrently with asyncio.gather.
+        """
+        if not await self._ensure_pool():
+            yield None
+            return
+
+        conn = _transaction_connection.get()
+        if conn is not None:
+            async with conn.transaction():
+                yield conn
+            return
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                token = _transaction_connection.set(conn)
+                try:
+                    yield conn
+                finally:
+                    _transaction_connection.reset(token)
+
+    async def gather(self, *calls):
+        """
+        Run independent repository reads together. Outside a transaction each
+        read gets its own pooled connection and they all wait on the database
+        at once; inside a transaction they run in order on its connection.
+        """
+        if _transaction_connection.get() is not None:
+            return [await call for call in calls]
+        return await asyncio.gather(*calls)
+
+    async def _init_connection(self, conn: NamedStatementConnection) -> None:
+        """Prepare all registered statements on a new pooled connection"""
+        conn.named_statements = {}
+        for name, query in self.queries.items():
+            try:
+                conn.named_statements[name] = await conn.prepare(query)
+            except Exception as e:
+                logging.error(f"Failed to prepare statement {name}: {e}")
+
+    def register(self, name: str, query: str) -> None:
+        """Register a named statement that is prepared once per connection and reused"""
+        if self.queries.get(name, query) != query:
+            raise ValueError(f"Statement {name} is already registered with a different query")
+        self.queries[name] = query
+
+    async def _prepared(self, conn: NamedStatementConnection, name: str, refresh: bool = False):
+        """Get the connection's prepared statement for a registered name"""
+        statements = conn.named_statements
+        statement = None if refresh else statements.get(name)
+        if statement is None:
+            statement = statements[name] = await conn.prepare(self.queries[name])
+        return statement
+
+    async def _run_named(self, method: str, name: str, args: tuple):
+        """Run a registered statement with timing, re-preparing it once if the schema changed"""
+        # Prepared statements have no execute(): fetch and return the command status instead
+        run_method = "fetch" if method == "execute" else method
+        started = time.monotonic()
+        try:
+            async with self._acquire() as conn:
+                statement = await self._prepared(conn, name)
+                try:
+                    result = await getattr(statement, run_method)(*args)
+                except asyncpg.exceptions.InvalidCachedStatementError:
+                    statement = await self._prepared(conn, name, refresh=True)
+                    result = await getattr(statement, run_method)(*args)
+                if method == "execute":
+                    result = statement.get_statusmsg()
+        except Exception:
+            self._record_query(name, time.monotonic() - started, error=True)
+            raise
+        self._record_query(name, time.monotonic() - started)
+        return result
+
+    def _record_query(self, name: str, duration: float, error: bool = False) -> None:
+        stats = self.query_stats.get(name)
+        if stats is None:
+            stats = self.query_stats[name] = {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        stats["calls"] += 1
+        stats["total_seconds"] += duration
+        if duration > stats["max_seconds"]:
+            stats["max_seconds"] = duration
+        if error:
+            stats["errors"] += 1
+
+    def get_query_stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-statement call counts and timings, slowest total first"""
+        return dict(sorted(self.query_stats.items(), key=lambda item: item[1]["total_seconds"], reverse=True))
+
+    async def execute_named(self, name: str, *args) -> str:
+        """Execute a registered statement and return its status"""
+        if not await self._ensure_pool():
+            return None
+        return await self._run_named("execute", name, args)
+
+    async def fetch_named(self, name: str, *args) -> list:
+        """Fetch multiple rows with a registered statement"""
+        if not await self._ensure_pool():
+            return []
+        return await self._run_named("fetch", name, args)
+
+    async def fetchrow_named(self, name: str, *args) -> dict:
+        """Fetch a single row with a registered statement"""
+        if not await self._ensure_pool():
+            return None
+        return await self._run_named("fetchrow", name, args)
+
+    async def fetchval_named(self, name: str, *args):
+        """Fetch a single value with a registered statement"""
+        if not await self._ensure_pool():
+            return None
+        return await self._run_named("fetchval", name, args)
+
     async def close(self) -> None:
         """Close the database connection pool"""
+        if self._warm_up_task and not self._warm_up_task.done():
+            self._warm_up_task.cancel()
+        if self._replica_monitor_task and not self._replica_monitor_task.done():
+            self._replica_monitor_task.cancel()
+        if self.replica_pool:
+            await self.replica_pool.close()
+            self.replica_pool = None
+            self.replica_url = ""
         if self.pool:
             await self.pool.close()
+            self.pool = None
+            self.database_url = ""
             logging.info("Database connection pool closed")
     
+    async def execute_schema(self, query: str) -> str:
+        """Run a CREATE/ALTER statement of a repository's init, unless schema checks are disabled"""
+        if not self.schema_checks:
+            return None
+        return await self.execute(query)
+
     async def execute(self, query: str, *args) -> str:
         """Execute a query"""
-        if not self.pool:
-            logging.error("Database connection not established")
+        if not await self._ensure_pool():
             return None
         
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             return await conn.execute(query, *args)
     
     async def fetch(self, query: str, *args) -> list:
         """Fetch multiple rows"""
-        if not self.pool:
-            logging.error("Database connection not established")
+        if not await self._ensure_pool():
             return []
         
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             return await conn.fetch(query, *args)
     
     async def fetchrow(self, query: str, *args) -> dict:
         """Fetch a single row"""
-        if not self.pool:
-            logging.error("Database connection not established")
+        if not await self._ensure_pool():
             return None
         
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             return await conn.fetchrow(query, *args)
     
     async def fetchval(self, query: str, *args):
         """Fetch a single value"""
-        if not self.pool:
-            logging.error("Database connection not established")
+        if not await self._ensure_pool():
             return None
         
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             return await conn.fetchval(query, *args)
 
+    async def copy_from_query(self, query: str, *args, output, timeout: float = None, **kwargs) -> str:
+        """
+        Stream the result of a query with COPY ... TO STDOUT into a file path, file
+        object or callback. With a timeout, it replaces both the client command timeout
+        and the server statement_timeout, which are meant for short queries.
+        """
+        if not await self._ensure_pool():
+            return None
+
+        async with self._acquire() as conn:
+            if timeout is None:
+                return await conn.copy_from_query(query, *args, output=output, **kwargs)
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+                return await conn.copy_from_query(query, *args, output=output, timeout=timeout, **kwargs)
+
+    async def iterate(self, query: str, *args, prefetch: int = 500):
+        """Stream rows through a server-side cursor without loading them all into memory"""
+        if not await self._ensure_pool():
+            return
+
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor(query, *args, prefetch=prefetch):
+                    yield record
+
 # Create a single instance to be used throughout the application
 db = Database()
\ No newline at end of file
@@ -0,0 +1,42 @@
+from collections import deque
+from typing import Deque, Set
+from metrics import metrics
+
+class UpdateDeduplicator:
+    """
+    Drops updates Telegram delivers more than once. The ids of the last
+    `window` updates are kept in a ring with a set for lookups; with
+    `update_repo` the ids are also claimed in Postgres, so an update
+    redelivered to another instance is dropped as well.
+    """
+
+    def __init__(self, window: int, update_repo=None):
+        self.window = window
+        self.update_repo = update_repo
+        self._order: Deque[int] = deque()
+        self._seen: Set[int] = set()
+
+    def _remember(self, update_id: int) -> bool:
+        """Add an id to the window; False if it is already there"""
+        if update_id in self._seen:
+            return False
+        if len(self._order) >= self.window:
+            self._seen.discard(self._order.popleft())
+        self._order.append(update_id)
+        self._seen.add(update_id)
+        return True
+
+    async def is_new(self, update_id: int) -> bool:
+        if not self._remember(update_id):
+            metrics.increment("updates_duplicate_memory")
+            return False
+        if self.update_repo and not await self.update_repo.claim_update(update_id):
+            metrics.increment("updates_duplicate_database")
+            return False
+        return True
+
+    async def update_middleware(self, handler, event, data):
+        """Outer update middleware: skip updates that were already processed"""
+        if not await self.is_new(event.update_id):
+            return None
+        return await handler(event, data)
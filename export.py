@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Export of tests joined with their students for analytics.
+
+    python export.py --output tests.csv
+    python export.py --format parquet --since 2025-01-01 --level basic --output tests.parquet
+
+Rows are streamed with COPY straight into the file, so memory use does not
+depend on the size of the export. Parquet needs the optional pyarrow package.
+Admins can run the same export from the bot with /export.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime
+from db import db
+from settings import settings
+from repository.export import ExportRepository
+
+export_repo = ExportRepository()
+
+EXPORT_FORMATS = ("csv", "parquet")
+# Bytes of CSV read per Parquet record batch
+PARQUET_BLOCK_SIZE = 16 * 1024 * 1024
+FILTER_NAMES = ("since", "until", "level", "type")
+
+def parse_filters(tokens: list) -> dict:
+    """
+    Parse `key=value` tokens (since, until, level, type) and an optional
+    format name into export arguments. Raises ValueError on bad input.
+    """
+    options = {"format": "csv", "filters": {}}
+    for token in tokens:
+        if token in EXPORT_FORMATS:
+            options["format"] = token
+            continue
+        key, separator, value = token.partition("=")
+        if not separator or key not in FILTER_NAMES or not value:
+            raise ValueError(f"Unknown export option: {token}")
+        if key in ("since", "until"):
+            options["filters"][key] = datetime.fromisoformat(value)
+        elif key == "type":
+            options["filters"]["test_type"] = value
+        else:
+            options["filters"][key] = value
+    return options
+
+def _csv_to_parquet(csv_path: str, parquet_path: str) -> None:
+    """Convert a CSV file to Parquet block by block"""
+    try:
+        import pyarrow.parquet as pq
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow")
+
+    reader = pa_csv.open_csv(csv_path, read_options=pa_csv.ReadOptions(block_size=PARQUET_BLOCK_SIZE))
+    with pq.ParquetWriter(parquet_path, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+async def export_tests(path: str, export_format: str = "csv", **filters) -> bool:
+    """Export tests into path in the given format"""
+    if export_format == "csv":
+        return await export_repo.copy_tests_csv(path, **filters)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_path = os.path.join(workdir, "tests.csv")
+        if not await export_repo.copy_tests_csv(csv_path, **filters):
+            return False
+        await asyncio.to_thread(_csv_to_parquet, csv_path, path)
+    return True
+
+def _csv_records(source):
+    """
+    Yield the raw records of a CSV file opened in binary mode. Quoted fields
+    (essays) may span lines: a record ends at a newline outside quotes, that is
+    once it holds an even number of quote characters.
+    """
+    record = b""
+    for line in source:
+        record += line
+        if record.count(b'"') % 2 == 0:
+            yield record
+            record = b""
+    if record:
+        yield record
+
+def split_csv(path: str, max_bytes: int) -> list:
+    """
+    Split a CSV file on record boundaries into parts of at most max_bytes,
+    repeating the header in every part. Returns the part paths.
+    """
+    if os.path.getsize(path) <= max_bytes:
+        return [path]
+
+    base, extension = os.path.splitext(path)
+    parts = []
+    with open(path, "rb") as source:
+        records = _csv_records(source)
+        header = next(records, b"")
+        part = None
+        for record in records:
+            if part is None or part.tell() + len(record) > max_bytes:
+                if part is not None:
+                    part.close()
+                parts.append(f"{base}.part{len(parts) + 1}{extension}")
+                part = open(parts[-1], "wb")
+                part.write(header)
+            part.write(record)
+        if part is not None:
+            part.close()
+    os.remove(path)
+    return parts
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Export tests and students to CSV or Parquet")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--output", help="Output file (default: tests.<format>)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Tests started at or after this date")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Tests started before this date")
+    parser.add_argument("--level", choices=["basic", "intermediate", "advanced"])
+    parser.add_argument("--test-type", help="For example writing_part_1")
+    parser.add_argument("--archived", action="store_true", help="Include tests moved to tests_archive")
+    args = parser.parse_args()
+
+    await db.connect(settings.DATABASE_URL_UNPOOLED, settings.DATABASE_URL_REPLICA)
+    if not db.pool:
+        return 1
+    await export_repo.init(db, settings.EXPORT_TIMEOUT)
+    output = args.output or f"tests.{args.format}"
+    try:
+        exported = await export_tests(
+            output, args.format,
+            since=args.since, until=args.until, level=args.level,
+            test_type=args.test_type, include_archived=args.archived
+        )
+    finally:
+        await db.close()
+    if not exported:
+        return 1
+    logging.info(f"Exported tests to {output}")
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main()))
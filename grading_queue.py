@@ -0,0 +1,89 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, List, Optional
+from metrics import metrics
+
+class GradingQueue:
+    """
+    Admission control for gradings. At most `concurrency` run at once; the
+    others wait and are let in earliest deadline first (ties in arrival
+    order). A waiting grading is told its position and an estimate of the
+    wait based on the duration of recent gradings.
+    """
+
+    # Assumed grading duration before any grading finished
+    DEFAULT_DURATION = 30.0
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self._waiting: List[list] = []
+        self._order = itertools.count()
+        self._durations: Deque[float] = deque(maxlen=50)
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for entry in self._waiting if not entry[2].done())
+
+    def _position(self, entry: list) -> int:
+        return 1 + sum(1 for other in self._waiting if other[:2] < entry[:2] and not other[2].done())
+
+    def estimate_wait(self, position: int) -> float:
+        """Seconds until the grading at this position starts"""
+        duration = sum(self._durations) / len(self._durations) if self._durations else self.DEFAULT_DURATION
+        return math.ceil(position / self.concurrency) * duration
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("grading_queue_depth", self.depth)
+        metrics.set_gauge("grading_running", self.running)
+
+    def _release(self) -> None:
+        """Hand the slot to the next waiting grading, or free it"""
+        while self._waiting:
+            future = heapq.heappop(self._waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, deadline: float, on_queued: Optional[Callable[[int, float], Awaitable]] = None):
+        """
+        Wait for a grading slot. deadline orders the waiting gradings (a timestamp);
+        on_queued(position, seconds) is awaited when the grading has to wait.
+        """
+        queued_at = time.monotonic()
+        if self.running < self.concurrency and not self.depth:
+            self.running += 1
+        else:
+            entry = [deadline, next(self._order), asyncio.get_running_loop().create_future()]
+            heapq.heappush(self._waiting, entry)
+            self._update_gauges()
+            try:
+                if on_queued:
+                    position = self._position(entry)
+                    await on_queued(position, self.estimate_wait(position))
+                await entry[2]
+            except asyncio.CancelledError:
+                if entry[2].done() and not entry[2].cancelled():
+                    # The slot was handed over just before the cancellation
+                    self._release()
+                else:
+                    entry[2].cancel()
+                self._update_gauges()
+                raise
+        metrics.observe("grading_queue_wait_seconds", time.monotonic() - queued_at)
+        self._update_gauges()
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._durations.append(time.monotonic() - started)
+            self._release()
+            self._update_gauges()
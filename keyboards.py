@@ -0,0 +1,117 @@
+"""
+Callback data schema and prebuilt inline keyboards.
+
+Every callback button of the bot is packed by one of the CallbackData classes
+below, with short prefixes to stay well below Telegram's 64 byte limit.
+Static keyboards are built once per language and shared between requests, so
+they must be treated as read-only. Handlers match the packed strings directly
+(see the *_BY_CALLBACK maps) instead of parsing them on every click.
+"""
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from settings import get_text, writing_parts_names, languages
+
+class MenuCallback(CallbackData, prefix="m"):
+    action: str
+
+class LanguageCallback(CallbackData, prefix="lg"):
+    language: str
+
+class LevelCallback(CallbackData, prefix="lv"):
+    level: str
+
+class PartCallback(CallbackData, prefix="wp"):
+    part: int
+
+class BroadcastCallback(CallbackData, prefix="bc"):
+    confirm: bool
+
+class HistoryCallback(CallbackData, prefix="h"):
+    # o(lder), n(ewer), f(rom) the cursor or v(iew) the test; numbers in base 36
+    action: str
+    started_at: str
+    test_id: str
+
+MENU_NAME = MenuCallback(action="name").pack()
+MENU_LANGUAGE = MenuCallback(action="lang").pack()
+MENU_LEVEL = MenuCallback(action="level").pack()
+MENU_BACK = MenuCallback(action="back").pack()
+BROADCAST_YES = BroadcastCallback(confirm=True).pack()
+BROADCAST_NO = BroadcastCallback(confirm=False).pack()
+
+LANGUAGE_NAMES = {'ru': "Русский", 'en': "English", 'fi': "Suomi", 'kz': "Қазақ"}
+LEVEL_NAMES = {'basic': "Basic", 'intermediate': "Intermediate", 'advanced': "Advanced"}
+
+LANGUAGE_BY_CALLBACK = {LanguageCallback(language=code).pack(): code for code in languages}
+LEVEL_BY_CALLBACK = {LevelCallback(level=level).pack(): level for level in LEVEL_NAMES}
+PART_BY_CALLBACK = {
+    PartCallback(part=index).pack(): test_type
+    for index, test_type in enumerate(writing_parts_names, start=1)
+}
+_CALLBACK_BY_PART = {test_type: data for data, test_type in PART_BY_CALLBACK.items()}
+
+@lru_cache(maxsize=None)
+def menu_keyboard(language: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text('change_name', language), callback_data=MENU_NAME)],
+        [InlineKeyboardButton(text=get_text('change_language', language), callback_data=MENU_LANGUAGE)],
+        [InlineKeyboardButton(text=get_text('change_level', language), callback_data=MENU_LEVEL)],
+    ])
+
+@lru_cache(maxsize=None)
+def language_keyboard(language: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *[
+            [InlineKeyboardButton(text=LANGUAGE_NAMES[code], callback_data=data)]
+            for data, code in LANGUAGE_BY_CALLBACK.items()
+        ],
+        [InlineKeyboardButton(text=get_text('back', language), callback_data=MENU_BACK)],
+    ])
+
+@lru_cache(maxsize=None)
+def level_keyboard(language: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *[
+            [InlineKeyboardButton(text=LEVEL_NAMES[level], callback_data=data)]
+            for data, level in LEVEL_BY_CALLBACK.items()
+        ],
+        [InlineKeyboardButton(text=get_text('back', language), callback_data=MENU_BACK)],
+    ])
+
+@lru_cache(maxsize=None)
+def parts_keyboard() -> InlineKeyboardMarkup:
+    # Part names are the Finnish exam names in every language
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=writing_parts_names[test_type], callback_data=_CALLBACK_BY_PART[test_type])]
+        for test_type in writing_parts_names
+    ])
+
+@lru_cache(maxsize=None)
+def broadcast_confirm_keyboard(language: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=get_text('broadcast_yes', language), callback_data=BROADCAST_YES),
+        InlineKeyboardButton(text=get_text('broadcast_no', language), callback_data=BROADCAST_NO),
+    ]])
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _base36(number: int) -> str:
+    digits = ""
+    while True:
+        number, digit = divmod(number, 36)
+        digits = BASE36[digit] + digits
+        if not number:
+            return digits
+
+def history_callback(action: str, test: dict) -> str:
+    """Pack a history action with the (started_at, id) keyset cursor of a test"""
+    micros = (test['started_at'] - EPOCH) // timedelta(microseconds=1)
+    return HistoryCallback(action=action, started_at=_base36(micros), test_id=_base36(test['id'])).pack()
+
+def unpack_history_callback(callback_data: HistoryCallback) -> tuple:
+    """Decode a history callback into (action, started_at, test id)"""
+    started_at = EPOCH + timedelta(microseconds=int(callback_data.started_at, 36))
+    return callback_data.action, started_at, int(callback_data.test_id, 36)
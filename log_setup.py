@@ -0,0 +1,135 @@
+"""
+Logging pipeline of the bot.
+
+Records are handed to a queue on the calling thread and formatted and
+written by a QueueListener thread, so the event loop never blocks on
+stderr. Before a record is queued it gets the correlation ids bound in the
+current context (update, user, test), long string arguments such as essays
+are redacted, and records logged with extra=SAMPLED are kept one in
+`sample_rate`. Messages should use lazy %-formatting, which also keeps the
+template stable for sampling.
+"""
+import json
+import logging
+import queue
+import sys
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+# Mark high-volume info events: logging.info("...", arg, extra=SAMPLED)
+SAMPLED = {"sampled": True}
+
+_correlation: ContextVar[Dict[str, int]] = ContextVar("log_correlation", default={})
+
+def bind(**ids) -> None:
+    """Add correlation ids (update_id, user_id, test_id) to the records of the current context"""
+    _correlation.set({**_correlation.get(), **ids})
+
+def redact(text: str) -> str:
+    """Replace user-written text by its length"""
+    return f"<redacted {len(text)} chars>"
+
+class ContextFilter(logging.Filter):
+    """Copy the correlation ids of the current context onto the record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation = _correlation.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep one in `rate` of the sampled records per message template; warnings and errors always pass"""
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.counts: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or record.levelno > logging.INFO:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        return count % self.rate == 0
+
+class RedactionFilter(logging.Filter):
+    """Redact string arguments longer than max_length; they are essays or prompts"""
+
+    def __init__(self, max_length: int):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                redact(arg) if isinstance(arg, str) and len(arg) > self.max_length else arg
+                for arg in record.args
+            )
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "correlation", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        correlation = getattr(record, "correlation", None)
+        if correlation:
+            line += " [" + " ".join(f"{key}={value}" for key, value in correlation.items()) + "]"
+        return line
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener thread
+        return record
+
+def setup_logging(level: str = "INFO", fmt: str = "json", sample_rate: int = 1,
+                  max_arg_length: int = 200, stream=None) -> QueueListener:
+    """Route the root logger through a queue; stop the returned listener on exit to flush it"""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    queue_handler.addFilter(RedactionFilter(max_arg_length))
+    queue_handler.addFilter(ContextFilter())
+
+    # Records do not use caller, process or thread information; skip collecting it (see "Optimization" in the logging docs)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+async def correlation_middleware(handler, event, data):
+    """Outer update middleware: bind the update and user ids for the records of this update"""
+    user = data.get("event_from_user")
+    if user:
+        bind(update_id=event.update_id, user_id=user.id)
+    else:
+        bind(update_id=event.update_id)
+    return await handler(event, data)
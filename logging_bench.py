@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Logging overhead benchmark.
+
+    python logging_bench.py                  # 20000 records per case
+    python logging_bench.py --records 100000
+
+Measures the time a log call costs the calling code (the event loop in the
+bot) with a direct StreamHandler and eager f-strings, as before, and with
+the queue pipeline of log_setup.py and lazy %-formatting, sampled or not.
+Output goes to os.devnull so only logging itself is measured.
+"""
+import argparse
+import logging
+import os
+import time
+from log_setup import SAMPLED, setup_logging
+
+ESSAY = "Hyvä ystävä, kirjoitan sinulle, koska " * 40
+
+def time_calls(records: int, log) -> float:
+    """Microseconds per call of log(i)"""
+    started = time.perf_counter()
+    for i in range(records):
+        log(i)
+    return (time.perf_counter() - started) / records * 1e6
+
+def direct_handler(stream) -> None:
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = []
+    with open(os.devnull, "w") as devnull:
+        direct_handler(devnull)
+        results.append(("direct, f-string", time_calls(
+            args.records, lambda i: logging.info(f"Updated last response for test {i}: {ESSAY[:50]}")
+        )))
+        results.append(("direct, debug filtered out", time_calls(
+            args.records, lambda i: logging.debug(f"Updated last response for test {i}")
+        )))
+
+        for fmt in ("text", "json"):
+            listener = setup_logging("INFO", fmt, sample_rate=10, stream=devnull)
+            results.append((f"queue {fmt}, lazy", time_calls(
+                args.records, lambda i: logging.info("Updated last response for test %s: %s", i, ESSAY)
+            )))
+            results.append((f"queue {fmt}, lazy, sampled 1/10", time_calls(
+                args.records, lambda i: logging.info("Updated last response for test %s", i, extra=SAMPLED)
+            )))
+            # Time until the listener wrote everything
+            started = time.perf_counter()
+            listener.stop()
+            results.append((f"queue {fmt}, listener drain (total ms)", (time.perf_counter() - started) * 1e3))
+
+    width = max(len(name) for name, _ in results)
+    print(f"{'case':<{width}}  us/call")
+    for name, value in results:
+        print(f"{name:<{width}}  {value:8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,110 @@
 import asyncio
+import contextvars
 import logging
-from settings import get_test_time_limit, get_text, writing_parts_names
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Any, Union
+import math
+import signal
+import time
+from settings import get_test_time_limit, get_text, writing_parts_names, languages
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple, Any, Union, NamedTuple
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters.command import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from settings import settings
 from db import db
+from metrics import metrics
 from repository.user import UserRepository
 from repository.invites import InviteRepository
 from repository.test import TestRepository
+from repository.stats import StatsRepository
+from repository.broadcast import BroadcastRepository
+from repository.reminder import ReminderRepository
+from repository.jobs import JobRepository
+from repository.cluster import ClusterRepository
+from repository.updates import ProcessedUpdateRepository
 from openai_service import openai_service
+from response_buffer import ResponseBuffer
+from broadcast import Broadcaster
+from keyboards import (
+    MENU_NAME, MENU_LANGUAGE, MENU_LEVEL, MENU_BACK, BROADCAST_YES, BROADCAST_NO,
+    LANGUAGE_BY_CALLBACK, LEVEL_BY_CALLBACK, PART_BY_CALLBACK, HistoryCallback,
+    menu_keyboard, language_keyboard, level_keyboard, parts_keyboard, broadcast_confirm_keyboard,
+    history_callback, unpack_history_callback,
+)
+from reminders import ReminderScheduler
+from shutdown import ShutdownCoordinator
+from cluster import Cluster
+from dedup import UpdateDeduplicator
+from throttling import Throttler, ThrottleLimit
+from grading_queue import GradingQueue
+from memory_monitor import MemoryMonitor, parse_high_water
+from log_setup import setup_logging, bind, correlation_middleware
+import export
+import hmac
+import html
+import os
+import tempfile
 import aiohttp
 from aiohttp import web
 
 user_repo = UserRepository()
 invite_repo = InviteRepository()
 test_repo = TestRepository()
+stats_repo = StatsRepository()
+broadcast_repo = BroadcastRepository()
+reminder_repo = ReminderRepository()
+job_repo = JobRepository()
+cluster_repo = ClusterRepository()
+update_repo = ProcessedUpdateRepository()
+# Coalesces the response writes of students who send their essay in several messages
+response_buffer = ResponseBuffer(test_repo, settings.RESPONSE_FLUSH_DELAY, settings.RESPONSE_FLUSH_MAX_DELAY)
+# Bounds the gradings running at once so a class finishing together waits instead of hitting rate limits
+grading_queue = GradingQueue(settings.GRADING_CONCURRENCY)
+broadcaster = Broadcaster(broadcast_repo, settings.BROADCAST_RATE, settings.BROADCAST_BATCH_SIZE)
+reminder_scheduler = ReminderScheduler(
+    reminder_repo, user_repo, settings.REMINDER_DAYS, settings.REMINDER_INTERVAL, settings.REMINDER_BATCH_SIZE
+)
+cluster = Cluster(
+    cluster_repo, settings.CLUSTER_MODE, settings.CLUSTER_HEARTBEAT_INTERVAL,
+    settings.CLUSTER_INSTANCE_TTL, settings.CLUSTER_LEASE_TTL
+)
 # Initialize storage
 storage = MemoryStorage()
 
 # Initialize dispatcher
 dp = Dispatcher(storage=storage)
 
+# Drops updates once shutdown started and lets it wait for running handlers
+shutdown = ShutdownCoordinator()
+dp.update.outer_middleware(shutdown.update_middleware)
+# Drops redelivered updates before any handler runs
+deduplicator = UpdateDeduplicator(
+    settings.UPDATE_DEDUP_WINDOW, update_repo if settings.UPDATE_DEDUP_DATABASE else None
+)
+dp.update.outer_middleware(deduplicator.update_middleware)
+# Tags the log records of an update with its update and user ids
+dp.update.outer_middleware(correlation_middleware)
+
+async def user_language(user_id: int) -> str:
+    user = await user_repo.get_user(user_id)
+    return user['language'] if user else 'ru'
+
+# Limits handlers flagged with {"throttle": name}
+throttler = Throttler({
+    "topic": ThrottleLimit(
+        settings.THROTTLE_TOPIC_USER_BURST, settings.THROTTLE_TOPIC_USER_PER_MINUTE,
+        settings.THROTTLE_TOPIC_GLOBAL_BURST, settings.THROTTLE_TOPIC_GLOBAL_PER_MINUTE,
+    ),
+    "command": ThrottleLimit(settings.THROTTLE_COMMAND_USER_BURST, settings.THROTTLE_COMMAND_USER_PER_MINUTE),
+}, user_language)
+dp.message.middleware(throttler)
+dp.callback_query.middleware(throttler)
+
 # State group for invite code creation
 class InviteCodeStates(StatesGroup):
     waiting_for_uses = State()
@@ -38,6 +114,11 @@ class RegistrationStates(StatesGroup):
     waiting_for_invite_code = State()
     waiting_for_name = State()
 
+# State group for broadcasts
+class BroadcastStates(StatesGroup):
+    waiting_for_text = State()
+    waiting_for_confirmation = State()
+
 # State group for test responses
 class TestStates(StatesGroup):
     waiting_for_response = State()
@@ -47,8 +128,38 @@ bot_instance = None
 # Global dispatcher instance for state management
 dp_instance = None
 
-# Dictionary to store scheduled tasks
+class ScheduledJob(NamedTuple):
+    """A timer of a test: a warning ("5min", "1min") or its "completion" """
+    test_id: int
+    kind: str
+    user_id: int
+    run_at: datetime
+
+# Dictionary to store scheduled tasks, and the jobs they run by the same key
 scheduled_tasks = {}
+scheduled_jobs: Dict[str, ScheduledJob] = {}
+
+WARNING_MINUTES = {"5min": 5, "1min": 1}
+# A timer's test started less than this before the timer's run time; bounds the partitions read
+TIMER_LOOKBACK = timedelta(days=1)
+
+def prune_fsm_storage() -> int:
+    """Drop empty FSM records; MemoryStorage creates one for every user that sends anything"""
+    empty = [key for key, record in storage.storage.items() if record.state is None and not record.data]
+    for key in empty:
+        del storage.storage[key]
+    return len(empty)
+
+memory_monitor = MemoryMonitor(parse_high_water(settings.MEMORY_HIGH_WATER), settings.TRACEMALLOC_FRAMES)
+memory_monitor.register("scheduled_tasks", lambda: len(scheduled_tasks))
+memory_monitor.register("scheduled_jobs", lambda: len(scheduled_jobs))
+memory_monitor.register("fsm_states", lambda: len(storage.storage))
+memory_monitor.register("response_buffer", lambda: len(response_buffer.pending))
+memory_monitor.register("update_window", lambda: len(deduplicator._seen))
+memory_monitor.register("throttle_buckets", lambda: len(throttler.user_buckets))
+memory_monitor.register("grading_queue", lambda: grading_queue.depth)
+memory_monitor.register("broadcasts", lambda: len(broadcaster.tasks))
+memory_monitor.register("in_flight_updates", lambda: len(shutdown.in_flight))
 
 @dp.message(Command("start"))
 async def command_start_handler(message: Message, state: FSMContext) -> None:
@@ -97,15 +208,26 @@ async def handle_invite_code_input(message: Message, state: FSMContext) -> None:
         await message.answer(get_text('registration_cancelled', 'ru'))
         return
     
-    # Check if invite code is valid
-    valid_invite = await invite_repo.is_valid_invite(invite_code)
-    if valid_invite:
-        await invite_repo.use_invite(invite_code)
-        await user_repo.update_user(
-            message.from_user.id,
-            invited=True,
-            invited_by=valid_invite['created_by']
-        )
+    # Check and redeem the invite code in one transaction
+    registered = False
+    try:
+        async with db.transaction():
+            valid_invite = await invite_repo.is_valid_invite(invite_code)
+            if valid_invite:
+                registered = (
+                    await invite_repo.use_invite(invite_code)
+                    and await user_repo.update_user(
+                        message.from_user.id,
+                        invited=True,
+                        invited_by=valid_invite['created_by']
+                    )
+                )
+                if not registered:
+                    raise RuntimeError(f"Failed to redeem invite code {invite_code}")
+    except RuntimeError as e:
+        logging.error(str(e))
+
+    if registered:
         await message.answer(get_text('registration_success', 'ru'))
         await state.clear()
     else:
@@ -123,53 +245,35 @@ async def command_menu_handler(message: Message) -> None:
         await message.answer(get_text('not_registered', user['language'] if user else 'ru'))
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=get_text('change_name', user['language']), callback_data="change_name")],
-        [InlineKeyboardButton(text=get_text('change_language', user['language']), callback_data="change_language")],
-        [InlineKeyboardButton(text=get_text('change_level', user['language']), callback_data="change_level")],
-    ])
-    
-    await message.answer(get_text('menu_title', user['language']), reply_markup=keyboard)
+    await message.answer(get_text('menu_title', user['language']), reply_markup=menu_keyboard(user['language']))
 
-@dp.callback_query(F.data == "change_language")
+@dp.callback_query(F.data == MENU_LANGUAGE)
 async def callback_change_language_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "change_language" data
     """
     user = await user_repo.get_user(callback.from_user.id)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Русский", callback_data="language_ru")],
-        [InlineKeyboardButton(text="English", callback_data="language_en")],
-        [InlineKeyboardButton(text="Suomi", callback_data="language_fi")],
-        [InlineKeyboardButton(text="Қазақ", callback_data="language_kz")],
-        [InlineKeyboardButton(text=get_text('back', user['language']), callback_data="back")],
-    ])
-    await callback.message.edit_text(get_text('choose_language', user['language']), reply_markup=keyboard)
+    await callback.message.edit_text(get_text('choose_language', user['language']), reply_markup=language_keyboard(user['language']))
 
-@dp.callback_query(F.data == "change_level")
+@dp.callback_query(F.data == MENU_LEVEL)
 async def callback_change_level_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "change_level" data
     """
     user = await user_repo.get_user(callback.from_user.id)
-    await callback.message.edit_text(get_text('choose_level', user['language']), reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Basic", callback_data="level_basic")],
-        [InlineKeyboardButton(text="Intermediate", callback_data="level_intermediate")],
-        [InlineKeyboardButton(text="Advanced", callback_data="level_advanced")],
-        [InlineKeyboardButton(text=get_text('back', user['language']), callback_data="back")],
-    ]))
-
-@dp.callback_query(F.data.startswith("level_"))
+    await callback.message.edit_text(get_text('choose_level', user['language']), reply_markup=level_keyboard(user['language']))
+
+@dp.callback_query(F.data.in_(LEVEL_BY_CALLBACK))
 async def callback_level_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "level_" data
     """
-    level = callback.data.split("_")[1]
+    level = LEVEL_BY_CALLBACK[callback.data]
     user = await user_repo.get_user(callback.from_user.id)
     await user_repo.update_user(callback.from_user.id, level=level)
     await callback.message.edit_text(get_text('level_changed', user['language'], level=level))
 
-@dp.callback_query(F.data == "back")
+@dp.callback_query(F.data == MENU_BACK)
 async def callback_back_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "back" data
@@ -179,20 +283,14 @@ async def callback_back_handler(callback: CallbackQuery, state: FSMContext) -> N
         await callback.message.edit_text(get_text('not_registered', user['language'] if user else 'ru'))
         return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=get_text('change_name', user['language']), callback_data="change_name")],
-        [InlineKeyboardButton(text=get_text('change_language', user['language']), callback_data="change_language")],
-        [InlineKeyboardButton(text=get_text('change_level', user['language']), callback_data="change_level")],
-    ])
-    
-    await callback.message.edit_text(get_text('menu_title', user['language']), reply_markup=keyboard)
+    await callback.message.edit_text(get_text('menu_title', user['language']), reply_markup=menu_keyboard(user['language']))
 
-@dp.callback_query(F.data.startswith("language_"))
+@dp.callback_query(F.data.in_(LANGUAGE_BY_CALLBACK))
 async def callback_language_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "language_" data
     """
-    language = callback.data.split("_")[1]
+    language = LANGUAGE_BY_CALLBACK[callback.data]
     await user_repo.update_user(callback.from_user.id, language=language)
     
     # Update the language in user's state
@@ -200,7 +298,7 @@ async def callback_language_handler(callback: CallbackQuery, state: FSMContext)
     
     await callback.message.edit_text(get_text('language_updated', language))
 
-@dp.callback_query(F.data == "change_name")
+@dp.callback_query(F.data == MENU_NAME)
 async def callback_change_name_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "change_name" data
@@ -263,7 +361,254 @@ async def handle_uses_input(message: Message, state: FSMContext) -> None:
     except ValueError:
         await message.answer("Please enter a valid number.")
 
-@dp.message(Command("test"))
+@dp.message(Command("stats"), flags={"throttle": "command"})
+async def command_stats_handler(message: Message) -> None:
+    """
+    This handler receives messages with `/stats` command. Admins can pass a user id.
+    """
+    user = await user_repo.get_user(message.from_user.id)
+    if not user or not user['invited']:
+        await message.answer(get_text('not_invited', user['language'] if user else 'ru'))
+        return
+
+    language = user['language']
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    if args and args[0].isdigit() and user['role'] == 'admin':
+        user_id = int(args[0])
+
+    (totals, parts), leaderboard = await asyncio.gather(
+        stats_repo.get_user_stats(user_id),
+        stats_repo.get_leaderboard(settings.LEADERBOARD_SIZE)
+    )
+
+    def average(row) -> str:
+        return f"{row['grade_sum'] / row['graded_attempts']:.1f}" if row['graded_attempts'] else "—"
+
+    if not totals or not totals['attempts']:
+        lines = [get_text('stats_empty', language)]
+    else:
+        lines = [get_text(
+            'stats_title', language,
+            attempts=totals['attempts'], average=average(totals),
+            best=totals['best_grade'] if totals['best_grade'] is not None else "—",
+            points=totals['points'], rank=totals['rank'],
+            streak=totals['streak'], best_streak=totals['best_streak']
+        )]
+        for part in parts:
+            lines.append(get_text(
+                'stats_part', language,
+                part=writing_parts_names.get(part['test_type'], part['test_type']),
+                attempts=part['attempts'], average=average(part),
+                best=part['best_grade'] if part['best_grade'] is not None else "—"
+            ))
+
+    if leaderboard:
+        lines.append("")
+        lines.append(get_text('leaderboard_title', language))
+        for position, row in enumerate(leaderboard, start=1):
+            lines.append(get_text(
+                'leaderboard_line', language,
+                position=position, name=html.escape(row['name'] or str(row['user_id'])), points=row['points']
+            ))
+
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("broadcast"))
+async def command_broadcast_handler(message: Message, state: FSMContext) -> None:
+    """
+    This handler receives messages with `/broadcast` command
+    """
+    user = await user_repo.get_user(message.from_user.id)
+    if not user:
+        await message.answer(get_text('not_registered', 'ru'))
+        return
+
+    if user['role'] != 'admin':
+        await message.answer(get_text('not_admin', user['language']))
+        return
+
+    await state.set_state(BroadcastStates.waiting_for_text)
+    await message.answer(get_text('broadcast_prompt', user['language']))
+
+@dp.message(BroadcastStates.waiting_for_text)
+async def handle_broadcast_text(message: Message, state: FSMContext) -> None:
+    """
+    Handle broadcast text input and ask for confirmation
+    """
+    user = await user_repo.get_user(message.from_user.id)
+    language = user['language'] if user else 'ru'
+    if message.text == "/cancel" or not message.text:
+        await state.clear()
+        await message.answer(get_text('broadcast_cancelled', language))
+        return
+
+    await state.update_data(broadcast_text=message.html_text)
+    await state.set_state(BroadcastStates.waiting_for_confirmation)
+    await message.answer(message.html_text)
+    await message.answer(get_text('broadcast_confirm', language), reply_markup=broadcast_confirm_keyboard(language))
+
+@dp.callback_query(BroadcastStates.waiting_for_confirmation, F.data.in_({BROADCAST_YES, BROADCAST_NO}))
+async def callback_broadcast_confirmation_handler(callback: CallbackQuery, state: FSMContext) -> None:
+    """
+    This handler receives the confirmation of a broadcast
+    """
+    user = await user_repo.get_user(callback.from_user.id)
+    data = await state.get_data()
+    await state.clear()
+    if not user or user['role'] != 'admin' or callback.data == BROADCAST_NO:
+        await callback.message.edit_text(get_text('broadcast_cancelled', user['language'] if user else 'ru'))
+        return
+
+    broadcast = await broadcast_repo.create_broadcast(user['id'], data['broadcast_text'])
+    if not broadcast:
+        await callback.message.edit_text(get_text('broadcast_cancelled', user['language']))
+        return
+
+    broadcaster.start(broadcast, bot_instance)
+    await callback.message.edit_text(get_text('broadcast_started', user['language']))
+
+HISTORY_ACTIONS = {"o": "older", "n": "newer", "f": "from"}
+
+def _history_date(value: datetime) -> str:
+    return f"{value:%Y-%m-%d %H:%M}"
+
+async def render_history_page(user: dict, direction: str = "first", started_at: datetime = None,
+                              test_id: int = None) -> tuple:
+    """Build the text and keyboard of one history page"""
+    language = user['language']
+    rows, has_newer, has_older = await test_repo.get_history_page(
+        user['id'], direction, started_at, test_id, settings.HISTORY_PAGE_SIZE
+    )
+    if not rows:
+        return get_text('history_empty', language), None
+
+    keyboard = [
+        [InlineKeyboardButton(
+            text=get_text(
+                'history_entry', language,
+                date=_history_date(row['started_at']),
+                part=writing_parts_names.get(row['test_type'], row['test_type']),
+                grade=row['grade'] if row['finished'] else "⏳"
+            ),
+            callback_data=history_callback("v", row)
+        )]
+        for row in rows
+    ]
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(text="⬅️", callback_data=history_callback("n", rows[0])))
+    if has_older:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=history_callback("o", rows[-1])))
+    if navigation:
+        keyboard.append(navigation)
+    return get_text('history_title', language), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def _shorten(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+@dp.message(Command("history"), flags={"throttle": "command"})
+async def command_history_handler(message: Message) -> None:
+    """
+    This handler receives messages with `/history` command
+    """
+    user = await user_repo.get_user(message.from_user.id)
+    if not user or not user['invited']:
+        await message.answer(get_text('not_invited', user['language'] if user else 'ru'))
+        return
+
+    text, keyboard = await render_history_page(user)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(HistoryCallback.filter())
+async def callback_history_handler(callback: CallbackQuery, callback_data: HistoryCallback) -> None:
+    """
+    This handler receives history navigation and entry callbacks
+    """
+    user = await user_repo.get_user(callback.from_user.id)
+    if not user:
+        await callback.answer()
+        return
+
+    try:
+        action, started_at, test_id = unpack_history_callback(callback_data)
+    except ValueError:
+        await callback.answer()
+        return
+
+    if action in HISTORY_ACTIONS:
+        text, keyboard = await render_history_page(user, HISTORY_ACTIONS[action], started_at, test_id)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+        return
+
+    # Responses and feedback are only loaded when an entry is opened
+    test = await test_repo.get_test_details(user['id'], test_id, started_at)
+    if not test:
+        await callback.answer(get_text('test_not_found_error', user['language']))
+        return
+
+    text = get_text(
+        'history_details', user['language'],
+        part=writing_parts_names.get(test['test_type'], test['test_type']),
+        level=test['test_level'],
+        date=_history_date(test['started_at']),
+        topic=html.escape(_shorten(test['topic'], 800)),
+        response=html.escape(_shorten(test['response'] or "—", 1500)),
+        grade=test['grade'] if test['finished'] else "⏳",
+        feedback=html.escape(_shorten(test['feedback'] or "—", 1500))
+    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text('back', user['language']), callback_data=history_callback("f", test))]
+    ])
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@dp.message(Command("export"), flags={"throttle": "command"})
+async def command_export_handler(message: Message) -> None:
+    """
+    This handler receives messages with `/export` command and sends tests as documents
+    """
+    user = await user_repo.get_user(message.from_user.id)
+    if not user:
+        await message.answer(get_text('not_registered', 'ru'))
+        return
+
+    if user['role'] != 'admin':
+        await message.answer(get_text('not_admin', user['language']))
+        return
+
+    try:
+        options = export.parse_filters(message.text.split()[1:])
+    except ValueError:
+        await message.answer(get_text('export_usage', user['language']))
+        return
+
+    await message.answer(get_text('export_started', user['language']))
+    max_bytes = settings.EXPORT_PART_SIZE_MB * 1024 * 1024
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, f"tests_{datetime.now():%Y%m%d_%H%M}.{options['format']}")
+        try:
+            exported = await export.export_tests(path, options['format'], **options['filters'])
+        except RuntimeError as e:
+            logging.error(f"Export failed: {e}")
+            exported = False
+        if not exported:
+            await message.answer(get_text('export_error', user['language']))
+            return
+
+        if options['format'] == 'csv':
+            parts = await asyncio.to_thread(export.split_csv, path, max_bytes)
+        elif os.path.getsize(path) <= max_bytes:
+            parts = [path]
+        else:
+            await message.answer(get_text('export_too_large', user['language']))
+            return
+
+        for part in parts:
+            await message.answer_document(FSInputFile(part))
+
+@dp.message(Command("test"), flags={"throttle": "command"})
 async def command_test_handler(message: Message, state: FSMContext) -> None:
     """
     This handler receives messages with `/test` command
@@ -274,26 +619,26 @@ async def command_test_handler(message: Message, state: FSMContext) -> None:
         await message.answer(get_text('not_invited', user['language'] if user else 'ru'))
         return
     
-    if await state.get_state() == TestStates.waiting_for_response:
+    if await in_active_test(state, message.from_user.id):
         await message.answer(get_text('already_in_test', user['language']))
         return
     
-    keyboard_buttons = []
-    for part in writing_parts_names:
-        keyboard_buttons.append([InlineKeyboardButton(text=writing_parts_names[part], callback_data=part)])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-    await message.answer(get_text('choose_part', user['language']), reply_markup=keyboard)
+    await message.answer(get_text('choose_part', user['language']), reply_markup=parts_keyboard())
 
-@dp.callback_query(F.data.startswith("writing_part_"))
+@dp.callback_query(F.data.in_(PART_BY_CALLBACK), flags={"throttle": "topic"})
 async def callback_writing_part_1_handler(callback: CallbackQuery, state: FSMContext) -> None:
     """
     This handler receives callback queries with "writing_part_1" data
     """
-    test_type = callback.data
-    logging.info(f"test_type: {test_type}")
+    test_type = PART_BY_CALLBACK[callback.data]
+    logging.info("test_type: %s", test_type)
     user = await user_repo.get_user(callback.from_user.id)
     
+    # The parts keyboard stays clickable after a test was started from it
+    if await in_active_test(state, callback.from_user.id):
+        await callback.answer(get_text('already_in_test', user['language']), show_alert=True)
+        return
+    
     # Show loading message
     await callback.message.edit_text(get_text('generating_topic', user['language'], topic=writing_parts_names[test_type]))
     
@@ -303,6 +648,7 @@ async def callback_writing_part_1_handler(callback: CallbackQuery, state: FSMCon
         
         # Create test record in database
         test_id = await test_repo.create_test(test_type, callback.from_user.id, topic, user['level'])
+        bind(test_id=test_id)
         
         if test_id:
             # Get time limit for this test type
@@ -328,48 +674,151 @@ async def callback_writing_part_1_handler(callback: CallbackQuery, state: FSMCon
         logging.error(f"Error generating test topic: {e}")
         await callback.message.edit_text(get_text('test_creation_error', user['language']))
 
+async def in_active_test(state: FSMContext, user_id: int) -> bool:
+    """
+    Whether the user is taking a test. In cluster mode tests may be completed
+    by another instance, so the state is checked against the database.
+    """
+    if await state.get_state() != TestStates.waiting_for_response:
+        return False
+    if cluster.enabled and not await test_repo.get_active_test(user_id):
+        await state.clear()
+        return False
+    return True
+
+async def run_job(job: ScheduledJob, coroutine) -> None:
+    await coroutine
+    if cluster.enabled:
+        await job_repo.complete_job(job.test_id, job.kind)
+
+def schedule_job(job: ScheduledJob, bot: Bot) -> None:
+    """Start the task of a test timer; timers that are due run immediately"""
+    delay = max(0.0, (job.run_at - datetime.now(timezone.utc)).total_seconds())
+    if job.kind == "completion":
+        if cluster.enabled:
+            # The last response may still be buffered on the polling instance
+            delay += settings.RESPONSE_FLUSH_MAX_DELAY
+        coroutine = auto_complete_test(job.test_id, job.user_id, delay, bot, job.run_at - TIMER_LOOKBACK)
+    else:
+        coroutine = send_scheduled_warning(
+            job.test_id, job.user_id, WARNING_MINUTES[job.kind], delay, bot, job.run_at - TIMER_LOOKBACK
+        )
+    key = f"{job.test_id}_{job.kind}"
+    # A fresh context, so the timer's logs do not carry the update id of the handler that scheduled it
+    task = scheduled_tasks[key] = asyncio.create_task(run_job(job, coroutine), context=contextvars.Context())
+    scheduled_jobs[key] = job
+
+    def forget(_) -> None:
+        # Unless the timer was replaced in the meantime
+        if scheduled_tasks.get(key) is task:
+            del scheduled_tasks[key]
+            scheduled_jobs.pop(key, None)
+
+    task.add_done_callback(forget)
+
 async def schedule_test_tasks(test_id: int, user_id: int, test_type: str, bot: Bot):
     """Schedule warning and completion tasks for a specific test."""
-    from settings import get_test_time_limit
-    
     time_limit_minutes = get_test_time_limit(test_type)
+    now = datetime.now(timezone.utc)
     
-    # Calculate delays in seconds
-    warning_5min_delay = (time_limit_minutes - 5) * 60  # 5 minutes before end
-    warning_1min_delay = (time_limit_minutes - 1) * 60  # 1 minute before end
-    completion_delay = time_limit_minutes * 60           # At the end
-    
-    # Schedule 5-minute warning
-    if warning_5min_delay > 0:
-        task_5min = asyncio.create_task(
-            send_scheduled_warning(test_id, user_id, 5, warning_5min_delay, bot)
-        )
-        scheduled_tasks[f"{test_id}_5min"] = task_5min
-    
-    # Schedule 1-minute warning
-    if warning_1min_delay > 0:
-        task_1min = asyncio.create_task(
-            send_scheduled_warning(test_id, user_id, 1, warning_1min_delay, bot)
-        )
-        scheduled_tasks[f"{test_id}_1min"] = task_1min
-    
+    # 5 and 1 minutes before the end, unless the test is shorter
+    jobs = [
+        ScheduledJob(test_id, kind, user_id, now + timedelta(minutes=time_limit_minutes - minutes_left))
+        for kind, minutes_left in WARNING_MINUTES.items()
+        if time_limit_minutes > minutes_left
+    ]
     # Schedule test completion
-    task_completion = asyncio.create_task(
-        auto_complete_test(test_id, user_id, completion_delay, bot)
-    )
-    scheduled_tasks[f"{test_id}_completion"] = task_completion
+    jobs.append(ScheduledJob(test_id, "completion", user_id, now + timedelta(minutes=time_limit_minutes)))
+
+    if cluster.enabled:
+        # Run by whichever instance owns the shard of the test when they are due
+        await job_repo.save_jobs(jobs)
+    else:
+        for job in jobs:
+            schedule_job(job, bot)
     
-    logging.info(f"Scheduled tasks for test {test_id}: 5min warning at {warning_5min_delay}s, 1min warning at {warning_1min_delay}s, completion at {completion_delay}s")
+    logging.info("Scheduled tasks for test %s: time limit %s minutes", test_id, time_limit_minutes)
+
+async def restore_test_state(test_id: int, user_id: int, bot: Bot) -> None:
+    """Put a student of a running test back into the response state"""
+    state = dp.fsm.get_context(bot=bot, chat_id=user_id, user_id=user_id)
+    await state.set_state(TestStates.waiting_for_response)
+    await state.update_data(current_test_id=test_id, warnings_sent=[])
+
+async def restore_scheduled_jobs(bot: Bot) -> int:
+    """
+    Reschedule the timers persisted by the previous process. Warnings that are
+    already late are dropped; students of running tests get their state back.
+    """
+    now = datetime.now(timezone.utc)
+    restored = 0
+    for row in await job_repo.take_jobs():
+        job = ScheduledJob(row['test_id'], row['kind'], row['user_id'], row['run_at'])
+        if job.kind != "completion" and job.run_at < now:
+            continue
+        if job.kind == "completion" and job.run_at > now:
+            await restore_test_state(job.test_id, job.user_id, bot)
+        schedule_job(job, bot)
+        restored += 1
+    if restored:
+        logging.info(f"Restored {restored} scheduled jobs")
+    return restored
+
+async def run_claimed_jobs(bot: Bot) -> None:
+    """
+    Cluster mode: claim the timers of this instance's shard shortly before
+    they are due, and those of instances that stopped. Late warnings are dropped.
+    """
+    while True:
+        try:
+            late = datetime.now(timezone.utc) - timedelta(seconds=settings.JOB_LOOKAHEAD)
+            rows = await job_repo.claim_due_jobs(
+                cluster.instance_id, cluster.shard_index, cluster.shard_count,
+                settings.JOB_LOOKAHEAD, settings.JOB_CLAIM_SECONDS, settings.CLUSTER_INSTANCE_TTL
+            )
+            for row in rows:
+                job = ScheduledJob(row['test_id'], row['kind'], row['user_id'], row['run_at'])
+                if f"{job.test_id}_{job.kind}" in scheduled_tasks:
+                    continue
+                if job.kind != "completion" and job.run_at < late:
+                    await job_repo.complete_job(job.test_id, job.kind)
+                    continue
+                schedule_job(job, bot)
+        except Exception as e:
+            logging.error(f"Failed to run claimed jobs: {e}")
+        await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+
+async def graceful_shutdown(bot: Bot) -> None:
+    """
+    Wait a bounded time for running handlers, gradings and warnings, then
+    persist the timers that did not run for the next process.
+    """
+    now = datetime.now(timezone.utc)
+    # Timers past their sleep are running; the rest are only waiting
+    running = {task for key, task in scheduled_tasks.items() if scheduled_jobs[key].run_at <= now}
+    await shutdown.drain(running, settings.SHUTDOWN_TIMEOUT)
+
+    remaining = [scheduled_jobs[key] for key, task in scheduled_tasks.items() if not task.done()]
+    for task in list(scheduled_tasks.values()):
+        task.cancel()
+    if cluster.enabled:
+        # The jobs are still in the table; other instances take them over
+        await job_repo.release_jobs(cluster.instance_id)
+        return
+    if await job_repo.save_jobs(remaining):
+        logging.info(f"Persisted {len(remaining)} scheduled jobs")
 
-async def send_scheduled_warning(test_id: int, user_id: int, minutes_left: int, delay: float, bot: Bot):
+async def send_scheduled_warning(test_id: int, user_id: int, minutes_left: int, delay: float, bot: Bot,
+                                 started_after: datetime = None):
     """Send a scheduled warning message to the user."""
+    bind(test_id=test_id, user_id=user_id)
     try:
         await asyncio.sleep(delay)
         
         # Check if test is still active
-        test = await test_repo.get_test(test_id)
+        test = await test_repo.get_test(test_id, started_after)
         if not test or test['finished']:
-            logging.info(f"Test {test_id} already finished, skipping {minutes_left}-minute warning")
+            logging.info("Test %s already finished, skipping %s-minute warning", test_id, minutes_left)
             return
         
         user = await user_repo.get_user(user_id)
@@ -382,7 +831,7 @@ async def send_scheduled_warning(test_id: int, user_id: int, minutes_left: int,
         message = warning_messages.get(minutes_left, get_text('warning_generic', user['language'], minutes=minutes_left))
         
         await bot.send_message(user_id, message)
-        logging.info(f"Sent scheduled {minutes_left}-minute warning to user {user_id} for test {test_id}")
+        logging.info("Sent scheduled %s-minute warning to user %s for test %s", minutes_left, user_id, test_id)
         
     except Exception as e:
         logging.error(f"Failed to send scheduled warning: {e}")
@@ -397,98 +846,106 @@ async def clear_user_state_via_dispatcher(user_id: int, bot: Bot):
                 user_id=user_id,
             )
             await state.clear()
-            logging.info(f"Cleared state for user {user_id} via dispatcher")
+            logging.info("Cleared state for user %s via dispatcher", user_id)
         else:
             logging.warning(f"Could not clear state for user {user_id} - dispatcher not available")
     except Exception as e:
         logging.error(f"Failed to clear user state via dispatcher: {e}")
 
-async def auto_complete_test(test_id: int, user_id: int, delay: float, bot: Bot):
+async def auto_complete_test(test_id: int, user_id: int, delay: float, bot: Bot, started_after: datetime = None):
     """Automatically complete a test after the specified delay."""
+    bind(test_id=test_id, user_id=user_id)
     try:
         await asyncio.sleep(delay)
         
+        # Make sure the latest buffered response is in the database
+        flushed = await response_buffer.flush(test_id)
+        if not flushed:
+            await asyncio.sleep(1)
+            flushed = await response_buffer.flush(test_id)
+        # Otherwise the buffered response is graded and stored when the test is finished
+        buffered_response = None if flushed else response_buffer.pending.get(test_id)
+        
         # Check if test is still active
-        test = await test_repo.get_test(test_id)
+        test, user = await db.gather(test_repo.get_test(test_id, started_after), user_repo.get_user(user_id))
         if not test or test['finished']:
-            logging.info(f"Test {test_id} already finished, skipping auto-completion")
+            logging.info("Test %s already finished, skipping auto-completion", test_id)
             return
         
-        user = await user_repo.get_user(user_id)
-        
         # Get the last response from the database
-        last_response = test.get('response')
+        last_response = buffered_response or test.get('response')
         
         if last_response:
-            prompt = (
-                f"I have this text: \"{test['response']}\". "
-                f"The writing task is: {writing_parts_names[test['test_type']]}. "
-                f"The topic is: \"{test['topic']}\". "
-                "Give only a single numerical grade (0–6) according to the official YKI grading scale. "
-                "Do not explain, comment, or add any extra text. Be strict and follow all YKI criteria. "
-                "If the text is off-topic, give a score of 0."
-            )
+            async def notify_queued(position: int, seconds: float) -> None:
+                try:
+                    await bot.send_message(user_id, get_text(
+                        'grading_queued', user['language'], position=position, minutes=max(1, math.ceil(seconds / 60))
+                    ))
+                except Exception as e:
+                    logging.error(f"Failed to send grading queue position: {e}")
 
-            grade, reason_code = await openai_service.get_numeric_grade(user['language'], prompt, test['test_level'], test['topic'])
+            # Tests that timed out first are graded first
+            deadline = (test['started_at'] + timedelta(minutes=get_test_time_limit(test['test_type']))).timestamp()
+            async with grading_queue.slot(deadline, notify_queued):
+                grade, reason_code, confidence = await openai_service.get_numeric_grade(user['language'], last_response, test['test_level'], test['topic'])
 
-            if reason_code:
-                reason_message = get_text(f'grade_reason_{reason_code}', user['language'])
-                grade_zero_message = get_text('grade_zero_message', user['language'], reason=reason_message)
-                await bot.send_message(user_id, grade_zero_message)
-                return
-            else:
-                await bot.send_message(
-                    user_id, 
-                    get_text('grade_title', user['language'], grade=grade), 
-                )
-                feedback_prompt = (
-                        f"YKI examiner give this response a grade {grade}: {test['response']} "
-                        f"Your response should be in {user['language']} language. Students's name is {user['name']}."
-                        "Your response should be according to the following format: "
-                        """Hi [student's name]!
-                            Well done: your text included an opening and closing greeting, the conditional mood, and passive voice in the pluperfect tense—very nice! You also described the situation, explained what had happened, and why you wanted compensation.
-                            First, let’s look at the mistakes:
-                            matkuston (?) - do you mean “matka” (trip)? In that case you should also use the –sta ending, i.e. “matkasta” (write + mistä).
-                            mutta jos - did you mean “mutta kun”?
-                            sapuimme - should be saavuimme.
-                            hytti oli pieni ja ei siisti – say “hytti oli pieni eikä ollut siisti” (“eikä” = “and not” rather than “ja + ei”).
-                            pysyä - do you mean pyytää (to ask)?
-                            reisusta - correct is reissusta.
-                            jos tarvitse - use “jos tarvitsette” or, more politely, “jos tarvitsisitte”.
-                            meillä on ruvia (?) - I’m not sure what you meant here.
-                            Helsingista - correct is Helsingistä.
-                            Topics for review (if the error occurs several times, move it into the “review” section):
-                            1.…
-                            2.… (No more than two items.)
-                            Structures you could improve to raise your level (up to five):
-                            1. …
-                            2. …
-                            3. …
-                            4. …
-                            5. …   """
-                                            )
-                response = await openai_service.get_response(user['language'], feedback_prompt, test['test_level'], test['topic'], tokens=1000)
-                await bot.send_message(user_id, str(response))
+                if reason_code == "error_occurred":
+                    # Grading itself failed; finish the test without a grade instead of a 0
+                    messages = [get_text('grading_failed', user['language'])]
+                    grade, confidence, feedback = None, None, None
+                elif reason_code:
+                    reason_message = get_text(f'grade_reason_{reason_code}', user['language'])
+                    messages = [get_text('grade_zero_message', user['language'], reason=reason_message)]
+                    # A rejected response counts as graded with 0
+                    grade, feedback = 0, None
+                else:
+                    feedback = str(await openai_service.get_feedback(
+                        languages.get(user['language'], user['language']), last_response, grade,
+                        user['name'], test['test_level'], test['topic'], tokens=1000
+                    ))
+                    messages = [get_text('grade_title', user['language'], grade=grade), feedback]
 
             
-            # User provided a response, finish the test with it
-            await test_repo.db.execute("""
-                UPDATE tests 
-                SET finished = TRUE, 
-                    finished_at = NOW(),
-                    grade = $2
-                WHERE id = $1
-            """, test_id, grade)
+            # User provided a response, finish the test with it and update the statistics,
+            # unless it was finished or cancelled elsewhere while it was being graded
+            async with db.transaction():
+                finished = await test_repo.db.fetchval("""
+                    UPDATE tests 
+                    SET finished = TRUE, 
+                        finished_at = NOW(),
+                        grade = $2,
+                        grade_confidence = $3,
+                        feedback = $4,
+                        response = $5
+                    WHERE id = $1 AND finished = FALSE
+                    RETURNING id
+                """, test_id, grade, confidence, feedback, last_response)
+                if finished:
+                    await stats_repo.record_completion(user_id, test['test_type'], grade)
+            response_buffer.discard(test_id)
+            if not finished:
+                logging.info("Test %s was finished while grading, dropping the grade", test_id)
+                return
+
+            for text in messages:
+                await bot.send_message(user_id, text)
            
         else:
             # No response provided, mark as auto-finished
-            await test_repo.db.execute("""
-                UPDATE tests 
-                SET finished = TRUE, 
-                    finished_at = NOW(),
-                    response = 'AUTO_FINISHED: Time limit exceeded'
-                WHERE id = $1
-            """, test_id)
+            async with db.transaction():
+                finished = await test_repo.db.fetchval("""
+                    UPDATE tests 
+                    SET finished = TRUE, 
+                        finished_at = NOW(),
+                        response = 'AUTO_FINISHED: Time limit exceeded'
+                    WHERE id = $1 AND finished = FALSE
+                    RETURNING id
+                """, test_id)
+                if finished:
+                    await stats_repo.record_completion(user_id, test['test_type'])
+            if not finished:
+                logging.info("Test %s already finished, skipping auto-completion", test_id)
+                return
             
             # Send completion message
             await bot.send_message(user_id, get_text('no_response_provided', user['language']))
@@ -496,12 +953,12 @@ async def auto_complete_test(test_id: int, user_id: int, delay: float, bot: Bot)
         # Clear user's state using dispatcher
         await clear_user_state_via_dispatcher(user_id, bot)
         
-        logging.info(f"Auto-completed test {test_id} for user {user_id}")
+        logging.info("Auto-completed test %s for user %s", test_id, user_id)
         
     except Exception as e:
         logging.error(f"Failed to auto-complete test: {e}")
 
-def cancel_scheduled_tasks(test_id: int):
+async def cancel_scheduled_tasks(test_id: int):
     """Cancel all scheduled tasks for a specific test."""
     task_keys = [f"{test_id}_5min", f"{test_id}_1min", f"{test_id}_completion"]
     
@@ -511,8 +968,11 @@ def cancel_scheduled_tasks(test_id: int):
             if not task.done():
                 task.cancel()
             del scheduled_tasks[key]
+        scheduled_jobs.pop(key, None)
+    if cluster.enabled:
+        await job_repo.delete_test_jobs(test_id)
     
-    logging.info(f"Cancelled scheduled tasks for test {test_id}")
+    logging.info("Cancelled scheduled tasks for test %s", test_id)
 
 @dp.message(TestStates.waiting_for_response)
 async def handle_test_response(message: Message, state: FSMContext) -> None:
@@ -527,8 +987,11 @@ async def handle_test_response(message: Message, state: FSMContext) -> None:
         test_id = data.get('current_test_id')
         
         if test_id:
-            await test_repo.cancel_active_test(message.from_user.id)
-            cancel_scheduled_tasks(test_id)
+            response_buffer.discard(test_id)
+            async with db.transaction():
+                cancelled = await test_repo.cancel_active_test(message.from_user.id)
+                await stats_repo.record_completions(cancelled)
+            await cancel_scheduled_tasks(test_id)
         
         await message.answer(get_text('test_cancelled', user['language']))
         await state.clear()
@@ -537,16 +1000,16 @@ async def handle_test_response(message: Message, state: FSMContext) -> None:
     # Get test data from state
     data = await state.get_data()
     test_id = data.get('current_test_id')
+    bind(test_id=test_id)
     
-    if not test_id:
+    if not test_id or not await in_active_test(state, message.from_user.id):
         await message.answer(get_text('test_not_found', user['language']))
         await state.clear()
         return
 
     
-    # Store the latest response in state and database
-    await state.update_data(last_response=message.text)
-    await test_repo.update_last_response(test_id, message.text)
+    # Store the latest response; it is written to the database in batches
+    response_buffer.put(test_id, message.text)
     
     # Show confirmation but don't finish the test yet
     await message.answer(get_text('response_saved', user['language']))
@@ -557,49 +1020,209 @@ async def handle_unknown_message(message: Message) -> None:
     user = await user_repo.get_user(message.from_user.id)
     await message.answer(get_text('unknown_message', user['language'] if user else 'ru'))
 
+async def run_maintenance() -> None:
+    """
+    Keep tests partitions ahead, cancel tests whose timers were lost and archive
+    old tests. In cluster mode the lease makes it run on one instance per interval.
+    """
+    while True:
+        if not await cluster.hold_lease("maintenance", settings.MAINTENANCE_INTERVAL):
+            await asyncio.sleep(settings.MAINTENANCE_INTERVAL)
+            continue
+        try:
+            if await test_repo.is_partitioned():
+                await test_repo.ensure_partitions()
+            async with db.transaction():
+                running = [job.test_id for job in scheduled_jobs.values() if job.kind == "completion"]
+                expired = await test_repo.check_and_cancel_expired_tests(running)
+                await stats_repo.record_completions(expired)
+            older_than = datetime.now(timezone.utc) - timedelta(days=settings.TESTS_ARCHIVE_AFTER_DAYS)
+            await test_repo.archive_finished_tests(older_than, settings.TESTS_ARCHIVE_BATCH_SIZE)
+            if settings.UPDATE_DEDUP_DATABASE:
+                await update_repo.prune(datetime.now(timezone.utc) - timedelta(hours=settings.UPDATE_DEDUP_HOURS))
+        except Exception as e:
+            logging.error(f"Maintenance run failed: {e}")
+        await asyncio.sleep(settings.MAINTENANCE_INTERVAL)
+
+async def init_repositories() -> None:
+    """Create or check the tables; repositories without dependencies on each other run together"""
+    # Every table references tg_user
+    await user_repo.init(db)
+    await asyncio.gather(
+        invite_repo.init(db),
+        test_repo.init(db),
+        broadcast_repo.init(db),
+        cluster_repo.init(db),
+        update_repo.init(db),
+    )
+    # These read or reference tests
+    await asyncio.gather(
+        stats_repo.init(db, settings.LEADERBOARD_CACHE_SECONDS),
+        reminder_repo.init(db),
+        job_repo.init(db),
+        export.export_repo.init(db, settings.EXPORT_TIMEOUT),
+    )
+
 async def main() -> None:
     global bot_instance, dp_instance
-    
-    # Initialize Bot instance with default bot properties which will be passed to all API calls
-    bot_instance = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    # Connect to the database
-    await db.connect(settings.DATABASE_URL_UNPOOLED)
-    # Initialize tables
-    await user_repo.init(db)
-    await invite_repo.init(db)
-    await test_repo.init(db)
+    started = time.monotonic()
+    phase_started = started
 
-    # Set global dispatcher instance
-    dp_instance = dp
+    def startup_phase(name: str) -> None:
+        """Record how long a startup phase took, exported as startup_<name>_seconds"""
+        nonlocal phase_started
+        now = time.monotonic()
+        metrics.set_gauge(f"startup_{name}_seconds", round(now - phase_started, 3))
+        phase_started = now
+
+    # Set until the bot is about to poll; /ready returns 503 before that
+    ready = asyncio.Event()
 
     # Create web app for health checks
     app = web.Application()
     
-    # Health check endpoint
+    # Health check endpoint (liveness: the process is up)
     async def health_check(request):
         return web.Response(text="OK", status=200)
+
+    # Readiness: the database is initialized and the bot is polling
+    async def readiness_check(request):
+        if ready.is_set():
+            return web.Response(text="READY", status=200)
+        return web.Response(text="STARTING", status=503)
+    
+    # Metrics endpoint for monitoring
+    async def metrics_handler(request):
+        snapshot = metrics.snapshot()
+        snapshot["database"] = {"pool": db.get_pool_stats(), "queries": db.get_query_stats()}
+        return web.json_response(snapshot)
     
+    # Memory diagnostics for admins: ?action=top|snapshot|diff|stop&limit=20&group_by=lineno|filename|traceback
+    async def memory_handler(request):
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not settings.ADMIN_TOKEN or not hmac.compare_digest(token, settings.ADMIN_TOKEN):
+            return web.Response(text="Forbidden", status=403)
+        action = request.query.get("action", "top")
+        group_by = request.query.get("group_by", "lineno")
+        if group_by not in ("lineno", "filename", "traceback"):
+            return web.Response(text="Unknown group_by", status=400)
+        try:
+            limit = int(request.query.get("limit", "20"))
+        except ValueError:
+            return web.Response(text="Invalid limit", status=400)
+
+        result = {}
+        if action == "top":
+            result["top"] = await asyncio.to_thread(memory_monitor.top, limit, group_by)
+        elif action == "snapshot":
+            await asyncio.to_thread(memory_monitor.take_baseline)
+        elif action == "diff":
+            result["diff"] = await asyncio.to_thread(memory_monitor.diff, limit, group_by)
+        elif action == "stop":
+            memory_monitor.stop()
+        else:
+            return web.Response(text="Unknown action", status=400)
+        result["tracemalloc"] = memory_monitor.traced_memory()
+        result["registries"] = memory_monitor.check()
+        return web.json_response(result)
+
     app.router.add_get('/health', health_check)
     app.router.add_get('/', health_check)  # Root endpoint also returns health status
+    app.router.add_get('/ready', readiness_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/debug/memory', memory_handler)
     
     # Create runner for web app
     runner = web.AppRunner(app)
     await runner.setup()
     
-    # Start web server on port 8080
+    # Start web server on port 8080 first, so the platform sees the process while it starts
     site = web.TCPSite(runner, '0.0.0.0', 8080)
     await site.start()
     
     logging.info("Health check server started on port 8080")
-    
+    startup_phase("health_server")
+
+    # Initialize Bot instance with default bot properties which will be passed to all API calls
+    bot_instance = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Connect to the database
+    await db.connect(settings.DATABASE_URL_UNPOOLED, settings.DATABASE_URL_REPLICA)
+    startup_phase("database")
+    # Initialize tables
+    db.schema_checks = settings.SCHEMA_CHECKS
+    await init_repositories()
+    startup_phase("schema")
+
+    # Set global dispatcher instance
+    dp_instance = dp
+
+    background_tasks = [
+        asyncio.create_task(memory_monitor.run(settings.MEMORY_CHECK_INTERVAL, prune_fsm_storage)),
+    ]
+    if cluster.enabled:
+        await cluster.heartbeat()
+        background_tasks.append(asyncio.create_task(cluster.run_heartbeat()))
+        background_tasks.append(asyncio.create_task(run_claimed_jobs(bot_instance)))
+    else:
+        await restore_scheduled_jobs(bot_instance)
+        await broadcaster.resume(bot_instance)
+    # After the timers are restored, so the expiry sweep leaves their tests to them
+    background_tasks.append(asyncio.create_task(run_maintenance()))
+    if settings.REMINDER_DAYS > 0:
+        reminders_due = lambda: cluster.hold_lease("reminders", settings.REMINDER_INTERVAL)
+        background_tasks.append(asyncio.create_task(reminder_scheduler.run(bot_instance, reminders_due)))
+
+    async def on_startup() -> None:
+        ready.set()
+        metrics.set_gauge("startup_seconds", round(time.monotonic() - started, 3))
+        logging.info(f"Bot ready in {time.monotonic() - started:.2f}s")
+
+    def cancel_broadcasts() -> None:
+        # Broadcasts save their progress after every batch and resume on start
+        for task in list(broadcaster.tasks.values()):
+            task.cancel()
+
+    async def on_leader() -> None:
+        # Students of running tests answer to the polling instance
+        for row in await job_repo.get_pending_completions():
+            await restore_test_state(row['test_id'], row['user_id'], bot_instance)
+        await broadcaster.resume(bot_instance)
+
+    async def on_follower() -> None:
+        cancel_broadcasts()
+
     try:
-        # Start both the bot and keep the web server running
-        await dp.start_polling(bot_instance)
+        if cluster.enabled:
+            # Followers are ready too: they run timers and take over polling
+            await on_startup()
+            loop = asyncio.get_running_loop()
+            for signal_number in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signal_number, cluster.stop)
+            await cluster.run_polling(dp, bot_instance, on_leader, on_follower)
+        else:
+            dp.startup.register(on_startup)
+            # Start both the bot and keep the web server running. Polling stops on
+            # SIGTERM/SIGINT; the session stays open for the sends of the drain below.
+            await dp.start_polling(bot_instance, close_bot_session=False)
     finally:
+        ready.clear()
+        for task in background_tasks:
+            task.cancel()
+        cancel_broadcasts()
+        await graceful_shutdown(bot_instance)
+        await response_buffer.flush()
+        await cluster.leave()
+        await db.close()
+        await bot_instance.session.close()
         await runner.cleanup()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    listener = setup_logging(
+        settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_SAMPLE_RATE, settings.LOG_MAX_ARG_LENGTH
+    )
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Maintenance of the tests table.
+
+    python maintenance.py partition-tests   # migrate an unpartitioned tests table (locks it)
+    python maintenance.py partitions        # create monthly partitions ahead of time
+    python maintenance.py sweep             # cancel tests that are past their time limit
+    python maintenance.py archive --days 180   # move old finished tests into tests_archive
+    python maintenance.py rebuild-stats     # recompute user_stats from tests and tests_archive
+
+The bot runs partitions, sweep and archive periodically (MAINTENANCE_INTERVAL),
+so the commands are only needed for one-off runs.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+from db import db
+from settings import settings
+from repository.user import UserRepository
+from repository.test import TestRepository
+from repository.stats import StatsRepository
+from repository.jobs import JobRepository
+
+user_repo = UserRepository()
+test_repo = TestRepository()
+stats_repo = StatsRepository()
+job_repo = JobRepository()
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Maintain the partitioned tests table")
+    parser.add_argument("command", choices=["partition-tests", "partitions", "sweep", "archive", "rebuild-stats"])
+    parser.add_argument("--days", type=int, default=settings.TESTS_ARCHIVE_AFTER_DAYS,
+                        help="With archive: archive finished tests started more than this many days ago")
+    parser.add_argument("--batch-size", type=int, default=settings.TESTS_ARCHIVE_BATCH_SIZE,
+                        help="With archive: tests moved per statement")
+    parser.add_argument("--months-ahead", type=int, default=2, help="With partitions: months to create ahead")
+    args = parser.parse_args()
+
+    await db.connect(settings.DATABASE_URL_UNPOOLED)
+    if not db.pool:
+        return 1
+    # tests references tg_user
+    await user_repo.init(db)
+    await test_repo.init(db)
+    await stats_repo.init(db)
+    # The sweep leaves tests with a persisted completion timer alone
+    await job_repo.init(db)
+    try:
+        if args.command == "partition-tests":
+            if not await test_repo.migrate_to_partitioned():
+                logging.info("Tests table is already partitioned")
+        elif args.command == "partitions":
+            if not await test_repo.is_partitioned():
+                logging.error("Tests table is not partitioned, run partition-tests first")
+                return 1
+            await test_repo.ensure_partitions(months_ahead=args.months_ahead)
+        elif args.command == "sweep":
+            async with db.transaction():
+                expired = await test_repo.check_and_cancel_expired_tests()
+                await stats_repo.record_completions(expired)
+        elif args.command == "archive":
+            older_than = datetime.now(timezone.utc) - timedelta(days=args.days)
+            await test_repo.archive_finished_tests(older_than, args.batch_size)
+        elif args.command == "rebuild-stats":
+            await stats_repo.rebuild()
+    finally:
+        await db.close()
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main()))
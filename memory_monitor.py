@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+from metrics import metrics
+
+def parse_high_water(value: str) -> Dict[str, int]:
+    """Parse "name=limit,name=limit" into a dict"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = int(limit)
+    return limits
+
+class MemoryMonitor:
+    """
+    Memory diagnostics: tracemalloc snapshots with the top allocation sites
+    and the difference to a baseline, and the sizes of long-lived in-memory
+    registries, exported as gauges with a warning when one exceeds its
+    high-water mark.
+    """
+
+    def __init__(self, high_water: Dict[str, int], frames: int = 1):
+        self.high_water = high_water
+        self.frames = frames
+        self.registries: Dict[str, Callable[[], int]] = {}
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self._above = set()
+
+    def register(self, name: str, size: Callable[[], int]) -> None:
+        self.registries[name] = size
+
+    def check(self) -> Dict[str, int]:
+        """Measure the registries and warn once each time one crosses its high-water mark"""
+        sizes = {}
+        for name, size in self.registries.items():
+            sizes[name] = value = size()
+            metrics.set_gauge(f"registry_{name}", value)
+            limit = self.high_water.get(name)
+            if limit is not None and value > limit:
+                if name not in self._above:
+                    self._above.add(name)
+                    metrics.increment("registry_high_water_alarms")
+                    logging.warning(f"Registry {name} holds {value} entries, above its high-water mark of {limit}")
+            else:
+                self._above.discard(name)
+        return sizes
+
+    async def run(self, interval: float, cleanup: Callable[[], int] = None) -> None:
+        while True:
+            try:
+                if cleanup:
+                    cleanup()
+                self.check()
+            except Exception as e:
+                logging.error(f"Memory check failed: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.baseline = None
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        self.start()
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def take_baseline(self) -> None:
+        """Remember a snapshot to diff against; starts tracing if needed"""
+        self.baseline = self._snapshot()
+
+    def top(self, limit: int = 20, group_by: str = "lineno") -> List[dict]:
+        """Allocation sites holding the most memory"""
+        return [
+            {"site": str(stat.traceback), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+            for stat in self._snapshot().statistics(group_by)[:limit]
+        ]
+
+    def diff(self, limit: int = 20, group_by: str = "lineno") -> List[dict]:
+        """Allocation sites that grew the most since the baseline"""
+        if self.baseline is None:
+            self.take_baseline()
+            return []
+        return [
+            {
+                "site": str(stat.traceback),
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "size_kb": round(stat.size / 1024, 1),
+                "count_diff": stat.count_diff,
+            }
+            for stat in self._snapshot().compare_to(self.baseline, group_by)[:limit]
+        ]
+
+    def traced_memory(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": tracemalloc.is_tracing(), "current_kb": current // 1024, "peak_kb": peak // 1024}
@@ -0,0 +1,47 @@
+import time
+from collections import defaultdict
+from typing import Dict, Any
+
+
+class Metrics:
+    """In-process counters, gauges and timings for monitoring"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.started_at = time.time()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Increase a counter"""
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """Set the current value of a gauge"""
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a sample (usually a duration in seconds or a size)"""
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+        timing["count"] += 1
+        timing["total"] += value
+        timing["last"] = value
+        if value > timing["max"]:
+            timing["max"] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a JSON-serializable copy of all metrics"""
+        timings = {}
+        for name, timing in self.timings.items():
+            timings[name] = dict(timing, avg=timing["total"] / timing["count"] if timing["count"] else 0.0)
+        return {
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": timings,
+        }
+
+# Create a single instance to be used throughout the application
+metrics = Metrics()
@@ -1,20 +1,111 @@
-import openai
+import json
 import logging
 import re
-from settings import settings, system_message
+import statistics
+from settings import settings
+from prompts import get_template, bound_essay, bound_topic, language_sample
+from metrics import metrics
+from log_setup import SAMPLED
 
-# Configure OpenAI client
-openai.api_key = settings.OPENAI_API_KEY
+MODEL = "gpt-4o-mini"
+
+GRADE_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "provide_grade",
+            "description": "Provide only the numerical grade according to YKI grading scale (0-6)",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "grade": {
+                        "type": "integer",
+                        "description": "YKI grade from 0 to 6",
+                        "minimum": 0,
+                        "maximum": 6
+                    }
+                },
+                "required": ["grade"]
+            }
+        }
+    }
+]
 
 class OpenAIService:
     def __init__(self):
-        if settings.OPENAI_API_KEY:
-            self.client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-            self.api_available = True
-        else:
-            self.client = None
-            self.api_available = False
+        self.api_available = bool(settings.OPENAI_API_KEY)
+        self._client = None
+        self._async_client = None
+        if not self.api_available:
             logging.warning("OpenAI API key not provided. Using fallback responses.")
+
+    @property
+    def client(self):
+        """The OpenAI client, created (and the openai package imported) on first use"""
+        if self._client is None and self.api_available:
+            import openai
+            self._client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+        return self._client
+
+    @property
+    def async_client(self):
+        """The asyncio OpenAI client used by the bot, so requests do not block the event loop"""
+        if self._async_client is None and self.api_available:
+            import openai
+            self._async_client = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        return self._async_client
+
+    def build_request(self, template_name: str, variables: dict, **kwargs) -> dict:
+        """Build the chat completion request body for a registered prompt template"""
+        return {
+            "model": MODEL,
+            "messages": get_template(template_name).render(**variables),
+            **kwargs
+        }
+
+    def build_grade_request(self, task: str, essay: str, samples: int = 1) -> dict:
+        """
+        Build the request body asking for a YKI grade through the provide_grade tool.
+        With samples > 1 the model returns that many independent grades in one response.
+        """
+        options = {"n": samples} if samples > 1 else {}
+        return self.build_request(
+            "grade",
+            {"topic": bound_topic(task), "essay": bound_essay(essay)},
+            tools=GRADE_TOOLS,
+            tool_choice={"type": "function", "function": {"name": "provide_grade"}},
+            temperature=0.3,
+            max_tokens=50,
+            **options
+        )
+
+    @staticmethod
+    def parse_grade_arguments(arguments: str) -> int:
+        """Extract the grade from provide_grade tool call arguments, clamped to 0-6"""
+        grade = json.loads(arguments).get("grade", 3)
+        return max(0, min(6, int(grade)))
+
+    async def _create_completion(self, template_name: str, variables: dict, **kwargs):
+        """
+        Render a registered prompt template and request a chat completion.
+        Prompt and cached prompt token counts are recorded per template.
+        """
+        response = await self.async_client.chat.completions.create(
+            **self.build_request(template_name, variables, **kwargs)
+        )
+        self._record_usage(template_name, response)
+        return response
+
+    def _record_usage(self, template_name: str, response) -> None:
+        """Record prompt token usage, including tokens served from the provider's prompt cache"""
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        metrics.increment(f"openai_prompt_tokens_{template_name}", usage.prompt_tokens)
+        metrics.increment(f"openai_cached_tokens_{template_name}", cached_tokens)
+        metrics.increment(f"openai_completion_tokens_{template_name}", usage.completion_tokens)
     
     async def detect_language(self, text: str) -> str:
         """
@@ -24,20 +115,15 @@ class OpenAIService:
             return "unknown"
         
         try:
-            prompt = f"What language is this text written in? Respond with only the language name.\n\n{text}"
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a language detector. Respond with only the language name in English."},
-                    {"role": "user", "content": prompt}
-                ],
+            response = await self._create_completion(
+                "language",
+                {"text": language_sample(text)},
                 temperature=0,
                 max_tokens=20
             )
             
             answer = response.choices[0].message.content.strip().lower()
-            logging.info(f"Language detected: {answer} for text: {text[:50]}...")
+            logging.info("Language detected: %s for a text of %d chars", answer, len(text), extra=SAMPLED)
             return answer
             
         except Exception as e:
@@ -56,73 +142,41 @@ class OpenAIService:
         ]
         return any(indicator in language for indicator in finnish_indicators)
     
-    async def get_response(self, user_language: str, question: str, test_level: str, test_topic: str = None, tokens: int = 250) -> str:
-        """
-        Get response from OpenAI with system message and user question.
-        """
-        if not self.api_available:
-            return get_fallback_response(user_language, question)
-        
-        try:
-            system_msg = system_message
-            
-            # Build messages array
-            messages = [{"role": "system", "content": system_msg}]
-            
-            # Add test topic if provided
-            if test_topic:
-                messages.append({"role": "assistant", "content": f"test topic: {test_topic}"})
-            # Add the main question
-            messages.append({"role": "user", "content": question + "Level of YKI is " + test_level})
-
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                temperature=0.5,
-                max_tokens=tokens
-            )
-            
-            return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            logging.error(f"OpenAI API error: {e}")
-            return get_fallback_response(user_language, question)
-    
-    async def get_numeric_grade(self, user_language: str, question: str, test_level: str, test_topic: str = None) -> tuple[int, str]:
+    async def get_numeric_grade(self, user_language: str, question: str, test_level: str, test_topic: str = None) -> tuple[int, str, float]:
         """
         Get a numeric grade from OpenAI using the check_and_grade pipeline.
-        Returns (grade, reason_code) tuple. Reason_code is a translation key or empty string.
+        Returns (grade, reason_code, confidence) tuple. Reason_code is a translation key or empty string,
+        confidence is the share of grading samples that agreed with the grade (None if not graded by the model).
         """
         if not self.api_available:
-            return (3, "")  # Fallback grade, no reason
+            return (3, "", None)  # Fallback grade, no reason
         
         try:
-            # Extract the response text from the question for language detection
-
             # Clean up the response text (remove quotes, extra spaces)
             response_text = question.strip('"').strip("'").strip()
             
             # Use the check_and_grade pipeline
             if test_topic and response_text:
                 result = await self.check_and_grade(test_topic, response_text)
-                logging.info(f"result: {result}")
+                logging.info("Check and grade status: %s", result["status"])
                 if result["status"] == "rejected":
-                    logging.info(f"Text rejected: {result['reason']}")
+                    logging.info("Text rejected: %s", result['reason'])
                     if "not in Finnish" in result["reason"]:
-                        return (0, "not_finnish")
+                        return (0, "not_finnish", None)
                     elif "off-topic" in result["reason"]:
-                        return (0, "off_topic")
+                        return (0, "off_topic", None)
                     else:
-                        return (0, "rejected")
+                        return (0, "rejected", None)
                 else:
-                    return (result["evaluation"][0], "")
+                    grade, confidence = result["evaluation"]
+                    return (grade, "", confidence)
             
             # Fallback to original method if no topic provided or no response text extracted
-            return (3, "")  # Default fallback
+            return (3, "", None)  # Default fallback
             
         except Exception as e:
             logging.error(f"Error in get_numeric_grade: {e}")
-            return (0, "error_occurred")
+            return (0, "error_occurred", None)
     
     async def get_test_topic(self, user_language: str, test_type: str, test_level: str) -> str:
         """
@@ -133,8 +187,46 @@ class OpenAIService:
         if test_type not in tests:
             return "Неизвестный тип теста."
 
-        question = tests[test_type]
-        return await self.get_response(user_language, question, test_level)
+        if not self.api_available:
+            return get_fallback_response(user_language, test_type)
+
+        try:
+            response = await self._create_completion(
+                f"topic_{test_type}",
+                {"level": test_level},
+                temperature=0.5,
+                max_tokens=250
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logging.error(f"OpenAI API error: {e}")
+            return get_fallback_response(user_language, test_type)
+
+    async def get_feedback(self, user_language: str, essay: str, grade: int, name: str, test_level: str, test_topic: str, tokens: int = 1000) -> str:
+        """
+        Get written YKI feedback on the essay in the student's language.
+        """
+        if not self.api_available:
+            return get_fallback_response(user_language, "")
+
+        try:
+            response = await self._create_completion(
+                "feedback",
+                {
+                    "level": test_level,
+                    "topic": bound_topic(test_topic),
+                    "language": user_language,
+                    "name": name,
+                    "grade": grade,
+                    "essay": bound_essay(essay),
+                },
+                temperature=0.5,
+                max_tokens=tokens
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logging.error(f"OpenAI API error: {e}")
+            return get_fallback_response(user_language, "")
     
     async def check_topic_relevance(self, task: str, essay: str) -> bool:
         """
@@ -145,28 +237,9 @@ class OpenAIService:
             return True  # Assume relevant if API not available
         
         try:
-            prompt = f"""
-Tarkista, vastaako seuraava teksti annettua tehtävän aihetta.
-
-Tehtävän aihe:
-"{task}"
-
-Teksti:
-"{essay}"
-
-Arvioi relevanssi seuraavasti:
-- Jos teksti käsittelee aihetta suoraan tai sivuaa sitä merkittävästi, vastaa "kyllä"
-- Jos teksti on vain etäisesti aiheeseen liittyvä, vastaa "osittain"
-- Jos teksti ei liity aiheeseen lainkaan, vastaa "ei"
-
-Vastaa vain yhdellä sanalla: kyllä, osittain tai ei."""
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Olet kielitestien tarkistaja. Ole kohtuullinen arvioinnissa."},
-                    {"role": "user", "content": prompt}
-                ],
+            response = await self._create_completion(
+                "relevance",
+                {"task": bound_topic(task), "essay": bound_essay(essay)},
                 temperature=0
             )
             answer = response.choices[0].message.content.strip().lower()
@@ -178,56 +251,36 @@ Vastaa vain yhdellä sanalla: kyllä, osittain tai ei."""
             logging.error(f"Topic relevance check error: {e}")
             return True  # Assume relevant on error to avoid false rejections
 
-    async def get_yki_evaluation(self, task: str, essay: str) -> str:
-        tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "provide_grade",
-                        "description": "Provide only the numerical grade according to YKI grading scale (0-6)",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "grade": {
-                                    "type": "integer",
-                                    "description": "YKI grade from 0 to 6",
-                                    "minimum": 0,
-                                    "maximum": 6
-                                }
-                            },
-                            "required": ["grade"]
-                        }
-                    }
-                }
-            ]
-            
-        # Build messages array
-        messages = [{"role": "system", "content": "You are a YKI exam grader. Provide only numerical grades from 0-6 scale. No explanations, no text, just the grade number."}]
-        messages.append({"role": "assistant", "content": f"Test topic: {task}"})
-        
-        # Add the main question
-        messages.append({"role": "user", "content": essay })
-
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=tools,
-            tool_choice={"type": "function", "function": {"name": "provide_grade"}},
-            temperature=0.3,
-            max_tokens=50
-        )
-        try:
+    async def _sample_grades(self, task: str, essay: str, samples: int) -> list[int]:
+        """Request several grades for the essay in a single completion request"""
+        response = await self.async_client.chat.completions.create(**self.build_grade_request(task, essay, samples))
+        self._record_usage("grade", response)
+        grades = []
+        for choice in response.choices:
             # Extract the grade from tool call
-            if response.choices[0].message.tool_calls:
-                import json
-                tool_call = response.choices[0].message.tool_calls[0]
-                function_args = json.loads(tool_call.function.arguments)
-                grade = function_args.get("grade", 3)
-                return (max(0, min(6, grade)), "yki evaluation")
-        except Exception as e:
-            logging.error(f"Error in get_yki_evaluation: {e}")
-            return (0, f"Error: {str(e)}")
-        
+            if choice.message.tool_calls:
+                grades.append(self.parse_grade_arguments(choice.message.tool_calls[0].function.arguments))
+        return grades
+
+    async def get_yki_evaluation(self, task: str, essay: str) -> tuple[int, float]:
+        """
+        Grade the essay by consensus of several samples taken in one request.
+        Returns (grade, confidence). When the samples disagree too much, a
+        second-opinion request adds more samples before deciding.
+        """
+        grades = await self._sample_grades(task, essay, settings.GRADING_SAMPLES)
+        if not grades:
+            raise ValueError("No grade returned by the model")
+
+        grade, confidence = consensus_grade(grades)
+        if confidence < settings.GRADING_MIN_CONFIDENCE and settings.GRADING_SECOND_OPINION_SAMPLES:
+            metrics.increment("grading_second_opinions")
+            logging.info(f"Low grading confidence {confidence:.2f} for grades {grades}, requesting a second opinion")
+            grades += await self._sample_grades(task, essay, settings.GRADING_SECOND_OPINION_SAMPLES)
+            grade, confidence = consensus_grade(grades)
+
+        metrics.observe("grading_confidence", confidence)
+        return (grade, confidence)
 
     async def check_and_grade(self, task: str, essay: str) -> dict:
         """
@@ -250,6 +303,14 @@ Vastaa vain yhdellä sanalla: kyllä, osittain tai ei."""
         yki_feedback = await self.get_yki_evaluation(task, essay)
         return {"status": "accepted", "evaluation": yki_feedback}
 
+def consensus_grade(grades: list[int]) -> tuple[int, float]:
+    """
+    Combine sampled grades into the median grade and a confidence value:
+    the share of samples that agree with the median.
+    """
+    grade = statistics.median_low(grades)
+    return (grade, grades.count(grade) / len(grades))
+
 def get_fallback_response(user_language: str, question: str) -> str:
     """Provide fallback responses when OpenAI is not available."""
     if "writing_part_1" in question.lower():
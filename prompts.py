@@ -0,0 +1,210 @@
+import logging
+from dataclasses import dataclass, field
+from string import Formatter
+from typing import Dict, List, Tuple
+from settings import settings, system_message, tests
+from metrics import metrics
+
+# Average characters per token for Finnish/Cyrillic text when tiktoken is unavailable
+CHARS_PER_TOKEN = 3
+TRUNCATION_MARKER = "\n[...]\n"
+# Share of the token budget kept from the beginning of a truncated text,
+# the rest is kept from the end (greetings and closings matter for YKI grading)
+HEAD_SHARE = 0.7
+
+FEEDBACK_FORMAT = """Hi [student's name]!
+Well done: your text included an opening and closing greeting, the conditional mood, and passive voice in the pluperfect tense—very nice! You also described the situation, explained what had happened, and why you wanted compensation.
+First, let’s look at the mistakes:
+matkuston (?) - do you mean “matka” (trip)? In that case you should also use the –sta ending, i.e. “matkasta” (write + mistä).
+mutta jos - did you mean “mutta kun”?
+sapuimme - should be saavuimme.
+hytti oli pieni ja ei siisti – say “hytti oli pieni eikä ollut siisti” (“eikä” = “and not” rather than “ja + ei”).
+pysyä - do you mean pyytää (to ask)?
+reisusta - correct is reissusta.
+jos tarvitse - use “jos tarvitsette” or, more politely, “jos tarvitsisitte”.
+meillä on ruvia (?) - I’m not sure what you meant here.
+Helsingista - correct is Helsingistä.
+Topics for review (if the error occurs several times, move it into the “review” section):
+1.…
+2.… (No more than two items.)
+Structures you could improve to raise your level (up to five):
+1. …
+2. …
+3. …
+4. …
+5. …"""
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    """Load the tiktoken encoding once, or None if tiktoken is not available"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logging.info(f"tiktoken is not available, estimating token counts: {e}")
+            _encoding = None
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """Count (or estimate) the number of tokens in the text"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def truncate_to_tokens(text: str, max_tokens: int, label: str) -> str:
+    """
+    Bound the text to max_tokens, keeping its beginning and its end.
+    Truncations are counted in metrics under the label.
+    """
+    if not text:
+        return text or ""
+
+    encoding = _get_encoding()
+    tokens = encoding.encode(text, disallowed_special=()) if encoding else None
+    size = len(tokens) if tokens is not None else count_tokens(text)
+    if size <= max_tokens:
+        return text
+
+    head_size = int(max_tokens * HEAD_SHARE)
+    tail_size = max_tokens - head_size
+    if tokens is not None:
+        head = encoding.decode(tokens[:head_size])
+        tail = encoding.decode(tokens[-tail_size:]) if tail_size else ""
+    else:
+        head = text[:head_size * CHARS_PER_TOKEN]
+        tail = text[-tail_size * CHARS_PER_TOKEN:] if tail_size else ""
+
+    metrics.increment(f"prompt_truncated_{label}")
+    metrics.observe(f"prompt_truncated_{label}_tokens", size - max_tokens)
+    logging.warning(f"Truncated {label} from {size} to {max_tokens} tokens")
+    return head + TRUNCATION_MARKER + tail
+
+def bound_essay(essay: str) -> str:
+    """Bound a student's essay to the configured token limit"""
+    return truncate_to_tokens(essay, settings.MAX_ESSAY_TOKENS, "essay")
+
+def bound_topic(topic: str) -> str:
+    """Bound a generated test topic to the configured token limit"""
+    return truncate_to_tokens(topic, settings.MAX_TOPIC_TOKENS, "topic")
+
+def language_sample(text: str) -> str:
+    """Take the short sample of a text that is enough for language detection"""
+    return truncate_to_tokens(text, settings.LANGUAGE_SAMPLE_TOKENS, "language_sample")
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    A versioned chat prompt. The system message and the static instructions
+    never change between calls and always come first, so the provider can
+    cache them as a prompt prefix; per-call content is rendered last.
+    """
+    name: str
+    version: int
+    system: str
+    instructions: str
+    variable: str
+    fields: Tuple[str, ...] = field(default=())
+
+    def render(self, **variables) -> List[Dict[str, str]]:
+        """Render the chat messages for this template"""
+        missing = [name for name in self.fields if name not in variables]
+        if missing:
+            raise KeyError(f"Prompt {self.name} is missing variables: {', '.join(missing)}")
+
+        messages = [{"role": "system", "content": self.system}]
+        if self.instructions:
+            messages.append({"role": "user", "content": self.instructions})
+        messages.append({"role": "user", "content": self.variable.format(**variables)})
+        measure_prompt(self.name, messages)
+        return messages
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@v{self.version}"
+
+PROMPT_TEMPLATES: Dict[str, PromptTemplate] = {}
+
+def register_template(name: str, version: int, system: str, instructions: str, variable: str) -> PromptTemplate:
+    """Compile a template once and add it to the registry"""
+    fields = tuple(dict.fromkeys(
+        field_name for _, field_name, _, _ in Formatter().parse(variable) if field_name
+    ))
+    template = PromptTemplate(name, version, system.strip(), instructions.strip(), variable, fields)
+    PROMPT_TEMPLATES[name] = template
+    return template
+
+def get_template(name: str) -> PromptTemplate:
+    """Get a registered template by name"""
+    return PROMPT_TEMPLATES[name]
+
+def measure_prompt(name: str, messages: List[Dict[str, str]]) -> None:
+    """Record the size of a rendered prompt and warn if it exceeds the prompt limit"""
+    size = sum(count_tokens(message["content"]) for message in messages)
+    metrics.observe(f"prompt_tokens_{name}", size)
+    if size > settings.MAX_PROMPT_TOKENS:
+        metrics.increment(f"prompt_oversized_{name}")
+        logging.warning(f"Prompt {name} has {size} tokens (limit {settings.MAX_PROMPT_TOKENS})")
+
+register_template(
+    "grade", 2,
+    system="You are a YKI exam grader. Provide only numerical grades from 0-6 scale. No explanations, no text, just the grade number.",
+    instructions=(
+        "Give only a single numerical grade (0–6) according to the official YKI grading scale. "
+        "Do not explain, comment, or add any extra text. Be strict and follow all YKI criteria. "
+        "If the text is off-topic, give a score of 0."
+    ),
+    variable="Test topic: {topic}\n\nText:\n{essay}",
+)
+
+register_template(
+    "feedback", 2,
+    system=system_message,
+    instructions=(
+        "You are a YKI examiner writing feedback on a student's text. "
+        "Your response should be according to the following format:\n"
+        f"{FEEDBACK_FORMAT}"
+    ),
+    variable=(
+        "Level of YKI is {level}. Test topic: {topic}\n"
+        "Your response should be in {language} language. Student's name is {name}. "
+        "The text was given a grade {grade}:\n{essay}"
+    ),
+)
+
+register_template(
+    "relevance", 2,
+    system="Olet kielitestien tarkistaja. Ole kohtuullinen arvioinnissa.",
+    instructions="""
+Tarkista, vastaako seuraava teksti annettua tehtävän aihetta.
+
+Arvioi relevanssi seuraavasti:
+- Jos teksti käsittelee aihetta suoraan tai sivuaa sitä merkittävästi, vastaa "kyllä"
+- Jos teksti on vain etäisesti aiheeseen liittyvä, vastaa "osittain"
+- Jos teksti ei liity aiheeseen lainkaan, vastaa "ei"
+
+Vastaa vain yhdellä sanalla: kyllä, osittain tai ei.""",
+    variable='Tehtävän aihe:\n"{task}"\n\nTeksti:\n"{essay}"',
+)
+
+register_template(
+    "language", 2,
+    system="You are a language detector. Respond with only the language name in English.",
+    instructions="What language is this text written in? Respond with only the language name.",
+    variable="{text}",
+)
+
+for test_type, question in tests.items():
+    register_template(
+        f"topic_{test_type}", 2,
+        system=system_message,
+        instructions=question,
+        variable="Level of YKI is {level}",
+    )
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Offline regrading of finished tests through the OpenAI Batch API.
+
+    python regrade.py prepare   # stream tests from Postgres into a JSONL batch request file
+    python regrade.py submit    # upload the file and create a batch
+    python regrade.py collect   # download the results of a completed batch
+    python regrade.py simulate  # grade the request file locally instead of the Batch API
+    python regrade.py load      # bulk upsert results into the regrades table
+    python regrade.py summary   # compare regrade and original grade distributions
+    python regrade.py run --simulate   # prepare, simulate and load in one go
+
+Every step can be interrupted and run again: prepare continues after the
+last written test, simulate after the last written result, and load upserts.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from db import db
+from settings import settings
+from prompts import get_template
+from openai_service import openai_service, consensus_grade
+from repository.regrade import RegradeRepository
+
+regrade_repo = RegradeRepository()
+
+REQUESTS_FILE = "requests.jsonl"
+RESULTS_FILE = "results.jsonl"
+BATCH_FILE = "batch.json"
+
+def read_last_line(path: str) -> str:
+    """Read the last non-empty line of a file without reading the whole file"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return ""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        buffer = b""
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            buffer = f.read(step) + buffer
+            lines = buffer.rstrip(b"\n").split(b"\n")
+            if len(lines) > 1 or position == 0:
+                return lines[-1].decode("utf-8")
+    return ""
+
+def drop_incomplete_last_line(path: str) -> None:
+    """Truncate a line left without its newline by a crash in the middle of a write"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        end = position = f.tell()
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            if position + step == end and chunk.endswith(b"\n"):
+                return
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position += newline + 1
+                break
+        f.truncate(position)
+    logging.warning(f"Dropped an incomplete last line of {path}")
+
+def count_lines(path: str) -> int:
+    """Count lines of a file in constant memory"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+def test_id_from_custom_id(custom_id: str) -> int:
+    return int(custom_id.split("-", 1)[1])
+
+async def prepare(workdir: str, prompt_version: str) -> int:
+    """Write one batch request line per finished test that was not regraded yet"""
+    path = os.path.join(workdir, REQUESTS_FILE)
+    drop_incomplete_last_line(path)
+    last_line = read_last_line(path)
+    after_id = test_id_from_custom_id(json.loads(last_line)["custom_id"]) if last_line else 0
+
+    written = 0
+    with open(path, "a", encoding="utf-8") as f:
+        async for test in regrade_repo.iterate_finished_tests(prompt_version, after_id):
+            request = {
+                "custom_id": f"test-{test['id']}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": openai_service.build_grade_request(test['topic'], test['response'], settings.GRADING_SAMPLES),
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            written += 1
+    logging.info(f"Wrote {written} batch requests to {path} (after test {after_id})")
+    return written
+
+def submit(workdir: str) -> str:
+    """Upload the request file and create a batch"""
+    with open(os.path.join(workdir, REQUESTS_FILE), "rb") as f:
+        input_file = openai_service.client.files.create(file=f, purpose="batch")
+    batch = openai_service.client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    with open(os.path.join(workdir, BATCH_FILE), "w") as f:
+        json.dump({"batch_id": batch.id, "input_file_id": input_file.id}, f)
+    logging.info(f"Submitted batch {batch.id}")
+    return batch.id
+
+def collect(workdir: str) -> bool:
+    """Download the output of a completed batch into the results file"""
+    with open(os.path.join(workdir, BATCH_FILE)) as f:
+        batch_id = json.load(f)["batch_id"]
+
+    batch = openai_service.client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        logging.info(f"Batch {batch_id} is {batch.status}")
+        return False
+
+    path = os.path.join(workdir, RESULTS_FILE)
+    with open(path, "wb") as f:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            with openai_service.client.files.with_streaming_response.content(file_id) as response:
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+    logging.info(f"Downloaded results of batch {batch_id} to {path}")
+    return True
+
+def simulate(workdir: str) -> int:
+    """Run the batch requests one by one through the regular API, in the batch output format"""
+    requests_path = os.path.join(workdir, REQUESTS_FILE)
+    results_path = os.path.join(workdir, RESULTS_FILE)
+    drop_incomplete_last_line(results_path)
+    done = count_lines(results_path)
+
+    processed = 0
+    with open(requests_path, encoding="utf-8") as requests, open(results_path, "a", encoding="utf-8") as results:
+        for index, line in enumerate(requests):
+            if index < done:
+                continue
+            request = json.loads(line)
+            try:
+                response = openai_service.client.chat.completions.create(**request["body"])
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": response.model_dump()},
+                    "error": None,
+                }
+            except Exception as e:
+                result = {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+            results.write(json.dumps(result, ensure_ascii=False) + "\n")
+            results.flush()
+            processed += 1
+    logging.info(f"Simulated {processed} batch requests ({done} were already done)")
+    return processed
+
+def parse_result(line: str, prompt_version: str) -> tuple:
+    """Turn one batch output line into a (test_id, prompt_version, grade, error) row"""
+    item = json.loads(line)
+    test_id = test_id_from_custom_id(item["custom_id"])
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        error = item.get("error") or response.get("body")
+        return (test_id, prompt_version, None, json.dumps(error, ensure_ascii=False)[:500])
+    try:
+        grades = [
+            openai_service.parse_grade_arguments(choice["message"]["tool_calls"][0]["function"]["arguments"])
+            for choice in response["body"]["choices"]
+            if choice["message"].get("tool_calls")
+        ]
+        grade, _ = consensus_grade(grades)
+        return (test_id, prompt_version, grade, None)
+    except Exception as e:
+        return (test_id, prompt_version, None, f"Unparseable response: {e}")
+
+async def load(workdir: str, prompt_version: str, chunk_size: int) -> int:
+    """Stream the results file into the regrades table in chunks"""
+    loaded = 0
+    chunk = []
+    with open(os.path.join(workdir, RESULTS_FILE), encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                chunk.append(parse_result(line, prompt_version))
+            except json.JSONDecodeError as e:
+                logging.warning(f"Skipping unreadable line {number} of the results file: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                loaded += await regrade_repo.bulk_upsert(chunk)
+                chunk = []
+    loaded += await regrade_repo.bulk_upsert(chunk)
+    logging.info(f"Loaded {loaded} regrades for {prompt_version}")
+    return loaded
+
+async def summary(prompt_version: str) -> None:
+    """Print the grade distributions side by side"""
+    rows = await regrade_repo.get_distribution(prompt_version)
+    print(f"{'grade':>5} {'original':>9} {'regrade':>9}")
+    for row in rows:
+        print(f"{str(row['grade']):>5} {row['original']:>9} {row['regrade']:>9}")
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Regrade finished tests with the current grading prompt")
+    parser.add_argument("command", choices=["prepare", "submit", "collect", "simulate", "load", "summary", "run"])
+    parser.add_argument("--prompt-version", default=get_template("grade").key,
+                        help="Label stored with the regrades (default: current grade template version)")
+    parser.add_argument("--workdir", help="Directory for the batch files (default: regrade_<prompt version>)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per COPY when loading results")
+    parser.add_argument("--simulate", action="store_true", help="With run: grade locally instead of the Batch API")
+    args = parser.parse_args()
+
+    workdir = args.workdir or f"regrade_{args.prompt_version.replace('@', '_')}"
+    os.makedirs(workdir, exist_ok=True)
+
+    if args.command in ("submit", "collect", "simulate", "run") and not openai_service.api_available:
+        logging.error("OPENAI_API_KEY is not set")
+        return 1
+
+    if args.command == "submit":
+        submit(workdir)
+        return 0
+    if args.command == "collect":
+        return 0 if collect(workdir) else 2
+    if args.command == "simulate":
+        simulate(workdir)
+        return 0
+
+    await db.connect(settings.DATABASE_URL_UNPOOLED)
+    if not db.pool:
+        return 1
+    await regrade_repo.init(db)
+    try:
+        if args.command == "prepare":
+            await prepare(workdir, args.prompt_version)
+        elif args.command == "load":
+            await load(workdir, args.prompt_version, args.chunk_size)
+        elif args.command == "summary":
+            await summary(args.prompt_version)
+        elif args.command == "run":
+            await prepare(workdir, args.prompt_version)
+            if args.simulate:
+                simulate(workdir)
+                await load(workdir, args.prompt_version, args.chunk_size)
+                await summary(args.prompt_version)
+            else:
+                submit(workdir)
+                logging.info("Run `python regrade.py collect` and `python regrade.py load` when the batch completes")
+    finally:
+        await db.close()
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from metrics import metrics
+from settings import get_text
+
+class ReminderScheduler:
+    """
+    Reminds students who have not taken a test for a few days. One loop wakes
+    up every `interval` seconds, claims at most `batch_size` due users and
+    spreads their messages over the interval, so the reminders of a day are
+    sent evenly instead of in one burst.
+    """
+
+    def __init__(self, reminder_repo, user_repo, inactive_days: int, interval: float, batch_size: int):
+        self.reminder_repo = reminder_repo
+        self.user_repo = user_repo
+        self.inactive_days = inactive_days
+        self.interval = interval
+        self.batch_size = batch_size
+
+    async def run(self, bot: Bot, may_run: Callable[[], Awaitable[bool]] = None) -> None:
+        """Send due reminders every interval; may_run lets only one instance of a cluster send them"""
+        while True:
+            started = time.monotonic()
+            try:
+                if may_run is None or await may_run():
+                    await self.send_due(bot)
+            except Exception as e:
+                logging.error(f"Reminder run failed: {e}")
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    async def send_due(self, bot: Bot) -> int:
+        """Claim one batch of due users and send their reminders spread over the interval"""
+        users = await self.reminder_repo.claim_due_reminders(self.inactive_days, self.batch_size)
+        if not users:
+            return 0
+
+        # Leave a tenth of the interval for the next claim
+        spacing = self.interval * 0.9 / len(users)
+        sent = 0
+        for user in users:
+            if await self._send(bot, user):
+                sent += 1
+            await asyncio.sleep(spacing)
+        logging.info(f"Sent {sent} of {len(users)} reminders")
+        return sent
+
+    async def _send(self, bot: Bot, user: dict) -> bool:
+        text = get_text('reminder', user['language'], name=user['name'] or "", days=self.inactive_days)
+        try:
+            await bot.send_message(user['id'], text)
+            metrics.increment("reminders_sent")
+            return True
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            metrics.increment("reminders_failed")
+            return False
+        except TelegramForbiddenError:
+            await self.user_repo.mark_blocked(user['id'])
+            metrics.increment("reminders_blocked")
+            return False
+        except TelegramAPIError as e:
+            logging.warning(f"Failed to send reminder to {user['id']}: {e}")
+            metrics.increment("reminders_failed")
+            return False
@@ -0,0 +1,93 @@
+import logging
+from db import Database
+
+class BroadcastRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the broadcasts table if it doesn't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id SERIAL PRIMARY KEY,
+                    created_by BIGINT NOT NULL REFERENCES tg_user(id),
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'finished')),
+                    last_user_id BIGINT NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    finished_at TIMESTAMP WITH TIME ZONE
+                )
+            """)
+            logging.info("Broadcasts table initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize broadcasts table: {e}")
+
+    async def create_broadcast(self, created_by: int, text: str) -> dict:
+        """Create a running broadcast"""
+        try:
+            return await self.db.fetchrow("""
+                INSERT INTO broadcasts (created_by, text) VALUES ($1, $2) RETURNING *
+            """, created_by, text)
+        except Exception as e:
+            logging.error(f"Failed to create broadcast: {e}")
+            return None
+
+    async def get_running_broadcasts(self) -> list:
+        """Broadcasts interrupted by a restart"""
+        try:
+            return await self.db.fetch("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+        except Exception as e:
+            logging.error(f"Failed to get running broadcasts: {e}")
+            return []
+
+    async def get_recipients(self, after_user_id: int, limit: int) -> list:
+        """
+        Next page of invited users who did not block the bot, in id order after
+        after_user_id. Returns None on errors, so a broadcast is not finished early.
+        """
+        try:
+            rows = await self.db.fetch("""
+                SELECT id FROM tg_user
+                WHERE invited = TRUE AND blocked_at IS NULL AND id > $1
+                ORDER BY id
+                LIMIT $2
+            """, after_user_id, limit)
+            return [row['id'] for row in rows]
+        except Exception as e:
+            logging.error(f"Failed to get broadcast recipients: {e}")
+            return None
+
+    async def save_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                            blocked_user_ids: list) -> bool:
+        """Add the results of a batch and move the resume point past it"""
+        try:
+            async with self.db.transaction():
+                await self.db.execute("""
+                    UPDATE broadcasts
+                    SET last_user_id = $2, sent = sent + $3, failed = failed + $4, blocked = blocked + $5
+                    WHERE id = $1
+                """, broadcast_id, last_user_id, sent, failed, len(blocked_user_ids))
+                if blocked_user_ids:
+                    await self.db.execute("""
+                        UPDATE tg_user SET blocked_at = NOW() WHERE id = ANY($1::bigint[])
+                    """, blocked_user_ids)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to save broadcast progress: {e}")
+            return False
+
+    async def finish_broadcast(self, broadcast_id: int) -> dict:
+        """Mark a broadcast finished and return its stats with the author's language"""
+        try:
+            return await self.db.fetchrow("""
+                UPDATE broadcasts b
+                SET status = 'finished', finished_at = NOW()
+                FROM tg_user u
+                WHERE b.id = $1 AND u.id = b.created_by
+                RETURNING b.id, b.created_by, b.sent, b.failed, b.blocked, u.language
+            """, broadcast_id)
+        except Exception as e:
+            logging.error(f"Failed to finish broadcast: {e}")
+            return None
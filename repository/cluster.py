@@ -0,0 +1,76 @@
+import logging
+from db import Database
+
+class ClusterRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the instances and leases tables if they don't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS instances (
+                    id TEXT PRIMARY KEY,
+                    started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    heartbeat_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+                )
+            """)
+            self.db.register("heartbeat", """
+                INSERT INTO instances (id) VALUES ($1)
+                ON CONFLICT (id) DO UPDATE SET heartbeat_at = NOW()
+            """)
+            self.db.register("live_instances", """
+                SELECT id FROM instances
+                WHERE heartbeat_at > NOW() - make_interval(secs => $1)
+                ORDER BY id
+            """)
+            self.db.register("acquire_lease", """
+                INSERT INTO leases (name, holder, expires_at)
+                VALUES ($1, $2, NOW() + make_interval(secs => $3))
+                ON CONFLICT (name) DO UPDATE
+                SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+                WHERE leases.holder = EXCLUDED.holder OR leases.expires_at < NOW()
+                RETURNING holder
+            """)
+            logging.info("Cluster tables initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize cluster tables: {e}")
+
+    async def heartbeat(self, instance_id: str, ttl: float) -> list:
+        """Record that this instance is alive and return the ids of all live instances"""
+        try:
+            await self.db.execute_named("heartbeat", instance_id)
+            return [row['id'] for row in await self.db.fetch_named("live_instances", float(ttl))]
+        except Exception as e:
+            logging.error(f"Failed to send heartbeat: {e}")
+            return []
+
+    async def remove_instance(self, instance_id: str) -> None:
+        """Leave the cluster: drop the heartbeat and every lease of this instance"""
+        try:
+            async with self.db.transaction():
+                await self.db.execute("DELETE FROM leases WHERE holder = $1", instance_id)
+                await self.db.execute("DELETE FROM instances WHERE id = $1", instance_id)
+            # Instances that stopped without leaving are forgotten after a day
+            await self.db.execute("DELETE FROM instances WHERE heartbeat_at < NOW() - INTERVAL '1 day'")
+        except Exception as e:
+            logging.error(f"Failed to remove instance: {e}")
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew a named lease; fails while another live holder has it"""
+        try:
+            return await self.db.fetchval_named("acquire_lease", name, holder, float(ttl)) == holder
+        except Exception as e:
+            logging.error(f"Failed to acquire lease {name}: {e}")
+            return False
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        try:
+            await self.db.execute("DELETE FROM leases WHERE name = $1 AND holder = $2", name, holder)
+        except Exception as e:
+            logging.error(f"Failed to release lease {name}: {e}")
@@ -0,0 +1,62 @@
+import logging
+from datetime import datetime
+from db import Database, read_only
+
+# Columns of an exported test row, in file order
+EXPORT_COLUMNS = """
+    t.id AS test_id, t.user_id, u.username, u.name, u.language, t.test_type, t.test_level,
+    t.started_at, t.finished_at, t.finished, t.grade, t.grade_confidence, t.topic, t.response
+"""
+
+class ExportRepository:
+    async def init(self, db: Database, timeout: float = 3600):
+        self.db = db
+        self.timeout = timeout
+
+    @staticmethod
+    def build_query(since: datetime = None, until: datetime = None, level: str = None,
+                    test_type: str = None, include_archived: bool = False) -> tuple:
+        """Build the export query and its arguments for the given filters"""
+        conditions = []
+        args = []
+        for condition, value in (
+            ("t.started_at >= ${}", since),
+            ("t.started_at < ${}", until),
+            ("t.test_level = ${}", level),
+            ("t.test_type = ${}", test_type),
+        ):
+            if value is not None:
+                args.append(value)
+                conditions.append(condition.format(len(args)))
+
+        source = "tests"
+        if include_archived:
+            source = """(
+                SELECT id, test_type, test_level, user_id, topic, started_at, finished_at,
+                       finished, response, grade, grade_confidence FROM tests
+                UNION ALL
+                SELECT id, test_type, test_level, user_id, topic, started_at, finished_at,
+                       finished, response, grade, grade_confidence FROM tests_archive
+            )"""
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+            SELECT {EXPORT_COLUMNS}
+            FROM {source} t
+            JOIN tg_user u ON u.id = t.user_id
+            {where}
+            ORDER BY t.started_at, t.id
+        """
+        return query, args
+
+    @read_only
+    async def copy_tests_csv(self, output, **filters) -> bool:
+        """Stream tests joined with their users as CSV into a file path, file object or callback"""
+        query, args = self.build_query(**filters)
+        try:
+            status = await self.db.copy_from_query(
+                query, *args, output=output, timeout=self.timeout, format="csv", header=True
+            )
+            return status is not None
+        except Exception as e:
+            logging.error(f"Failed to export tests: {e}")
+            return False
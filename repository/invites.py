@@ -1,5 +1,5 @@
 import logging
-from db import Database
+from db import Database, read_only
 import uuid
 from datetime import datetime
 
@@ -8,7 +8,7 @@ class InviteRepository:
         self.db = db
         """Initialize the invites table if it doesn't exist"""
         try:
-            await self.db.execute("""
+            await self.db.execute_schema("""
                 CREATE TABLE IF NOT EXISTS invites (
                     id SERIAL PRIMARY KEY,
                     code TEXT UNIQUE NOT NULL,
@@ -21,6 +21,24 @@ class InviteRepository:
                     FOREIGN KEY (created_by) REFERENCES tg_user(id)
                 )
             """)
+            self.db.register("get_invite", """
+                SELECT * FROM invites WHERE code = $1 AND is_active = TRUE
+            """)
+            self.db.register("use_invite", """
+                UPDATE invites 
+                SET current_uses = current_uses + 1 
+                WHERE code = $1 AND is_active = TRUE 
+                AND (expires_at IS NULL OR expires_at > NOW())
+                AND current_uses < max_uses
+                RETURNING id
+            """)
+            self.db.register("is_valid_invite", """
+                SELECT id, created_by FROM invites 
+                WHERE code = $1 
+                AND is_active = TRUE 
+                AND (expires_at IS NULL OR expires_at > NOW())
+                AND current_uses < max_uses
+            """)
             logging.info("Invites table initialized")
         except Exception as e:
             logging.error(f"Failed to initialize invites table: {e}")
@@ -42,9 +60,7 @@ class InviteRepository:
     async def get_invite(self, code: str):
         """Get an invite by code"""
         try:
-            return await self.db.fetchrow("""
-                SELECT * FROM invites WHERE code = $1 AND is_active = TRUE
-            """, code)
+            return await self.db.fetchrow_named("get_invite", code)
         except Exception as e:
             logging.error(f"Failed to get invite: {e}")
             return None
@@ -52,14 +68,7 @@ class InviteRepository:
     async def use_invite(self, code: str) -> bool:
         """Use an invite code (increment current_uses)"""
         try:
-            result = await self.db.execute("""
-                UPDATE invites 
-                SET current_uses = current_uses + 1 
-                WHERE code = $1 AND is_active = TRUE 
-                AND (expires_at IS NULL OR expires_at > NOW())
-                AND current_uses < max_uses
-                RETURNING id
-            """, code)
+            result = await self.db.fetchval_named("use_invite", code)
             
             if result:
                 # Check if we've reached max uses
@@ -86,6 +95,7 @@ class InviteRepository:
             logging.error(f"Failed to deactivate invite: {e}")
             return False
     
+    @read_only
     async def get_invites_by_creator(self, created_by: int):
         """Get all invites created by a specific user"""
         try:
@@ -98,6 +108,7 @@ class InviteRepository:
             logging.error(f"Failed to get invites by creator: {e}")
             return []
     
+    @read_only
     async def get_active_invites(self):
         """Get all active invites"""
         try:
@@ -115,13 +126,7 @@ class InviteRepository:
     async def is_valid_invite(self, code: str) -> bool:
         """Check if an invite code is valid and can be used"""
         try:
-            result = await self.db.fetchrow("""
-                SELECT id, created_by FROM invites 
-                WHERE code = $1 
-                AND is_active = TRUE 
-                AND (expires_at IS NULL OR expires_at > NOW())
-                AND current_uses < max_uses
-            """, code)
+            result = await self.db.fetchrow_named("is_valid_invite", code)
             return result or None
         except Exception as e:
             logging.error(f"Failed to check invite validity: {e}")
@@ -0,0 +1,125 @@
+import logging
+from db import Database
+
+class JobRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the scheduled jobs table if it doesn't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    test_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    run_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                    PRIMARY KEY (test_id, kind)
+                )
+            """)
+            # In cluster mode the instance running a job claims it; after claimed_until
+            # the claim can be taken over, once the claimer stopped sending heartbeats
+            await self.db.execute_schema("""
+                ALTER TABLE scheduled_jobs
+                ADD COLUMN IF NOT EXISTS claimed_by TEXT DEFAULT NULL,
+                ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP WITH TIME ZONE DEFAULT NULL
+            """)
+            await self.db.execute_schema("""
+                CREATE INDEX IF NOT EXISTS scheduled_jobs_run_at_idx ON scheduled_jobs (run_at)
+            """)
+            self.db.register("claim_due_jobs", """
+                UPDATE scheduled_jobs j
+                SET claimed_by = $1, claimed_until = GREATEST(j.run_at, NOW()) + make_interval(secs => $5)
+                WHERE (j.test_id, j.kind) IN (
+                    SELECT test_id, kind FROM scheduled_jobs
+                    WHERE run_at <= NOW() + make_interval(secs => $4)
+                    AND (
+                        (claimed_by IS NULL AND test_id % $3 = $2)
+                        OR (claimed_until < NOW() AND NOT EXISTS (
+                            SELECT 1 FROM instances i
+                            WHERE i.id = claimed_by AND i.heartbeat_at > NOW() - make_interval(secs => $7)
+                        ))
+                    )
+                    ORDER BY run_at
+                    LIMIT $6
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.test_id, j.kind, j.user_id, j.run_at
+            """)
+            logging.info("Scheduled jobs table initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize scheduled jobs table: {e}")
+
+    async def save_jobs(self, jobs: list) -> bool:
+        """Persist (test_id, kind, user_id, run_at) timers that did not run yet"""
+        if not jobs:
+            return True
+        try:
+            test_ids, kinds, user_ids, run_ats = zip(*jobs)
+            await self.db.execute("""
+                INSERT INTO scheduled_jobs (test_id, kind, user_id, run_at)
+                SELECT * FROM unnest($1::int[], $2::text[], $3::bigint[], $4::timestamptz[])
+                ON CONFLICT (test_id, kind) DO UPDATE
+                SET user_id = EXCLUDED.user_id, run_at = EXCLUDED.run_at, claimed_by = NULL, claimed_until = NULL
+            """, list(test_ids), list(kinds), list(user_ids), list(run_ats))
+            return True
+        except Exception as e:
+            logging.error(f"Failed to save scheduled jobs: {e}")
+            return False
+
+    async def claim_due_jobs(self, instance_id: str, shard_index: int, shard_count: int,
+                             lookahead: float, claim_seconds: float, instance_ttl: float,
+                             limit: int = 100) -> list:
+        """
+        Claim jobs due within lookahead seconds. Unclaimed jobs are taken by the
+        instance owning their test_id shard. A claim is never taken from an
+        instance that still sends heartbeats (within instance_ttl seconds), however
+        long its job runs; claims of instances that died can be taken by anyone
+        claim_seconds after the run time.
+        """
+        try:
+            return await self.db.fetch_named(
+                "claim_due_jobs", instance_id, shard_index, shard_count,
+                float(lookahead), float(claim_seconds), limit, float(instance_ttl)
+            )
+        except Exception as e:
+            logging.error(f"Failed to claim scheduled jobs: {e}")
+            return []
+
+    async def complete_job(self, test_id: int, kind: str) -> None:
+        try:
+            await self.db.execute("DELETE FROM scheduled_jobs WHERE test_id = $1 AND kind = $2", test_id, kind)
+        except Exception as e:
+            logging.error(f"Failed to complete scheduled job: {e}")
+
+    async def delete_test_jobs(self, test_id: int) -> None:
+        """Forget the timers of a cancelled test"""
+        try:
+            await self.db.execute("DELETE FROM scheduled_jobs WHERE test_id = $1", test_id)
+        except Exception as e:
+            logging.error(f"Failed to delete scheduled jobs: {e}")
+
+    async def release_jobs(self, instance_id: str) -> None:
+        """Give back the jobs this instance claimed but did not run"""
+        try:
+            await self.db.execute("""
+                UPDATE scheduled_jobs SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = $1
+            """, instance_id)
+        except Exception as e:
+            logging.error(f"Failed to release scheduled jobs: {e}")
+
+    async def get_pending_completions(self) -> list:
+        """Tests whose time is not over yet, with their students"""
+        try:
+            return await self.db.fetch("""
+                SELECT test_id, user_id FROM scheduled_jobs WHERE kind = 'completion' AND run_at > NOW()
+            """)
+        except Exception as e:
+            logging.error(f"Failed to get pending completions: {e}")
+            return []
+
+    async def take_jobs(self) -> list:
+        """Remove and return all persisted timers"""
+        try:
+            return await self.db.fetch("DELETE FROM scheduled_jobs RETURNING test_id, kind, user_id, run_at")
+        except Exception as e:
+            logging.error(f"Failed to load scheduled jobs: {e}")
+            return []
@@ -0,0 +1,108 @@
+import logging
+from db import Database
+
+# Tests older than TESTS_ARCHIVE_AFTER_DAYS were moved into tests_archive
+ALL_TESTS = """(
+    SELECT id, test_type, topic, finished, response, grade FROM tests
+    UNION ALL
+    SELECT id, test_type, topic, finished, response, grade FROM tests_archive
+)"""
+
+class RegradeRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the regrades table if it doesn't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS regrades (
+                    test_id INTEGER NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    grade INTEGER,
+                    original_grade INTEGER,
+                    error TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    PRIMARY KEY (test_id, prompt_version)
+                )
+            """)
+            logging.info("Regrades table initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize regrades table: {e}")
+
+    def iterate_finished_tests(self, prompt_version: str, after_id: int = 0):
+        """Stream finished tests with a real response that were not regraded with this prompt version"""
+        return self.db.iterate(f"""
+            SELECT t.id, t.test_type, t.topic, t.response
+            FROM {ALL_TESTS} t
+            WHERE t.finished = TRUE
+            AND t.id > $1
+            AND t.response IS NOT NULL
+            AND t.response NOT LIKE 'AUTO\\_%'
+            AND NOT EXISTS (
+                SELECT 1 FROM regrades r
+                WHERE r.test_id = t.id AND r.prompt_version = $2
+            )
+            ORDER BY t.id
+        """, after_id, prompt_version)
+
+    async def bulk_upsert(self, rows: list) -> int:
+        """
+        Upsert (test_id, prompt_version, grade, error) rows with COPY into a
+        temporary table followed by a single INSERT ... ON CONFLICT.
+        Returns the number of rows stored; rows of unknown tests are dropped.
+        """
+        if not rows:
+            return 0
+        try:
+            async with self.db.transaction() as conn:
+                if conn is None:
+                    return 0
+                await conn.execute("""
+                    CREATE TEMP TABLE regrades_incoming (
+                        test_id INTEGER,
+                        prompt_version TEXT,
+                        grade INTEGER,
+                        error TEXT
+                    ) ON COMMIT DROP
+                """)
+                await conn.copy_records_to_table(
+                    "regrades_incoming",
+                    records=rows,
+                    columns=["test_id", "prompt_version", "grade", "error"]
+                )
+                inserted = await conn.execute(f"""
+                    INSERT INTO regrades (test_id, prompt_version, grade, original_grade, error)
+                    SELECT i.test_id, i.prompt_version, i.grade, t.grade, i.error
+                    FROM regrades_incoming i
+                    JOIN {ALL_TESTS} t ON t.id = i.test_id
+                    ON CONFLICT (test_id, prompt_version)
+                    DO UPDATE SET grade = EXCLUDED.grade,
+                                  original_grade = EXCLUDED.original_grade,
+                                  error = EXCLUDED.error,
+                                  created_at = NOW()
+                """)
+            stored = int(inserted.split()[-1])
+            if stored < len(rows):
+                logging.warning(f"Dropped {len(rows) - stored} regrades of tests that no longer exist")
+            return stored
+        except Exception as e:
+            logging.error(f"Failed to upsert regrades: {e}")
+            return 0
+
+    async def get_distribution(self, prompt_version: str) -> list:
+        """Compare the distribution of regrades with the original grades"""
+        try:
+            return await self.db.fetch("""
+                SELECT g.grade,
+                       COUNT(*) FILTER (WHERE g.source = 'original') AS original,
+                       COUNT(*) FILTER (WHERE g.source = 'regrade') AS regrade
+                FROM regrades r
+                CROSS JOIN LATERAL (
+                    VALUES ('original', r.original_grade), ('regrade', r.grade)
+                ) AS g(source, grade)
+                WHERE r.prompt_version = $1 AND r.error IS NULL
+                GROUP BY g.grade
+                ORDER BY g.grade
+            """, prompt_version)
+        except Exception as e:
+            logging.error(f"Failed to get regrade distribution: {e}")
+            return []
@@ -0,0 +1,57 @@
+import logging
+from db import Database
+
+class ReminderRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the reminders table if it doesn't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS reminders (
+                    user_id BIGINT PRIMARY KEY REFERENCES tg_user(id),
+                    last_active_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                    sent_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            # A user is reminded once per inactivity period: the reminder remembers
+            # the activity it was sent for and the user is due again after a new test
+            self.db.register("claim_due_reminders", """
+                WITH due AS (
+                    SELECT u.id, u.language, u.name, COALESCE(t.started_at, u.created_at) AS last_active_at
+                    FROM tg_user u
+                    LEFT JOIN LATERAL (
+                        SELECT started_at FROM tests
+                        WHERE user_id = u.id
+                        ORDER BY started_at DESC
+                        LIMIT 1
+                    ) t ON TRUE
+                    LEFT JOIN reminders r ON r.user_id = u.id
+                    WHERE u.invited = TRUE AND u.blocked_at IS NULL
+                    AND COALESCE(t.started_at, u.created_at) < NOW() - make_interval(days => $1)
+                    AND (r.last_active_at IS NULL OR r.last_active_at < COALESCE(t.started_at, u.created_at))
+                    ORDER BY u.id
+                    LIMIT $2
+                ), claimed AS (
+                    INSERT INTO reminders (user_id, last_active_at, sent_at)
+                    SELECT id, last_active_at, NOW() FROM due
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET last_active_at = EXCLUDED.last_active_at, sent_at = NOW()
+                    RETURNING user_id
+                )
+                SELECT due.id, due.language, due.name, due.last_active_at
+                FROM due JOIN claimed ON claimed.user_id = due.id
+            """)
+            logging.info("Reminders table initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize reminders table: {e}")
+
+    async def claim_due_reminders(self, inactive_days: int, limit: int) -> list:
+        """
+        Find users without a test for inactive_days who were not reminded about
+        this inactivity yet, and record the reminders as sent in the same statement.
+        """
+        try:
+            return await self.db.fetch_named("claim_due_reminders", inactive_days, limit)
+        except Exception as e:
+            logging.error(f"Failed to claim due reminders: {e}")
+            return []
@@ -0,0 +1,212 @@
+import logging
+import time
+from db import Database, read_only
+
+# A test counts as graded when the student sent a response that went through grading
+# (cancelled tests have no grade)
+GRADED_CONDITION = (
+    "finished = TRUE AND grade IS NOT NULL AND response IS NOT NULL AND response NOT LIKE 'AUTO\\_%'"
+)
+
+# Streak days are UTC days, in the incremental updates as in rebuild()
+UTC_TODAY = "(NOW() AT TIME ZONE 'UTC')::date"
+
+# Every test ever finished, archived ones included
+ALL_TESTS = """(
+    SELECT user_id, test_type, finished, finished_at, response, grade FROM tests
+    UNION ALL
+    SELECT user_id, test_type, finished, finished_at, response, grade FROM tests_archive
+)"""
+
+# Streak after a graded completion today, given the previous row of user_stats
+STREAK_AFTER_COMPLETION = f"""
+    CASE WHEN $3::int IS NULL THEN user_stats.current_streak
+         WHEN user_stats.last_active_on = {UTC_TODAY} THEN user_stats.current_streak
+         WHEN user_stats.last_active_on = {UTC_TODAY} - 1 THEN user_stats.current_streak + 1
+         ELSE 1 END
+"""
+
+class StatsRepository:
+    async def init(self, db: Database, leaderboard_ttl: float = 60):
+        self.db = db
+        self.leaderboard_ttl = leaderboard_ttl
+        self._leaderboard = []
+        self._leaderboard_limit = 0
+        self._leaderboard_expires_at = 0.0
+        """Initialize the statistics tables if they don't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id BIGINT PRIMARY KEY REFERENCES tg_user(id),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    graded_attempts INTEGER NOT NULL DEFAULT 0,
+                    grade_sum INTEGER NOT NULL DEFAULT 0,
+                    best_grade INTEGER,
+                    points INTEGER NOT NULL DEFAULT 0,
+                    current_streak INTEGER NOT NULL DEFAULT 0,
+                    best_streak INTEGER NOT NULL DEFAULT 0,
+                    last_active_on DATE,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS user_part_stats (
+                    user_id BIGINT NOT NULL REFERENCES tg_user(id),
+                    test_type TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    graded_attempts INTEGER NOT NULL DEFAULT 0,
+                    grade_sum INTEGER NOT NULL DEFAULT 0,
+                    best_grade INTEGER,
+                    PRIMARY KEY (user_id, test_type)
+                )
+            """)
+            await self.db.execute_schema("""
+                CREATE INDEX IF NOT EXISTS user_stats_points_idx ON user_stats (points DESC, user_id)
+            """)
+            self.db.register("record_completion", f"""
+                WITH part AS (
+                    INSERT INTO user_part_stats (user_id, test_type, attempts, graded_attempts, grade_sum, best_grade)
+                    VALUES ($1, $2, 1, ($3::int IS NOT NULL)::int, COALESCE($3, 0), $3)
+                    ON CONFLICT (user_id, test_type) DO UPDATE SET
+                        attempts = user_part_stats.attempts + 1,
+                        graded_attempts = user_part_stats.graded_attempts + EXCLUDED.graded_attempts,
+                        grade_sum = user_part_stats.grade_sum + EXCLUDED.grade_sum,
+                        best_grade = GREATEST(user_part_stats.best_grade, EXCLUDED.best_grade)
+                )
+                INSERT INTO user_stats (
+                    user_id, attempts, graded_attempts, grade_sum, best_grade, points,
+                    current_streak, best_streak, last_active_on
+                )
+                VALUES (
+                    $1, 1, ($3::int IS NOT NULL)::int, COALESCE($3, 0), $3, COALESCE($3, 0),
+                    ($3::int IS NOT NULL)::int, ($3::int IS NOT NULL)::int,
+                    CASE WHEN $3::int IS NULL THEN NULL ELSE {UTC_TODAY} END
+                )
+                ON CONFLICT (user_id) DO UPDATE SET
+                    attempts = user_stats.attempts + 1,
+                    graded_attempts = user_stats.graded_attempts + EXCLUDED.graded_attempts,
+                    grade_sum = user_stats.grade_sum + EXCLUDED.grade_sum,
+                    best_grade = GREATEST(user_stats.best_grade, EXCLUDED.best_grade),
+                    points = user_stats.points + EXCLUDED.points,
+                    current_streak = {STREAK_AFTER_COMPLETION},
+                    best_streak = GREATEST(user_stats.best_streak, {STREAK_AFTER_COMPLETION}),
+                    last_active_on = COALESCE(EXCLUDED.last_active_on, user_stats.last_active_on),
+                    updated_at = NOW()
+            """)
+            if self.db.schema_checks and not await self.db.fetchval("SELECT EXISTS (SELECT 1 FROM user_stats)"):
+                await self.rebuild()
+            logging.info("Stats tables initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize stats tables: {e}")
+
+    async def record_completion(self, user_id: int, test_type: str, grade: int = None) -> bool:
+        """
+        Fold a finished test into the aggregates. grade is None when nothing was graded.
+        Inside a transaction errors are raised, so the test is not finished without it.
+        """
+        try:
+            await self.db.execute_named("record_completion", user_id, test_type, grade)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to record test completion: {e}")
+            if self.db.in_transaction:
+                raise
+            return False
+
+    async def record_completions(self, tests: list) -> None:
+        """Fold ungraded (cancelled) tests given as (user_id, test_type) rows into the aggregates"""
+        for test in tests:
+            await self.record_completion(test['user_id'], test['test_type'])
+
+    async def rebuild(self) -> bool:
+        """Recompute all aggregates from the tests and tests_archive tables"""
+        try:
+            async with self.db.transaction():
+                await self.db.execute("TRUNCATE user_part_stats, user_stats")
+                await self.db.execute(f"""
+                    INSERT INTO user_part_stats (user_id, test_type, attempts, graded_attempts, grade_sum, best_grade)
+                    SELECT user_id, test_type, COUNT(*),
+                           COUNT(*) FILTER (WHERE {GRADED_CONDITION}),
+                           COALESCE(SUM(grade) FILTER (WHERE {GRADED_CONDITION}), 0),
+                           MAX(grade) FILTER (WHERE {GRADED_CONDITION})
+                    FROM {ALL_TESTS} t
+                    WHERE finished = TRUE
+                    GROUP BY user_id, test_type
+                """)
+                await self.db.execute(f"""
+                    WITH days AS (
+                        SELECT DISTINCT user_id, (finished_at AT TIME ZONE 'UTC')::date AS day
+                        FROM {ALL_TESTS} t WHERE {GRADED_CONDITION} AND finished_at IS NOT NULL
+                    ), runs AS (
+                        SELECT user_id, COUNT(*) AS length, MAX(day) AS last_day
+                        FROM (
+                            SELECT user_id, day, day - ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day)::int AS run
+                            FROM days
+                        ) numbered
+                        GROUP BY user_id, run
+                    ), streaks AS (
+                        SELECT user_id, MAX(length) AS best_streak,
+                               (ARRAY_AGG(length ORDER BY last_day DESC))[1] AS current_streak,
+                               MAX(last_day) AS last_active_on
+                        FROM runs GROUP BY user_id
+                    )
+                    INSERT INTO user_stats (
+                        user_id, attempts, graded_attempts, grade_sum, best_grade, points,
+                        current_streak, best_streak, last_active_on
+                    )
+                    SELECT p.user_id, SUM(p.attempts), SUM(p.graded_attempts), SUM(p.grade_sum),
+                           MAX(p.best_grade), SUM(p.grade_sum),
+                           COALESCE(MAX(s.current_streak), 0), COALESCE(MAX(s.best_streak), 0),
+                           MAX(s.last_active_on)
+                    FROM user_part_stats p
+                    LEFT JOIN streaks s ON s.user_id = p.user_id
+                    GROUP BY p.user_id
+                """)
+            self._leaderboard_expires_at = 0.0
+            logging.info("Rebuilt user statistics")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to rebuild user statistics: {e}")
+            return False
+
+    @read_only
+    async def get_user_stats(self, user_id: int) -> tuple:
+        """Get (totals, per-part rows) of a user. The streak counts as broken after a day without tests."""
+        try:
+            return await self.db.gather(
+                self.db.fetchrow(f"""
+                    SELECT s.*,
+                           CASE WHEN s.last_active_on >= {UTC_TODAY} - 1 THEN s.current_streak ELSE 0 END AS streak,
+                           (SELECT COUNT(*) + 1 FROM user_stats o WHERE o.points > s.points) AS rank
+                    FROM user_stats s WHERE s.user_id = $1
+                """, user_id),
+                self.db.fetch("""
+                    SELECT * FROM user_part_stats WHERE user_id = $1 ORDER BY test_type
+                """, user_id),
+            )
+        except Exception as e:
+            logging.error(f"Failed to get user statistics: {e}")
+            return None, []
+
+    @read_only
+    async def _load_leaderboard(self, limit: int) -> list:
+        return await self.db.fetch("""
+            SELECT s.user_id, u.name, s.points, s.best_grade
+            FROM user_stats s
+            JOIN tg_user u ON u.id = s.user_id
+            WHERE s.points > 0
+            ORDER BY s.points DESC, s.user_id
+            LIMIT $1
+        """, limit)
+
+    async def get_leaderboard(self, limit: int = 10) -> list:
+        """Top users by points, served from memory and refreshed every leaderboard_ttl seconds"""
+        if time.monotonic() < self._leaderboard_expires_at and limit <= self._leaderboard_limit:
+            return self._leaderboard[:limit]
+        try:
+            self._leaderboard = await self._load_leaderboard(limit)
+            self._leaderboard_limit = limit
+            self._leaderboard_expires_at = time.monotonic() + self.leaderboard_ttl
+        except Exception as e:
+            logging.error(f"Failed to get leaderboard: {e}")
+        return self._leaderboard[:limit]
@@ -1,28 +1,146 @@
 import logging
-from db import Database
-from datetime import datetime, timedelta
-from settings import get_test_time_limit
+from db import Database, read_only
+from datetime import datetime, timedelta, timezone
+from settings import get_test_time_limit, test_time_limits, settings
+from log_setup import SAMPLED
+
+# Columns copied between tests, its migration source and tests_archive
+TEST_COLUMNS = "id, test_type, test_level, user_id, topic, started_at, finished_at, finished, response, grade, grade_confidence, feedback"
+
+# A test archived again (e.g. after a failed run) replaces its archived copy
+ARCHIVE_UPDATE = ", ".join(
+    f"{column} = EXCLUDED.{column}" for column in TEST_COLUMNS.split(", ") if column not in ("id", "started_at")
+)
+
+TESTS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER NOT NULL DEFAULT nextval('tests_id_seq'),
+        test_type TEXT NOT NULL,
+        test_level TEXT NOT NULL DEFAULT 'intermediate' CHECK (test_level IN ('basic', 'intermediate', 'advanced')),
+        user_id BIGINT NOT NULL,
+        topic TEXT NOT NULL,
+        started_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        finished_at TIMESTAMP WITH TIME ZONE,
+        finished BOOLEAN DEFAULT FALSE,
+        response TEXT DEFAULT NULL,
+        grade INTEGER DEFAULT 0,
+        grade_confidence REAL DEFAULT NULL,
+        feedback TEXT DEFAULT NULL,
+        PRIMARY KEY (id, started_at),
+        FOREIGN KEY (user_id) REFERENCES tg_user(id)
+    ) PARTITION BY RANGE (started_at)
+"""
+
+# Keyset pages of a user's history: statement name, cursor condition and sort order.
+# $2/$3 are the (started_at, id) cursor; "newer" pages are fetched ascending and reversed.
+HISTORY_PAGES = [
+    ("history_first", "AND $2::timestamptz IS NULL AND $3::int IS NULL", "DESC"),
+    ("history_older", "AND (started_at, id) < ($2, $3)", "DESC"),
+    ("history_newer", "AND (started_at, id) > ($2, $3)", "ASC"),
+    ("history_from", "AND (started_at, id) <= ($2, $3)", "DESC"),
+]
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month(value: datetime) -> datetime:
+    return (value.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def _partition_name(month: datetime) -> str:
+    return f"tests_p{month:%Y%m}"
 
 class TestRepository:
     async def init(self, db: Database):
         self.db = db
         """Initialize the test table if it doesn't exist"""
         try:
-            await self.db.execute("""
-                CREATE TABLE IF NOT EXISTS tests (
-                    id SERIAL PRIMARY KEY,
+            # Tests are partitioned by month of started_at; the sequence is created
+            # separately so that an unpartitioned table can be migrated onto it
+            await self.db.execute_schema("CREATE SEQUENCE IF NOT EXISTS tests_id_seq")
+            await self.db.execute_schema(TESTS_TABLE_DDL.format(table="tests"))
+            # Share of grading samples that agreed with the grade
+            await self.db.execute_schema("""
+                ALTER TABLE tests ADD COLUMN IF NOT EXISTS grade_confidence REAL DEFAULT NULL
+            """)
+            # Feedback sent to the student, shown again in /history
+            await self.db.execute_schema("""
+                ALTER TABLE tests ADD COLUMN IF NOT EXISTS feedback TEXT DEFAULT NULL
+            """)
+            # Unfinished tests are a tiny part of the table: keep a partial index for them
+            await self.db.execute_schema("""
+                CREATE INDEX IF NOT EXISTS tests_active_idx
+                ON tests (user_id, started_at DESC) WHERE finished = FALSE
+            """)
+            # Keyset pagination of a user's history
+            await self.db.execute_schema("""
+                CREATE INDEX IF NOT EXISTS tests_history_idx ON tests (user_id, started_at DESC, id DESC)
+            """)
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS tests_archive (
+                    id INTEGER NOT NULL,
                     test_type TEXT NOT NULL,
-                    test_level TEXT NOT NULL DEFAULT 'intermediate' CHECK (test_level IN ('basic', 'intermediate', 'advanced')),
+                    test_level TEXT NOT NULL,
                     user_id BIGINT NOT NULL,
                     topic TEXT NOT NULL,
-                    started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    started_at TIMESTAMP WITH TIME ZONE NOT NULL,
                     finished_at TIMESTAMP WITH TIME ZONE,
-                    finished BOOLEAN DEFAULT FALSE,
-                    response TEXT DEFAULT NULL,
-                    grade INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES tg_user(id)
+                    finished BOOLEAN,
+                    response TEXT,
+                    grade INTEGER,
+                    grade_confidence REAL,
+                    feedback TEXT,
+                    archived_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    PRIMARY KEY (id, started_at)
                 )
             """)
+            await self.db.execute_schema("ALTER TABLE tests_archive ADD COLUMN IF NOT EXISTS feedback TEXT")
+            try:
+                await self.db.execute_schema("""
+                    ALTER TABLE tests_archive
+                    ALTER COLUMN response SET COMPRESSION lz4,
+                    ALTER COLUMN topic SET COMPRESSION lz4
+                """)
+            except Exception as e:
+                logging.info(f"lz4 compression is not available for tests_archive: {e}")
+
+            if self.db.schema_checks:
+                if await self.is_partitioned():
+                    await self.ensure_partitions()
+                else:
+                    logging.warning("Tests table is not partitioned, run `python maintenance.py partition-tests`")
+            self.db.register("create_test", """
+                INSERT INTO tests (test_type, user_id, topic, test_level) 
+                VALUES ($1, $2, $3, $4)
+                RETURNING id
+            """)
+            self.db.register("get_test", "SELECT * FROM tests WHERE id = $1")
+            # With a lower bound on started_at only the partitions from that month on are read
+            self.db.register("get_test_since", "SELECT * FROM tests WHERE id = $1 AND started_at >= $2")
+            self.db.register("get_active_test", """
+                SELECT * FROM tests 
+                WHERE user_id = $1 AND finished = FALSE
+                ORDER BY started_at DESC
+                LIMIT 1
+            """)
+            self.db.register("update_last_responses", """
+                UPDATE tests
+                SET response = v.response
+                FROM unnest($1::int[], $2::text[]) AS v(id, response)
+                WHERE tests.id = v.id AND tests.finished = FALSE
+            """)
+            for name, condition, order in HISTORY_PAGES:
+                self.db.register(name, f"""
+                    SELECT id, test_type, test_level, started_at, finished, grade
+                    FROM tests
+                    WHERE user_id = $1 {condition}
+                    ORDER BY started_at {order}, id {order}
+                    LIMIT $4
+                """)
+            self.db.register("get_test_details", """
+                SELECT id, test_type, test_level, topic, started_at, finished_at, finished, response, grade, feedback
+                FROM tests
+                WHERE id = $2 AND started_at = $3 AND user_id = $1
+            """)
             logging.info("Tests table initialized")
         except Exception as e:
             logging.error(f"Failed to initialize tests table: {e}")
@@ -30,14 +148,10 @@ class TestRepository:
     async def create_test(self, test_type: str, user_id: int, topic: str, test_level: str) -> int:
         """Create a new test session"""
         try:
-            result = await self.db.fetchrow("""
-                INSERT INTO tests (test_type, user_id, topic, test_level) 
-                VALUES ($1, $2, $3, $4)
-                RETURNING id
-            """, test_type, user_id, topic, test_level)
+            result = await self.db.fetchrow_named("create_test", test_type, user_id, topic, test_level)
             
             test_id = result['id']
-            logging.info(f"Created test session: {test_id} for user {user_id}")
+            logging.info("Created test session %s for user %s", test_id, user_id)
             return test_id
             
         except Exception as e:
@@ -47,12 +161,7 @@ class TestRepository:
     async def get_active_test(self, user_id: int) -> dict:
         """Get the user's active (unfinished) test"""
         try:
-            return await self.db.fetchrow("""
-                SELECT * FROM tests 
-                WHERE user_id = $1 AND finished = FALSE
-                ORDER BY started_at DESC
-                LIMIT 1
-            """, user_id)
+            return await self.db.fetchrow_named("get_active_test", user_id)
         except Exception as e:
             logging.error(f"Failed to get active test: {e}")
             return None
@@ -67,23 +176,24 @@ class TestRepository:
                 WHERE id = $1
             """,  test_id)
             
-            logging.info(f"Finished test: {test_id}")
+            logging.info("Finished test %s", test_id)
             return True
             
         except Exception as e:
             logging.error(f"Failed to finish test: {e}")
             return False
     
-    async def get_test(self, test_id: int) -> dict:
-        """Get a specific test by ID"""
+    async def get_test(self, test_id: int, started_after: datetime = None) -> dict:
+        """Get a specific test by ID. Pass a time it surely started after to skip older partitions."""
         try:
-            return await self.db.fetchrow("""
-                SELECT * FROM tests WHERE id = $1
-            """, test_id)
+            if started_after is not None:
+                return await self.db.fetchrow_named("get_test_since", test_id, started_after)
+            return await self.db.fetchrow_named("get_test", test_id)
         except Exception as e:
             logging.error(f"Failed to get test: {e}")
             return None
     
+    @read_only
     async def get_user_tests(self, user_id: int, limit: int = 10) -> list:
         """Get user's test history"""
         try:
@@ -97,59 +207,225 @@ class TestRepository:
             logging.error(f"Failed to get user tests: {e}")
             return []
     
-    async def cancel_active_test(self, user_id: int) -> bool:
-        """Cancel user's active test"""
+    @read_only
+    async def get_history_page(self, user_id: int, direction: str = "first", started_at: datetime = None,
+                               test_id: int = None, limit: int = 5) -> tuple:
+        """
+        Get one page of a user's tests, newest first, without responses.
+        direction is "first", "older" / "newer" than the (started_at, test_id)
+        cursor, or "from" the cursor on. Returns (rows, has_newer, has_older).
+        """
+        try:
+            rows = await self.db.fetch_named(f"history_{direction}", user_id, started_at, test_id, limit + 1)
+            has_more = len(rows) > limit
+            rows = list(rows[:limit])
+            if direction == "newer":
+                rows.reverse()
+                return rows, has_more, True
+            if direction == "first":
+                return rows, False, has_more
+            if direction == "older":
+                return rows, True, has_more
+            newer = await self.db.fetch_named("history_newer", user_id, started_at, test_id, 1)
+            return rows, bool(newer), has_more
+        except Exception as e:
+            logging.error(f"Failed to get test history: {e}")
+            return [], False, False
+
+    @read_only
+    async def get_test_details(self, user_id: int, test_id: int, started_at: datetime) -> dict:
+        """Get a test of a user with its response and feedback"""
+        try:
+            return await self.db.fetchrow_named("get_test_details", user_id, test_id, started_at)
+        except Exception as e:
+            logging.error(f"Failed to get test details: {e}")
+            return None
+    
+    async def cancel_active_test(self, user_id: int) -> list:
+        """Cancel user's active test. Returns the (user_id, test_type) of the cancelled tests."""
         try:
-            result = await self.db.execute("""
+            # A cancelled test is not graded, whatever response it has
+            return await self.db.fetch("""
                 UPDATE tests 
                 SET finished = TRUE, 
-                    finished_at = NOW()
+                    finished_at = NOW(),
+                    grade = NULL
                 WHERE user_id = $1 AND finished = FALSE
+                RETURNING user_id, test_type
             """, user_id)
             
-            return True
-            
         except Exception as e:
             logging.error(f"Failed to cancel active test: {e}")
-            return False
+            if self.db.in_transaction:
+                raise
+            return []
     
-    async def check_and_cancel_expired_tests(self) -> int:
-        """Check for expired tests and cancel them. Returns number of cancelled tests."""
+    async def check_and_cancel_expired_tests(self, running: list = ()) -> list:
+        """
+        Cancel tests that are past their time limit plus a grace period (their
+        timers were lost). Tests with a completion timer, persisted or in the
+        running list of test ids, are left to it; the response is kept.
+        Returns the (user_id, test_type) of the cancelled tests.
+        Runs as a single UPDATE over the partial index of unfinished tests.
+        """
         try:
-            # Get all active tests
-            active_tests = await self.db.fetch("""
-                SELECT id, test_type, started_at FROM tests 
+            cancelled = await self.db.fetch("""
+                UPDATE tests 
+                SET finished = TRUE, 
+                    finished_at = NOW(),
+                    response = COALESCE(response, 'AUTO_CANCELLED: Time limit exceeded')
                 WHERE finished = FALSE
-            """)
-            
-            cancelled_count = 0
-            current_time = datetime.now()
+                AND id <> ALL($5::int[])
+                AND NOT EXISTS (
+                    SELECT 1 FROM scheduled_jobs j WHERE j.test_id = tests.id AND j.kind = 'completion'
+                )
+                AND started_at < NOW() - make_interval(mins => COALESCE(
+                    (SELECT l.minutes FROM unnest($1::text[], $2::int[]) AS l(test_type, minutes)
+                     WHERE l.test_type = tests.test_type),
+                    $3
+                ) + $4)
+                RETURNING user_id, test_type
+            """, list(test_time_limits.keys()), list(test_time_limits.values()),
+                get_test_time_limit(None), settings.EXPIRED_TEST_GRACE_MINUTES, list(running))
             
-            for test in active_tests:
-                test_type = test['test_type']
-                started_at = test['started_at']
-                time_limit_minutes = get_test_time_limit(test_type)
-                
-                # Calculate if test has expired
-                time_elapsed = current_time - started_at
-                if time_elapsed.total_seconds() > (time_limit_minutes * 60):
-                    # Test has expired, cancel it
-                    await self.db.execute("""
-                        UPDATE tests 
-                        SET finished = TRUE, 
-                            finished_at = NOW(),
-                            response = 'AUTO_CANCELLED: Time limit exceeded'
-                        WHERE id = $1
-                    """, test['id'])
-                    
-                    cancelled_count += 1
-                    logging.info(f"Auto-cancelled expired test {test['id']} (type: {test_type})")
-            
-            return cancelled_count
+            if cancelled:
+                logging.info(f"Auto-cancelled {len(cancelled)} expired tests")
+            return cancelled
             
         except Exception as e:
             logging.error(f"Failed to check expired tests: {e}")
-            return 0
+            if self.db.in_transaction:
+                raise
+            return []
+
+    async def is_partitioned(self) -> bool:
+        """Check whether the tests table is range partitioned"""
+        try:
+            return bool(await self.db.fetchval("""
+                SELECT relkind = 'p' FROM pg_class WHERE oid = 'tests'::regclass
+            """))
+        except Exception as e:
+            logging.error(f"Failed to check tests partitioning: {e}")
+            return False
+
+    async def ensure_partitions(self, start: datetime = None, months_ahead: int = 2) -> None:
+        """Create monthly partitions from start (default: this month) up to months_ahead ahead"""
+        now = datetime.now(timezone.utc)
+        month = _month_start(start or now)
+        last = _month_start(now)
+        for _ in range(months_ahead):
+            last = _next_month(last)
+
+        while month <= last:
+            upper = _next_month(month)
+            await self.db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF tests
+                FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')
+            """)
+            month = upper
+        await self.db.execute("CREATE TABLE IF NOT EXISTS tests_default PARTITION OF tests DEFAULT")
+
+    async def migrate_to_partitioned(self) -> bool:
+        """
+        One-off migration of an unpartitioned tests table into the partitioned
+        layout. Locks the table for the duration, so run it during a quiet period.
+        """
+        async with self.db.transaction() as conn:
+            if conn is None or await self.is_partitioned():
+                return False
+
+            await conn.execute("LOCK TABLE tests IN ACCESS EXCLUSIVE MODE")
+            # Index names are schema-wide: free them for the partitioned table
+            await conn.execute("DROP INDEX IF EXISTS tests_active_idx, tests_history_idx")
+            await conn.execute("ALTER TABLE tests RENAME TO tests_unpartitioned")
+            await conn.execute("ALTER TABLE tests_unpartitioned RENAME CONSTRAINT tests_pkey TO tests_unpartitioned_pkey")
+            await conn.execute("ALTER TABLE tests_unpartitioned ALTER COLUMN id DROP DEFAULT")
+            await conn.execute(TESTS_TABLE_DDL.format(table="tests"))
+
+            oldest = await conn.fetchval("SELECT MIN(started_at) FROM tests_unpartitioned")
+            await self.ensure_partitions(start=oldest)
+
+            expected = await conn.fetchval("SELECT COUNT(*) FROM tests_unpartitioned")
+            moved = await conn.execute(f"""
+                INSERT INTO tests ({TEST_COLUMNS})
+                SELECT id, test_type, test_level, user_id, topic,
+                       COALESCE(started_at, finished_at, NOW()), finished_at, finished,
+                       response, grade, grade_confidence, feedback
+                FROM tests_unpartitioned
+            """)
+            if int(moved.split()[-1]) != expected:
+                # Rolls the whole migration back instead of dropping tests
+                raise RuntimeError(f"Migrated {moved} of {expected} tests, keeping the unpartitioned table")
+            await conn.execute("ALTER SEQUENCE tests_id_seq OWNED BY tests.id")
+            await conn.execute("DROP TABLE tests_unpartitioned")
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS tests_active_idx
+                ON tests (user_id, started_at DESC) WHERE finished = FALSE
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS tests_history_idx ON tests (user_id, started_at DESC, id DESC)
+            """)
+            logging.info(f"Migrated tests to the partitioned layout: {moved}")
+            return True
+
+    async def archive_finished_tests(self, older_than: datetime, batch_size: int = 1000) -> int:
+        """
+        Move finished tests started before older_than into tests_archive in
+        batches, then drop monthly partitions that became empty.
+        Returns number of archived tests.
+        """
+        archived = 0
+        try:
+            while True:
+                moved = await self.db.fetchval(f"""
+                    WITH moved AS (
+                        DELETE FROM tests
+                        WHERE (id, started_at) IN (
+                            SELECT id, started_at FROM tests
+                            WHERE finished = TRUE AND started_at < $1
+                            LIMIT $2
+                        )
+                        RETURNING {TEST_COLUMNS}
+                    ), inserted AS (
+                        INSERT INTO tests_archive ({TEST_COLUMNS})
+                        SELECT {TEST_COLUMNS} FROM moved
+                        ON CONFLICT (id, started_at) DO UPDATE SET {ARCHIVE_UPDATE}, archived_at = NOW()
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM moved
+                """, older_than, batch_size)
+                archived += moved
+                if moved < batch_size:
+                    break
+
+            if archived:
+                logging.info(f"Archived {archived} finished tests started before {older_than}")
+            await self.drop_empty_partitions(older_than)
+            return archived
+
+        except Exception as e:
+            logging.error(f"Failed to archive tests: {e}")
+            return archived
+
+    async def drop_empty_partitions(self, older_than: datetime) -> int:
+        """Drop monthly partitions that end before older_than and hold no tests"""
+        dropped = 0
+        partitions = await self.db.fetch("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'tests'::regclass AND c.relname LIKE 'tests\_p%'
+        """)
+        for partition in partitions:
+            name = partition['relname']
+            month = datetime.strptime(name[len("tests_p"):], "%Y%m").replace(tzinfo=timezone.utc)
+            if _next_month(month) > older_than:
+                continue
+            if await self.db.fetchval(f"SELECT EXISTS (SELECT 1 FROM {name})"):
+                continue
+            await self.db.execute(f"DROP TABLE {name}")
+            dropped += 1
+            logging.info(f"Dropped empty partition {name}")
+        return dropped
     
     async def get_remaining_time(self, test_id: int) -> int:
         """Get remaining time in minutes for a test. Returns negative if expired."""
@@ -201,9 +477,21 @@ class TestRepository:
                 WHERE id = $2 AND finished = FALSE
             """, response, test_id)
             
-            logging.info(f"Updated last response for test {test_id}")
+            logging.info("Updated last response for test %s", test_id, extra=SAMPLED)
             return True
             
         except Exception as e:
             logging.error(f"Failed to update last response: {e}")
-            return False 
\ No newline at end of file
+            return False 
+
+    async def update_last_responses(self, responses: dict) -> bool:
+        """Update the last responses of several unfinished tests in one statement."""
+        try:
+            await self.db.execute_named("update_last_responses", list(responses.keys()), list(responses.values()))
+
+            logging.info("Updated last responses for %d tests", len(responses), extra=SAMPLED)
+            return True
+
+        except Exception as e:
+            logging.error(f"Failed to update last responses: {e}")
+            return False
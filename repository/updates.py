@@ -0,0 +1,43 @@
+import logging
+from datetime import datetime
+from db import Database
+
+class ProcessedUpdateRepository:
+    async def init(self, db: Database):
+        self.db = db
+        """Initialize the processed updates table if it doesn't exist"""
+        try:
+            await self.db.execute_schema("""
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id BIGINT PRIMARY KEY,
+                    received_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            await self.db.execute_schema("""
+                CREATE INDEX IF NOT EXISTS processed_updates_received_at_idx ON processed_updates (received_at)
+            """)
+            self.db.register("claim_update", """
+                INSERT INTO processed_updates (update_id) VALUES ($1)
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING update_id
+            """)
+            logging.info("Processed updates table initialized")
+        except Exception as e:
+            logging.error(f"Failed to initialize processed updates table: {e}")
+
+    async def claim_update(self, update_id: int) -> bool:
+        """Record an update as processed. False if it was already recorded; True on errors, so updates are never lost."""
+        try:
+            return await self.db.fetchval_named("claim_update", update_id) is not None
+        except Exception as e:
+            logging.error(f"Failed to record processed update: {e}")
+            return True
+
+    async def prune(self, older_than: datetime) -> int:
+        """Forget updates received before older_than"""
+        try:
+            result = await self.db.execute("DELETE FROM processed_updates WHERE received_at < $1", older_than)
+            return int(result.split()[-1])
+        except Exception as e:
+            logging.error(f"Failed to prune processed updates: {e}")
+            return 0
@@ -1,12 +1,25 @@
 import logging
 from db import Database
+from log_setup import SAMPLED
+
+# Column combinations accepted by update_user, each backed by its own prepared statement
+USER_UPDATE_SHAPES = [
+    ("invited", "invited_by"),
+    ("language",),
+    ("level",),
+    ("name",),
+    ("role",),
+]
+
+def _update_statement_name(shape: tuple) -> str:
+    return "update_user:" + ",".join(shape)
 
 class UserRepository:
     async def init(self, db: Database):
         self.db = db
         """Initialize the user table if it doesn't exist"""
         try:
-            await self.db.execute("""
+            await self.db.execute_schema("""
                 CREATE TABLE IF NOT EXISTS tg_user (
                     id BIGINT PRIMARY KEY,
                     username TEXT,
@@ -19,6 +32,23 @@ class UserRepository:
                     invited BOOLEAN DEFAULT FALSE
                 )
             """)
+            # Set when a message to the user fails because they blocked the bot
+            await self.db.execute_schema("""
+                ALTER TABLE tg_user ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP WITH TIME ZONE DEFAULT NULL
+            """)
+            self.db.register("get_user", "SELECT * FROM tg_user WHERE id = $1")
+            self.db.register("save_user", """
+                INSERT INTO tg_user (id, username, name) 
+                VALUES ($1, $2, $3)
+                ON CONFLICT (id) 
+                DO UPDATE SET username = $2, name = $3, blocked_at = NULL
+            """)
+            for shape in USER_UPDATE_SHAPES:
+                assignments = ", ".join(f"{column} = ${index}" for index, column in enumerate(shape, start=1))
+                self.db.register(
+                    _update_statement_name(shape),
+                    f"UPDATE tg_user SET {assignments} WHERE id = ${len(shape) + 1}"
+                )
             logging.info("User table initialized")
         except Exception as e:
             logging.error(f"Failed to initialize user table: {e}")
@@ -28,51 +58,49 @@ class UserRepository:
         if username is None:
             username = ""
         try:
-            logging.info(f"Saving user: {user_id}, {username}, {name}")
-            await self.db.execute("""
-                INSERT INTO tg_user (id, username, name) 
-                VALUES ($1, $2, $3)
-                ON CONFLICT (id) 
-                DO UPDATE SET username = $2, name = $3
-            """, user_id, username, name)
+            logging.info("Saving user %s", user_id, extra=SAMPLED)
+            await self.db.execute_named("save_user", user_id, username, name)
             return await self.get_user(user_id)
         except Exception as e:
             logging.error(f"Failed to save user: {e}")
             return False
     
     async def update_user(self, user_id: int, **kwargs):
-        """Update a user"""
+        """Update a user. The updated columns must match one of USER_UPDATE_SHAPES."""
         try:
-            update_fields = []
-            values = []
-            param_count = 1
-            
-            for key, value in kwargs.items():
-                update_fields.append(f"{key} = ${param_count}")
-                values.append(value)
-                param_count += 1
-            
-            values.append(user_id)  # Add user_id as the last parameter
-            update_fields = ", ".join(update_fields)
-            
-            query = f"UPDATE tg_user SET {update_fields} WHERE id = ${param_count}"
-            await self.db.execute(query, *values)
+            shape = next((shape for shape in USER_UPDATE_SHAPES if set(shape) == set(kwargs)), None)
+            if shape is None:
+                logging.error(f"Unsupported user update: {', '.join(sorted(kwargs))}")
+                return False
+
+            values = [kwargs[column] for column in shape]
+            await self.db.execute_named(_update_statement_name(shape), *values, user_id)
             return True
         except Exception as e:
             logging.error(f"Failed to update user: {e}")
             return False
+
     async def update_points(self, user_id: int, points: int):
-        """Update points for a user by adding points in a single query"""
+        """Update points for a user by adding points in a single query (points live in user_stats)"""
         try:
-            await self.db.execute(
-                "UPDATE tg_user SET points = COALESCE(points, 0) + $1 WHERE id = $2",
-                points, user_id
-            )
+            await self.db.execute("""
+                INSERT INTO user_stats (user_id, points) VALUES ($2, $1)
+                ON CONFLICT (user_id) DO UPDATE SET points = user_stats.points + EXCLUDED.points, updated_at = NOW()
+            """, points, user_id)
             return True
         except Exception as e:
             logging.error(f"Failed to update points: {e}")
             return False
     
+    async def mark_blocked(self, user_id: int):
+        """Remember that a user blocked the bot, so broadcasts and reminders skip them"""
+        try:
+            await self.db.execute("UPDATE tg_user SET blocked_at = NOW() WHERE id = $1", user_id)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to mark user as blocked: {e}")
+            return False
+
     async def get_admins(self):
         """Get all admins"""
         try:
@@ -100,7 +128,7 @@ class UserRepository:
     async def get_user(self, user_id: int):
         """Get a user by ID"""
         try:
-            return await self.db.fetchrow("SELECT * FROM tg_user WHERE id = $1", user_id)
+            return await self.db.fetchrow_named("get_user", user_id)
         except Exception as e:
             logging.error(f"Failed to get user: {e}")
             return None
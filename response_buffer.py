@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from metrics import metrics
+
+class ResponseBuffer:
+    """
+    Write-behind buffer for test responses. Only the latest response per test
+    is kept; all dirty entries are written in one batch once no new response
+    arrived for `delay` seconds (or after `max_delay` under constant traffic).
+    """
+
+    def __init__(self, test_repo, delay: float, max_delay: float):
+        self.test_repo = test_repo
+        self.delay = delay
+        self.max_delay = max_delay
+        self.pending: Dict[int, str] = {}
+        self._first_put_at: float = 0.0
+        self._last_put_at: float = 0.0
+        self._flusher: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def put(self, test_id: int, response: str) -> None:
+        """Remember the latest response of a test and schedule a flush"""
+        now = time.monotonic()
+        if not self.pending:
+            self._first_put_at = now
+        self._last_put_at = now
+        if test_id in self.pending:
+            metrics.increment("response_writes_coalesced")
+        self.pending[test_id] = response
+        metrics.set_gauge("response_buffer_size", len(self.pending))
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    def discard(self, test_id: int) -> None:
+        """Drop a buffered response, e.g. when the test is cancelled"""
+        self.pending.pop(test_id, None)
+        metrics.set_gauge("response_buffer_size", len(self.pending))
+
+    async def _run(self) -> None:
+        """Wait for a quiet period, then flush everything that is dirty"""
+        while self.pending:
+            wait = min(self._last_put_at + self.delay, self._first_put_at + self.max_delay) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            await self.flush()
+
+    async def flush(self, test_id: int = None) -> bool:
+        """
+        Write buffered responses to the database in one batch.
+        With test_id only that test's response is written.
+        """
+        async with self._lock:
+            if test_id is not None:
+                if test_id not in self.pending:
+                    return True
+                batch = {test_id: self.pending.pop(test_id)}
+            else:
+                batch, self.pending = self.pending, {}
+                self._first_put_at = time.monotonic()
+            metrics.set_gauge("response_buffer_size", len(self.pending))
+            if not batch:
+                return True
+
+            started = time.monotonic()
+            if await self.test_repo.update_last_responses(batch):
+                metrics.increment("response_flushes")
+                metrics.observe("response_flush_batch_size", len(batch))
+                metrics.observe("response_flush_seconds", time.monotonic() - started)
+                return True
+
+            # Keep failed entries unless a newer response arrived meanwhile
+            for key, response in batch.items():
+                self.pending.setdefault(key, response)
+            # Back off for one quiet period before retrying
+            self._last_put_at = time.monotonic()
+            metrics.set_gauge("response_buffer_size", len(self.pending))
+            logging.error(f"Failed to flush {len(batch)} buffered responses")
+            return False
@@ -1,8 +1,9 @@
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 import os
+import string
 from dataclasses import dataclass
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 # Load environment variables first
 load_dotenv()
@@ -10,10 +11,105 @@ load_dotenv()
 class Settings:
     BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
     DATABASE_URL_UNPOOLED: str = os.getenv("DATABASE_URL_UNPOOLED", "")
+    DATABASE_URL_REPLICA: str = os.getenv("DATABASE_URL_REPLICA", "")
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     ADMINS: list[str] = [
         '658415666',
     ]
+    # Prompt size limits (in tokens)
+    MAX_ESSAY_TOKENS: int = int(os.getenv("MAX_ESSAY_TOKENS", "1500"))
+    MAX_TOPIC_TOKENS: int = int(os.getenv("MAX_TOPIC_TOKENS", "400"))
+    MAX_PROMPT_TOKENS: int = int(os.getenv("MAX_PROMPT_TOKENS", "4000"))
+    LANGUAGE_SAMPLE_TOKENS: int = int(os.getenv("LANGUAGE_SAMPLE_TOKENS", "200"))
+    # Consensus grading: samples per request and the agreement needed to skip a second opinion
+    GRADING_SAMPLES: int = int(os.getenv("GRADING_SAMPLES", "3"))
+    GRADING_MIN_CONFIDENCE: float = float(os.getenv("GRADING_MIN_CONFIDENCE", "0.6"))
+    GRADING_SECOND_OPINION_SAMPLES: int = int(os.getenv("GRADING_SECOND_OPINION_SAMPLES", "4"))
+    # Test responses are written to the database after this many seconds without new responses
+    RESPONSE_FLUSH_DELAY: float = float(os.getenv("RESPONSE_FLUSH_DELAY", "2"))
+    RESPONSE_FLUSH_MAX_DELAY: float = float(os.getenv("RESPONSE_FLUSH_MAX_DELAY", "10"))
+    # Database pool: sizing, lazy warm-up, timeouts and reconnection
+    DB_POOL_MIN_SIZE: int = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+    DB_POOL_MAX_SIZE: int = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+    DB_LAZY_CONNECT: bool = os.getenv("DB_LAZY_CONNECT", "true").lower() in ("1", "true", "yes")
+    DB_COMMAND_TIMEOUT: float = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+    DB_STATEMENT_TIMEOUT_MS: int = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+    DB_MAX_INACTIVE_LIFETIME: float = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+    DB_RECONNECT_INTERVAL: float = float(os.getenv("DB_RECONNECT_INTERVAL", "5"))
+    # Read-only queries fall back to the primary when the replica lags more than this (seconds)
+    DB_REPLICA_MAX_LAG: float = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+    DB_REPLICA_LAG_CHECK_INTERVAL: float = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "15"))
+    # Seconds to wait on shutdown for running handlers and gradings before persisting timers
+    SHUTDOWN_TIMEOUT: float = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+    # Create and migrate tables on startup; can be turned off for restarts without schema changes
+    SCHEMA_CHECKS: bool = os.getenv("SCHEMA_CHECKS", "true").lower() in ("1", "true", "yes")
+    # Tests table maintenance: partitions, expiry sweep and archival of old finished tests
+    MAINTENANCE_INTERVAL: float = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+    EXPIRED_TEST_GRACE_MINUTES: int = int(os.getenv("EXPIRED_TEST_GRACE_MINUTES", "15"))
+    TESTS_ARCHIVE_AFTER_DAYS: int = int(os.getenv("TESTS_ARCHIVE_AFTER_DAYS", "180"))
+    TESTS_ARCHIVE_BATCH_SIZE: int = int(os.getenv("TESTS_ARCHIVE_BATCH_SIZE", "1000"))
+    # Exports sent through Telegram are split into documents of at most this size (bots may upload 50 MB)
+    EXPORT_PART_SIZE_MB: int = int(os.getenv("EXPORT_PART_SIZE_MB", "45"))
+    # Seconds an export may take; it replaces DB_COMMAND_TIMEOUT and DB_STATEMENT_TIMEOUT_MS for the COPY
+    EXPORT_TIMEOUT: float = float(os.getenv("EXPORT_TIMEOUT", "3600"))
+    # Leaderboard shown by /stats and how long it is served from memory
+    LEADERBOARD_SIZE: int = int(os.getenv("LEADERBOARD_SIZE", "10"))
+    LEADERBOARD_CACHE_SECONDS: float = float(os.getenv("LEADERBOARD_CACHE_SECONDS", "60"))
+    # Tests per page of /history
+    HISTORY_PAGE_SIZE: int = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+    # Broadcast messages per second (Telegram allows about 30 for the whole bot) and per saved batch
+    BROADCAST_RATE: float = float(os.getenv("BROADCAST_RATE", "20"))
+    BROADCAST_BATCH_SIZE: int = int(os.getenv("BROADCAST_BATCH_SIZE", "20"))
+    # Remind students after this many days without a test (0 disables reminders);
+    # at most REMINDER_BATCH_SIZE reminders are spread over every REMINDER_INTERVAL seconds
+    REMINDER_DAYS: int = int(os.getenv("REMINDER_DAYS", "3"))
+    REMINDER_INTERVAL: float = float(os.getenv("REMINDER_INTERVAL", "3600"))
+    REMINDER_BATCH_SIZE: int = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+    # Update ids remembered to drop updates Telegram delivers twice; with UPDATE_DEDUP_DATABASE
+    # (on by default in cluster mode) they are also recorded in Postgres for UPDATE_DEDUP_HOURS
+    UPDATE_DEDUP_WINDOW: int = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+    UPDATE_DEDUP_DATABASE: bool = os.getenv(
+        "UPDATE_DEDUP_DATABASE", os.getenv("CLUSTER_MODE", "false")
+    ).lower() in ("1", "true", "yes")
+    UPDATE_DEDUP_HOURS: float = float(os.getenv("UPDATE_DEDUP_HOURS", "24"))
+    # Logs are written as JSON lines ("json") or plain text ("text") by a background thread;
+    # high-volume info events are kept one in LOG_SAMPLE_RATE and longer string arguments are redacted
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")
+    LOG_SAMPLE_RATE: int = int(os.getenv("LOG_SAMPLE_RATE", "10"))
+    LOG_MAX_ARG_LENGTH: int = int(os.getenv("LOG_MAX_ARG_LENGTH", "200"))
+    # Bearer token of the admin HTTP endpoints (/debug/memory); empty disables them
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")
+    # Seconds between registry size checks; a warning is logged when a registry exceeds its
+    # high-water mark ("name=entries,..." for scheduled_tasks, fsm_states, throttle_buckets, ...)
+    MEMORY_CHECK_INTERVAL: float = float(os.getenv("MEMORY_CHECK_INTERVAL", "60"))
+    MEMORY_HIGH_WATER: str = os.getenv(
+        "MEMORY_HIGH_WATER",
+        "scheduled_tasks=10000,scheduled_jobs=10000,fsm_states=50000,response_buffer=5000,"
+        "throttle_buckets=20000,grading_queue=500,in_flight_updates=1000",
+    )
+    # Stack frames recorded per allocation once tracing is started from /debug/memory
+    TRACEMALLOC_FRAMES: int = int(os.getenv("TRACEMALLOC_FRAMES", "1"))
+    # Gradings sent to OpenAI at once; the others wait, earliest deadline first
+    GRADING_CONCURRENCY: int = int(os.getenv("GRADING_CONCURRENCY", "4"))
+    # Token buckets of expensive handlers: topic generation per user and for the whole bot,
+    # and the other heavy commands (/test, /history, /stats, /export) per user. Bursts and refills per minute.
+    THROTTLE_TOPIC_USER_BURST: int = int(os.getenv("THROTTLE_TOPIC_USER_BURST", "2"))
+    THROTTLE_TOPIC_USER_PER_MINUTE: float = float(os.getenv("THROTTLE_TOPIC_USER_PER_MINUTE", "1"))
+    THROTTLE_TOPIC_GLOBAL_BURST: int = int(os.getenv("THROTTLE_TOPIC_GLOBAL_BURST", "30"))
+    THROTTLE_TOPIC_GLOBAL_PER_MINUTE: float = float(os.getenv("THROTTLE_TOPIC_GLOBAL_PER_MINUTE", "120"))
+    THROTTLE_COMMAND_USER_BURST: int = int(os.getenv("THROTTLE_COMMAND_USER_BURST", "5"))
+    THROTTLE_COMMAND_USER_PER_MINUTE: float = float(os.getenv("THROTTLE_COMMAND_USER_PER_MINUTE", "10"))
+    # Several instances share the work through Postgres leases (see cluster.py)
+    CLUSTER_MODE: bool = os.getenv("CLUSTER_MODE", "false").lower() in ("1", "true", "yes")
+    CLUSTER_HEARTBEAT_INTERVAL: float = float(os.getenv("CLUSTER_HEARTBEAT_INTERVAL", "10"))
+    CLUSTER_INSTANCE_TTL: float = float(os.getenv("CLUSTER_INSTANCE_TTL", "30"))
+    CLUSTER_LEASE_TTL: float = float(os.getenv("CLUSTER_LEASE_TTL", "30"))
+    # Cluster mode: test timers are claimed this often, this many seconds before they are due,
+    # and taken over by other instances this many seconds after a claimer stopped running them
+    JOB_POLL_INTERVAL: float = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+    JOB_LOOKAHEAD: float = float(os.getenv("JOB_LOOKAHEAD", "60"))
+    JOB_CLAIM_SECONDS: float = float(os.getenv("JOB_CLAIM_SECONDS", "600"))
 
     class Config:
         env_file = ".env"
@@ -109,7 +205,6 @@ TRANSLATIONS = {
         'test_not_found': '❌ Тест не найден\n\nНачните заново',
         'test_cancelled': '❌ Тест отменен',
         'generating_grade': '🔄 Генерирую оценку...',
-        'grade_title': '📊 Оценка: {grade}',
         'grade_reason_not_finnish': 'Текст не на финском языке',
         'grade_reason_off_topic': 'Текст не соответствует теме',
         'grade_reason_rejected': 'Текст отклонен',
@@ -146,7 +241,31 @@ TRANSLATIONS = {
         'grade_title' : '📊 **Оценка:**\n\n{grade}',
         'name_update_cancelled': '❌ Отмена обновления имени',
         'num_uses':'Введите максимальное количество использований кода',
-        'not_admin':'❌ Вы не администратор'
+        'not_admin':'❌ Вы не администратор',
+        'export_started': '📦 Готовлю выгрузку...',
+        'export_usage': 'ℹ️ Использование: /export [csv|parquet] [since=2025-01-01] [until=2025-02-01] [level=basic] [type=writing_part_1]',
+        'export_error': '❌ Не удалось сделать выгрузку',
+        'export_too_large': '❌ Файл слишком большой для Telegram, используйте python export.py',
+        'stats_title': '📈 Ваша статистика\n\nПопыток: {attempts}\nСредняя оценка: {average}\nЛучшая оценка: {best}\nОчки: {points} (место {rank})\nСерия: {streak} дн. (рекорд {best_streak})\n',
+        'stats_part': '• {part}: {attempts} попыток, средняя {average}, лучшая {best}',
+        'stats_empty': '📈 Пока нет завершенных тестов\n\nИспользуйте /test, чтобы начать',
+        'leaderboard_title': '🏆 Лучшие участники:',
+        'leaderboard_line': '{position}. {name} — {points}',
+        'history_title': '🗂 История тестов:',
+        'history_empty': '🗂 История пуста\n\nИспользуйте /test, чтобы начать',
+        'history_entry': '{date} · {part} · {grade}',
+        'history_details': '📝 {part} ({level})\n🗓 {date}\n\n{topic}\n\n✍️ Ответ:\n{response}\n\n📊 Оценка: {grade}\n\n💡 Отзыв:\n{feedback}',
+        'broadcast_prompt': '📣 Отправьте текст рассылки\n\nИспользуйте /cancel для отмены',
+        'broadcast_confirm': '📣 Отправить это сообщение всем пользователям?',
+        'broadcast_yes': '✅ Отправить',
+        'broadcast_no': '❌ Отмена',
+        'broadcast_started': '📣 Рассылка началась, по окончании придет отчет',
+        'broadcast_cancelled': '❌ Рассылка отменена',
+        'broadcast_finished': '📣 Рассылка завершена\n\nДоставлено: {sent}\nОшибки: {failed}\nЗаблокировали бота: {blocked}',
+        'reminder': '👋 {name}, вы не писали тест уже {days} дн.\n\n📝 Используйте /test, чтобы продолжить подготовку',
+        'throttled': '⏳ Слишком много запросов. Попробуйте снова через {seconds} с.',
+        'grading_queued': '⏳ Ваш ответ в очереди на проверку: место {position}, примерно {minutes} мин.',
+        'grading_failed': 'Не удалось оценить ваш ответ из-за ошибки. Тест завершён без оценки.'
     },
     'en': {
         'welcome': '👋 Hi! Welcome to the YKI preparation bot!\n\n📝 Use /test to start preparing\n⚙️ Use /menu for settings',
@@ -173,7 +292,6 @@ TRANSLATIONS = {
         'test_not_found': '❌ Test not found\n\nStart over',
         'test_cancelled': '❌ Test cancelled',
         'generating_grade': '🔄 Generating grade...',
-        'grade_title': '📊 Grade: {grade}',
         'grade_reason_not_finnish': 'Text is not in Finnish',
         'grade_reason_off_topic': 'Text is off-topic',
         'grade_reason_rejected': 'Text was rejected',
@@ -207,7 +325,31 @@ TRANSLATIONS = {
         'grade_title' : '📊 **Grade:**\n\n{grade}',
         'name_update_cancelled': '❌ Name update cancelled',
         'num_uses':'Enter number of uses for the invite code:',
-        'not_admin':'❌ You are not admin'
+        'not_admin':'❌ You are not admin',
+        'export_started': '📦 Preparing export...',
+        'export_usage': 'ℹ️ Usage: /export [csv|parquet] [since=2025-01-01] [until=2025-02-01] [level=basic] [type=writing_part_1]',
+        'export_error': '❌ Export failed',
+        'export_too_large': '❌ The file is too large for Telegram, use python export.py',
+        'stats_title': '📈 Your statistics\n\nAttempts: {attempts}\nAverage grade: {average}\nBest grade: {best}\nPoints: {points} (rank {rank})\nStreak: {streak} days (best {best_streak})\n',
+        'stats_part': '• {part}: {attempts} attempts, average {average}, best {best}',
+        'stats_empty': '📈 No finished tests yet\n\nUse /test to start',
+        'leaderboard_title': '🏆 Leaderboard:',
+        'leaderboard_line': '{position}. {name} — {points}',
+        'history_title': '🗂 Test history:',
+        'history_empty': '🗂 No tests yet\n\nUse /test to start',
+        'history_entry': '{date} · {part} · {grade}',
+        'history_details': '📝 {part} ({level})\n🗓 {date}\n\n{topic}\n\n✍️ Response:\n{response}\n\n📊 Grade: {grade}\n\n💡 Feedback:\n{feedback}',
+        'broadcast_prompt': '📣 Send the broadcast text\n\nUse /cancel to cancel',
+        'broadcast_confirm': '📣 Send this message to all users?',
+        'broadcast_yes': '✅ Send',
+        'broadcast_no': '❌ Cancel',
+        'broadcast_started': '📣 Broadcast started, you will get a report when it is done',
+        'broadcast_cancelled': '❌ Broadcast cancelled',
+        'broadcast_finished': '📣 Broadcast finished\n\nDelivered: {sent}\nFailed: {failed}\nBlocked the bot: {blocked}',
+        'reminder': '👋 {name}, you have not taken a test for {days} days\n\n📝 Use /test to keep practicing',
+        'throttled': '⏳ Too many requests. Please try again in {seconds} s.',
+        'grading_queued': '⏳ Your response is in the grading queue: position {position}, about {minutes} min.',
+        'grading_failed': 'Your response could not be graded because of an error. The test was finished without a grade.'
     },
     'fi': {
         'welcome': '👋 Hei! Tervetuloa YKI-valmennusbottiin!\n\n📝 Käytä /test aloittaaksesi valmennuksen\n⚙️ Käytä /menu asetusten muuttamiseen',
@@ -267,7 +409,31 @@ TRANSLATIONS = {
         'warning_generic': '⏰ {minutes} minuuttia jäljellä testin loppuun!',
         'name_update_cancelled': '❌ Nimi päivitetty',
         'num_uses':'Syötä kutsumiskoodin käyttömäärä:',
-        'not_admin':'❌ Sinä et ole admin'
+        'not_admin':'❌ Sinä et ole admin',
+        'export_started': '📦 Valmistellaan vientiä...',
+        'export_usage': 'ℹ️ Käyttö: /export [csv|parquet] [since=2025-01-01] [until=2025-02-01] [level=basic] [type=writing_part_1]',
+        'export_error': '❌ Vienti epäonnistui',
+        'export_too_large': '❌ Tiedosto on liian suuri Telegramille, käytä python export.py',
+        'stats_title': '📈 Tilastosi\n\nYrityksiä: {attempts}\nKeskiarvo: {average}\nParas arvosana: {best}\nPisteet: {points} (sija {rank})\nPutki: {streak} päivää (paras {best_streak})\n',
+        'stats_part': '• {part}: {attempts} yritystä, keskiarvo {average}, paras {best}',
+        'stats_empty': '📈 Ei vielä valmiita testejä\n\nAloita komennolla /test',
+        'leaderboard_title': '🏆 Parhaat:',
+        'leaderboard_line': '{position}. {name} — {points}',
+        'history_title': '🗂 Testihistoria:',
+        'history_empty': '🗂 Ei vielä testejä\n\nAloita komennolla /test',
+        'history_entry': '{date} · {part} · {grade}',
+        'history_details': '📝 {part} ({level})\n🗓 {date}\n\n{topic}\n\n✍️ Vastaus:\n{response}\n\n📊 Arvosana: {grade}\n\n💡 Palaute:\n{feedback}',
+        'broadcast_prompt': '📣 Lähetä tiedotteen teksti\n\nPeruuta komennolla /cancel',
+        'broadcast_confirm': '📣 Lähetetäänkö tämä viesti kaikille käyttäjille?',
+        'broadcast_yes': '✅ Lähetä',
+        'broadcast_no': '❌ Peruuta',
+        'broadcast_started': '📣 Tiedote lähtee, saat raportin kun se on valmis',
+        'broadcast_cancelled': '❌ Tiedote peruttu',
+        'broadcast_finished': '📣 Tiedote lähetetty\n\nToimitettu: {sent}\nEpäonnistui: {failed}\nEstänyt botin: {blocked}',
+        'reminder': '👋 {name}, et ole tehnyt testiä {days} päivään\n\n📝 Jatka harjoittelua komennolla /test',
+        'throttled': '⏳ Liian monta pyyntöä. Yritä uudelleen {seconds} s kuluttua.',
+        'grading_queued': '⏳ Vastauksesi on arviointijonossa: sija {position}, noin {minutes} min.',
+        'grading_failed': 'Vastaustasi ei voitu arvioida virheen vuoksi. Testi päättyi ilman arvosanaa.'
     },
     'kz': {
         'welcome': '👋 Сәлем! YKI дайындық ботына қош келдіңіз!\n\n📝 /test арқылы дайындықты бастаңыз\n⚙️ /menu арқылы параметрлерді өзгертіңіз',
@@ -327,10 +493,97 @@ TRANSLATIONS = {
         'warning_generic': '⏰ Сынақтың аяқталуына {minutes} минут қалды!',
         "name_update_cancelled": "❌ Ат өзгертуі тоқтатылды",
         'num_uses':'Шақыру кодының қолдану санын енгізіңіз:',
-        'not_admin':'❌ Сіз админ емессіз'
+        'not_admin':'❌ Сіз админ емессіз',
+        'export_started': '📦 Экспорт дайындалуда...',
+        'export_usage': 'ℹ️ Қолдану: /export [csv|parquet] [since=2025-01-01] [until=2025-02-01] [level=basic] [type=writing_part_1]',
+        'export_error': '❌ Экспорт сәтсіз аяқталды',
+        'export_too_large': '❌ Файл Telegram үшін тым үлкен, python export.py қолданыңыз',
+        'stats_title': '📈 Сіздің статистикаңыз\n\nТалпыныстар: {attempts}\nОрташа баға: {average}\nЕң жақсы баға: {best}\nҰпай: {points} ({rank} орын)\nСерия: {streak} күн (рекорд {best_streak})\n',
+        'stats_part': '• {part}: {attempts} талпыныс, орташа {average}, ең жақсы {best}',
+        'stats_empty': '📈 Әзірге аяқталған тест жоқ\n\nБастау үшін /test қолданыңыз',
+        'leaderboard_title': '🏆 Көшбасшылар:',
+        'leaderboard_line': '{position}. {name} — {points}',
+        'history_title': '🗂 Тесттер тарихы:',
+        'history_empty': '🗂 Әзірге тест жоқ\n\nБастау үшін /test қолданыңыз',
+        'history_entry': '{date} · {part} · {grade}',
+        'history_details': '📝 {part} ({level})\n🗓 {date}\n\n{topic}\n\n✍️ Жауап:\n{response}\n\n📊 Баға: {grade}\n\n💡 Пікір:\n{feedback}',
+        'broadcast_prompt': '📣 Хабарлама мәтінін жіберіңіз\n\nБолдырмау үшін /cancel қолданыңыз',
+        'broadcast_confirm': '📣 Бұл хабарламаны барлық қолданушыларға жіберу керек пе?',
+        'broadcast_yes': '✅ Жіберу',
+        'broadcast_no': '❌ Болдырмау',
+        'broadcast_started': '📣 Тарату басталды, аяқталғанда есеп келеді',
+        'broadcast_cancelled': '❌ Тарату болдырылмады',
+        'broadcast_finished': '📣 Тарату аяқталды\n\nЖеткізілді: {sent}\nҚателер: {failed}\nБотты бұғаттағандар: {blocked}',
+        'reminder': '👋 {name}, сіз {days} күн бойы тест жазбадыңыз\n\n📝 Дайындықты жалғастыру үшін /test қолданыңыз',
+        'throttled': '⏳ Сұраулар тым көп. {seconds} с кейін қайталап көріңіз.',
+        'grading_queued': '⏳ Жауабыңыз тексеру кезегінде: орны {position}, шамамен {minutes} мин.',
+        'grading_failed': 'Қате салдарынан жауабыңыз бағаланбады. Тест бағасыз аяқталды.'
     }
 }
 
+# Every language must define the same keys with the same placeholders as this one
+REFERENCE_LANGUAGE = 'ru'
+
+_formatter = string.Formatter()
+
+@dataclass(frozen=True)
+class CompiledText:
+    """A translation with its format fields parsed once"""
+    text: str
+    fields: frozenset
+    # (literal, field name) pairs, or None when the text needs the full str.format
+    pieces: Optional[tuple]
+
+    def render(self, kwargs: Dict[str, Any]) -> str:
+        if not self.fields:
+            return self.text
+        try:
+            if self.pieces is None:
+                return self.text.format(**kwargs)
+            return "".join(literal + ("" if name is None else str(kwargs[name])) for literal, name in self.pieces)
+        except (KeyError, ValueError, IndexError, AttributeError):
+            return self.text
+
+def _compile_text(text: str) -> CompiledText:
+    parsed = list(_formatter.parse(text))
+    fields = frozenset(name for _, name, _, _ in parsed if name is not None)
+    simple = all(
+        name is None or (name and not spec and not conversion and name.isidentifier())
+        for _, name, spec, conversion in parsed
+    )
+    pieces = tuple((literal, name) for literal, name, _, _ in parsed) if simple else None
+    return CompiledText(text, fields, pieces)
+
+def compile_translations(translations: Dict[str, Dict[str, str]]) -> Dict[str, Dict[str, CompiledText]]:
+    """
+    Compile the translations and check them against REFERENCE_LANGUAGE.
+    Raises ValueError listing every missing, unknown or mismatched key.
+    """
+    reference = {key: _compile_text(text) for key, text in translations[REFERENCE_LANGUAGE].items()}
+    catalog = {REFERENCE_LANGUAGE: reference}
+    problems = []
+    for language, texts in translations.items():
+        if language == REFERENCE_LANGUAGE:
+            continue
+        compiled = {key: _compile_text(text) for key, text in texts.items()}
+        for key in sorted(reference.keys() - compiled.keys()):
+            problems.append(f"{language}: missing '{key}'")
+        for key in sorted(compiled.keys() - reference.keys()):
+            problems.append(f"{language}: '{key}' is not in {REFERENCE_LANGUAGE}")
+        for key in sorted(reference.keys() & compiled.keys()):
+            if compiled[key].fields != reference[key].fields:
+                problems.append(
+                    f"{language}: '{key}' has placeholders {sorted(compiled[key].fields)}, "
+                    f"{REFERENCE_LANGUAGE} has {sorted(reference[key].fields)}"
+                )
+        catalog[language] = {**reference, **compiled}
+    if problems:
+        raise ValueError("Invalid translations:\n" + "\n".join(problems))
+    return catalog
+
+# Built once at import, so a broken translation stops the bot at startup
+CATALOG = compile_translations(TRANSLATIONS)
+
 def get_text(key: str, language: str = 'ru', **kwargs) -> str:
     """
     Get translated text for the given key and language.
@@ -341,17 +594,11 @@ def get_text(key: str, language: str = 'ru', **kwargs) -> str:
         **kwargs: Format parameters for the text
         
     Returns:
-        Translated text
+        Translated text, or the key itself if it is unknown
     """
-    if language not in TRANSLATIONS:
-        language = 'ru'  # Default to Russian
-    
-    text = TRANSLATIONS[language].get(key, TRANSLATIONS['ru'].get(key, key))
-    
+    compiled = CATALOG.get(language, CATALOG[REFERENCE_LANGUAGE]).get(key)
+    if compiled is None:
+        return key
     if kwargs:
-        try:
-            return text.format(**kwargs)
-        except (KeyError, ValueError):
-            return text
-    
-    return text
\ No newline at end of file
+        return compiled.render(kwargs)
+    return compiled.text
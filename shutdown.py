@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Set
+from metrics import metrics
+
+class ShutdownCoordinator:
+    """
+    Tracks work that must finish before the process exits. Once stopping is
+    set, new updates are dropped; drain() then waits a bounded time for the
+    tracked handlers and the given tasks.
+    """
+
+    def __init__(self):
+        self.stopping = False
+        self.in_flight: Set[asyncio.Task] = set()
+
+    @contextmanager
+    def tracking(self):
+        """Track the current task until the block exits"""
+        task = asyncio.current_task()
+        self.in_flight.add(task)
+        try:
+            yield
+        finally:
+            self.in_flight.discard(task)
+
+    async def update_middleware(self, handler, event, data):
+        """Outer update middleware: refuse updates while stopping, track the others"""
+        if self.stopping:
+            metrics.increment("updates_dropped_on_shutdown")
+            return None
+        with self.tracking():
+            return await handler(event, data)
+
+    async def drain(self, tasks: Set[asyncio.Task], timeout: float) -> Set[asyncio.Task]:
+        """Stop intake and wait up to timeout for in-flight handlers and tasks. Returns the unfinished ones."""
+        self.stopping = True
+        pending = {task for task in self.in_flight | set(tasks) if not task.done()}
+        pending.discard(asyncio.current_task())
+        if not pending:
+            return set()
+
+        logging.info(f"Waiting up to {timeout:.0f}s for {len(pending)} in-flight tasks")
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            logging.warning(f"{len(pending)} tasks did not finish before shutdown")
+            metrics.increment("shutdown_unfinished_tasks", len(pending))
+        return pending
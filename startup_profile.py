@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Startup profile of the bot.
+
+    python startup_profile.py            # import time of main.py, slowest modules first
+    python startup_profile.py --top 40
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter and
+summarizes its output. The time spent after the imports (health server,
+database connection, schema checks) is exported by the running bot on
+/metrics as startup_<phase>_seconds and startup_seconds.
+"""
+import argparse
+import subprocess
+import sys
+
+def profile_imports(module: str) -> list:
+    """Return (self microseconds, cumulative microseconds, module) of every import"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "import failed")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(own), int(cumulative), name.rstrip()))
+    return imports
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Show where the bot spends its import time")
+    parser.add_argument("--module", default="main", help="Module to import (default: main)")
+    parser.add_argument("--top", type=int, default=20, help="Number of modules to show")
+    args = parser.parse_args()
+
+    imports = profile_imports(args.module)
+    total = next((cumulative for _, cumulative, name in imports if name.strip() == args.module), 0)
+    print(f"Importing {args.module} took {total / 1000:.0f} ms\n")
+
+    # Top-level packages imported directly by the module, by cumulative time
+    print(f"{'cumulative ms':>13}  package")
+    direct = [item for item in imports if item[2].startswith("   ") and not item[2].startswith("    ")]
+    for _, cumulative, name in sorted(direct, reverse=True, key=lambda item: item[1])[:args.top]:
+        print(f"{cumulative / 1000:>13.1f}  {name.strip()}")
+
+    print(f"\n{'self ms':>13}  module")
+    for own, _, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"{own / 1000:>13.1f}  {name.strip()}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
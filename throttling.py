@@ -0,0 +1,116 @@
+import logging
+import time
+from typing import Awaitable, Callable, Dict, NamedTuple, Set, Tuple
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+from metrics import metrics
+from settings import get_text
+
+class ThrottleLimit(NamedTuple):
+    """Bucket sizes and refills per minute; a global_burst of 0 means no global limit"""
+    user_burst: int
+    user_per_minute: float
+    global_burst: int = 0
+    global_per_minute: float = 0.0
+
+class TokenBucket:
+    def __init__(self, capacity: int, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else float("inf")
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class Throttler:
+    """
+    Inner middleware limiting handlers flagged with flags={"throttle": name}
+    to the token buckets of that limit, per user and for the whole bot.
+    Throttled users are told how long to wait. While a flagged callback of a
+    user runs, further presses of that user are answered and dropped.
+    """
+
+    # Idle buckets are dropped once there are more users than this
+    MAX_BUCKETS = 10000
+
+    def __init__(self, limits: Dict[str, ThrottleLimit], language_of: Callable[[int], Awaitable[str]]):
+        self.limits = limits
+        self.language_of = language_of
+        self.user_buckets: Dict[Tuple[str, int], TokenBucket] = {}
+        self.global_buckets = {
+            name: TokenBucket(limit.global_burst, limit.global_per_minute)
+            for name, limit in limits.items() if limit.global_burst
+        }
+        self.in_flight: Set[Tuple[str, int]] = set()
+
+    def _user_bucket(self, name: str, user_id: int) -> TokenBucket:
+        bucket = self.user_buckets.get((name, user_id))
+        if bucket is None:
+            if len(self.user_buckets) >= self.MAX_BUCKETS:
+                self.user_buckets = {key: b for key, b in self.user_buckets.items() if not b.full}
+            limit = self.limits[name]
+            bucket = self.user_buckets[(name, user_id)] = TokenBucket(limit.user_burst, limit.user_per_minute)
+        return bucket
+
+    def acquire(self, name: str, user_id: int) -> float:
+        """Take a token from both buckets, or return the seconds to wait without taking any"""
+        buckets = [self._user_bucket(name, user_id)]
+        if name in self.global_buckets:
+            buckets.append(self.global_buckets[name])
+        wait = max(bucket.wait_time() for bucket in buckets)
+        if not wait:
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    async def __call__(self, handler, event, data):
+        name = get_flag(data, "throttle")
+        if name not in self.limits:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        key = (name, user_id)
+
+        if isinstance(event, CallbackQuery) and key in self.in_flight:
+            metrics.increment("callbacks_merged")
+            await event.answer()
+            return None
+
+        wait = self.acquire(name, user_id)
+        if wait:
+            metrics.increment(f"throttled_{name}")
+            await self._tell_wait(event, user_id, wait)
+            return None
+
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
+
+    async def _tell_wait(self, event, user_id: int, wait: float) -> None:
+        try:
+            text = get_text('throttled', await self.language_of(user_id), seconds=max(1, round(wait)))
+            if isinstance(event, CallbackQuery):
+                await event.answer(text, show_alert=True)
+            elif isinstance(event, Message):
+                await event.answer(text)
+        except Exception as e:
+            logging.error(f"Failed to send throttling notice: {e}")